@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+"""
+⏱ Бенчмарк: пропускная способность CHART_SERVICE в зависимости от числа воркеров
+(compute_chart — то, что lil_hour/nodes_hour раньше считали в цикле событий)
+"""
+import os
+import sys
+import time
+import random
+import asyncio
+
+os.environ.setdefault("TELEGRAM_TOKEN", "bench")
+os.environ.setdefault("GROQ_API_KEY", "bench")
+
+import bot
+
+N = int(sys.argv[1]) if len(sys.argv) > 1 else 4000
+
+
+def make_jobs(n: int):
+    rnd = random.Random(42)
+    rows = [bot.CITY_CATALOG.row(i) for i in range(len(bot.CITY_CATALOG))] or [("Москва", 55.7558, 37.6173, "RU")]
+    jobs = []
+    for _ in range(n):
+        _, lat, lon, iso = rows[rnd.randrange(len(rows))][:4]
+        # Секунды/минуты в дате — чтобы LRU-кэши эфемерид не подменяли работу
+        date_str = f"{rnd.randint(1, 28):02d}.{rnd.randint(1, 12):02d}.{rnd.randint(bot.BIRTH_YEAR_MIN, bot.BIRTH_YEAR_MAX)}"
+        jobs.append((date_str, rnd.randint(0, 23), lat + rnd.uniform(-0.01, 0.01), lon, iso, 3.0))
+    return jobs
+
+
+async def run(workers: int, jobs) -> float:
+    service = bot.ChartService(workers=workers, limit=len(jobs))
+    await service.start()
+    t0 = time.perf_counter()
+    await asyncio.gather(*(service.run(bot.compute_chart, *job) for job in jobs))
+    elapsed = time.perf_counter() - t0
+    await service.stop()
+    return elapsed
+
+
+def main():
+    bot.MEAN_POINTS.load()
+    jobs = make_jobs(N)
+    print(f"🧮 Расчётов: {N}, ядер: {os.cpu_count()}")
+    base = None
+    for workers in sorted({0, 1, 2, 4, os.cpu_count() or 1}):
+        elapsed = asyncio.run(run(workers, jobs))
+        base = base or elapsed
+        label = "в процессе бота" if workers == 0 else f"{workers} воркер(ов)"
+        print(f"⚙️ {label:>16}: {elapsed:.2f} с ({N/elapsed:,.0f} карт/с, ×{base/elapsed:.2f})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""
+⏱ Бенчмарк: ChartEngine.compute_batch vs расчёт карт по одной
+(calc_lilith_house + calc_nodes + moon_phase, как в lil_hour)
+"""
+import os
+import sys
+import time
+import random
+
+os.environ.setdefault("TELEGRAM_TOKEN", "bench")
+os.environ.setdefault("GROQ_API_KEY", "bench")
+
+import numpy as np
+import bot
+
+N = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+
+
+def make_births(n: int):
+    rnd = random.Random(42)
+    cities = bot.CITY_CATALOG.coordinates() or [(55.7558, 37.6173)]
+    births = []
+    for _ in range(n):
+        lat, lon = rnd.choice(cities)
+        births.append((
+            f"{rnd.randint(1, 28):02d}.{rnd.randint(1, 12):02d}.{rnd.randint(bot.BIRTH_YEAR_MIN, bot.BIRTH_YEAR_MAX)}",
+            rnd.randint(0, 23),
+            rnd.choice([2.0, 3.0, 4.0, 5.0, 7.0]),
+            lat,
+            lon,
+        ))
+    return births
+
+
+def per_chart(births):
+    out = []
+    for date_str, hour, tz_offset, lat, lon in births:
+        _, sign_idx, house, jd, cusps = bot.calc_lilith_house(date_str, f"{hour:02d}:00", tz_offset, lat, lon)
+        _, node_sign, node_lon = bot.calc_nodes(jd, False)
+        node_house = bot.house_for_lon(node_lon, cusps)
+        phase = bot.moon_phase(jd)
+        out.append((sign_idx, house, node_sign, node_house, bot.MOON_PHASES.index(phase)))
+    return out
+
+
+def main():
+    births = make_births(N)
+    print(f"🧮 Карт: {N}")
+
+    t0 = time.perf_counter()
+    single = per_chart(births)
+    t_single = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    batch = bot.CHART_ENGINE.compute_batch(births)
+    t_batch = time.perf_counter() - t0
+
+    print(f"🐢 По одной:  {t_single:.3f} с ({N/t_single:,.0f} карт/с)")
+    print(f"⚡ Пакетом:   {t_batch:.3f} с ({N/t_batch:,.0f} карт/с)")
+    print(f"🚀 Ускорение: ×{t_single/t_batch:.2f}")
+
+    expected = np.array(single)
+    got = np.stack([batch["lilith_sign"], batch["lilith_house"], batch["node_sign"],
+                    batch["node_house"], batch["phase"]], axis=1)
+    mismatches = int(np.any(expected != got, axis=1).sum())
+    if mismatches:
+        print(f"⚠️ Расхождений: {mismatches}")
+    else:
+        print("✅ Знаки, дома и фазы совпадают с расчётом по одной")
+
+
+if __name__ == "__main__":
+    main()
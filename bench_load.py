@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+"""
+⏱ Офлайн-нагрузка всего бота: расчёты Лилит и Узлов, магазин с оплатой, расширенные разборы
+Запуск: python bench_load.py [пользователей] [параллельно] [профиль Groq] [задержка Bot API, с]
+Пример: python bench_load.py 200 50 "*=latency:0.8,jitter:0.4,error:0.05" 0.02
+
+bot.py стартует в webhook-режиме (как в fake_telegram.py) и ходит только в локальные
+заглушки: Bot API (fake_telegram.FakeBotApi) и Groq (fake_groq.FakeGroq, профиль — там же).
+Сеть не нужна. Отчёт: пропускная способность, p50/p95/p99 по обработчикам, пиковая память.
+"""
+import sys
+import time
+import signal
+import asyncio
+import random
+from collections import Counter, defaultdict
+from pathlib import Path
+from typing import Dict, List, NamedTuple, Optional
+
+import httpx
+
+import fake_groq
+from fake_telegram import (FakeBotApi, serve_api, launch_bot, update_json, user_json,
+                           free_port, percentile, STEP_TIMEOUT)
+
+NODES_SHARE = 0.3           # доля пользователей, считающих Узлы (остальные — Лилит, разбор и покупку)
+RSS_SAMPLE_INTERVAL = 0.2   # секунд между замерами памяти
+CITIES = ["Москва", "Санкт-Петербург", "Казань", "Новосибирск"]
+DEEP_DONE = "✅ Выбери действие"
+DEEP_FAILED = "удалось получить разбор"     # stream.fail: все модели Groq отказали
+
+
+class Step(NamedTuple):
+    handler: str        # под этим именем шаг попадает в отчёт
+    kind: str           # text / callback / precheckout / paid
+    value: str = ""
+    until: str = ""     # ждать ответ с таким началом текста или таким методом; "" — первый ответ
+
+
+def birth_steps(prefix: str, entry: str, rnd: random.Random) -> List[Step]:
+    return [
+        Step("start", "text", "/start"),
+        Step(f"{prefix}_start", "text", entry),
+        Step(f"{prefix}_city", "text", rnd.choice(CITIES)),
+        Step(f"{prefix}_day", "text", str(rnd.randint(1, 28))),
+        Step(f"{prefix}_month", "text", str(rnd.randint(1, 12))),
+        Step(f"{prefix}_year", "text", str(rnd.randint(1950, 2005))),
+        Step(f"{prefix}_hour", "text", f"{rnd.randint(0, 23):02d}"),
+    ]
+
+
+def scenario(uid: int, rnd: random.Random) -> List[Step]:
+    if rnd.random() < NODES_SHARE:
+        return birth_steps("nodes", "⭐ Расчёт Узлов Луны", rnd)
+    return birth_steps("lil", "🌙 Расчёт Лилит", rnd) + [
+        Step("deep_lilith", "callback", "deep_lilith", DEEP_DONE),     # первый — в подарок
+        Step("shop_start", "text", "🛒 Магазин разборов"),
+        Step("buy", "callback", "buy_1", "sendInvoice"),
+        Step("precheckout", "precheckout", until="answerPreCheckoutQuery"),
+        Step("success_payment", "paid"),
+        Step("deep_lilith", "callback", "deep_lilith", DEEP_DONE),     # оплаченный
+    ]
+
+
+def matches(step: Step, method: str, text: str) -> bool:
+    return not step.until or method == step.until or text.startswith(step.until)
+
+
+class RssSampler:
+    """Пиковая память бота и его воркеров (пул расчётов) по /proc"""
+
+    def __init__(self, pid: int):
+        self.pid = pid
+        self.peak_total_kb = 0
+        self.peak_workers = 0
+
+    @staticmethod
+    def _status(pid: int, field: str) -> int:
+        try:
+            for line in Path(f"/proc/{pid}/status").read_text().splitlines():
+                if line.startswith(field + ":"):
+                    return int(line.split()[1])
+        except OSError:
+            pass
+        return 0
+
+    def children(self) -> List[int]:
+        pids = []
+        for task in Path(f"/proc/{self.pid}/task").glob("*"):
+            try:
+                pids += [int(p) for p in (task / "children").read_text().split()]
+            except OSError:
+                pass
+        return pids
+
+    def sample(self):
+        workers = self.children()
+        total = sum(self._status(pid, "VmRSS") for pid in [self.pid] + workers)
+        self.peak_total_kb = max(self.peak_total_kb, total)
+        self.peak_workers = max(self.peak_workers, len(workers))
+
+    def bot_peak_kb(self) -> int:
+        return self._status(self.pid, "VmHWM")
+
+    async def run(self):
+        while True:
+            self.sample()
+            await asyncio.sleep(RSS_SAMPLE_INTERVAL)
+
+
+class ScenarioDriver:
+    def __init__(self, api: FakeBotApi, webhook: str, secret: str):
+        self.api = api
+        self.webhook = webhook
+        self.secret = secret
+        self.update_id = 0
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.timeouts = Counter()
+        self.broken = Counter()         # шаг не из чего собрать: нет кнопки или счёта
+        self.rejected = 0
+        self.deep_failed = 0
+        self.completed = 0
+
+    def update_for(self, uid: int, step: Step) -> Optional[Dict]:
+        self.update_id += 1
+        if step.kind == "text":
+            return update_json(self.update_id, uid, step.value)
+        if step.kind == "callback":
+            found = self.api.button(uid, step.value)
+            if found is None:
+                return None
+            data, message = found
+            return {"update_id": self.update_id, "callback_query": {
+                "id": f"{uid}:{self.update_id}", "from": user_json(uid), "chat_instance": str(uid),
+                "data": data, "message": message}}
+        invoice = self.api.invoices.get(uid)
+        if invoice is None:
+            return None
+        amount = sum(price["amount"] for price in invoice["prices"])
+        if step.kind == "precheckout":
+            return {"update_id": self.update_id, "pre_checkout_query": {
+                "id": f"{uid}:{self.update_id}", "from": user_json(uid), "currency": invoice["currency"],
+                "total_amount": amount, "invoice_payload": invoice["payload"]}}
+        update = update_json(self.update_id, uid, "")
+        del update["message"]["text"]
+        update["message"]["successful_payment"] = {
+            "currency": invoice["currency"], "total_amount": amount, "invoice_payload": invoice["payload"],
+            "telegram_payment_charge_id": f"tg-{self.update_id}", "provider_payment_charge_id": f"pr-{self.update_id}"}
+        return update
+
+    async def step(self, client: httpx.AsyncClient, uid: int, step: Step) -> bool:
+        inbox = self.api.inbox[uid]
+        while not inbox.empty():
+            inbox.get_nowait()
+        update = self.update_for(uid, step)
+        if update is None:
+            self.broken[step.handler] += 1
+            return False
+        t0 = time.perf_counter()
+        resp = await client.post(self.webhook, json=update, headers={"X-Telegram-Bot-Api-Secret-Token": self.secret})
+        if resp.status_code != 200:
+            self.rejected += 1
+            return False
+        deadline = t0 + STEP_TIMEOUT
+        while True:
+            try:
+                answered, method, text = await asyncio.wait_for(inbox.get(), deadline - time.perf_counter())
+            except asyncio.TimeoutError:
+                self.timeouts[step.handler] += 1
+                return False
+            if step.until == DEEP_DONE and DEEP_FAILED in text:
+                self.deep_failed += 1
+            if matches(step, method, text):
+                self.latencies[step.handler].append(answered - t0)
+                return True
+
+    async def user(self, client: httpx.AsyncClient, uid: int, steps: List[Step], gate: asyncio.Semaphore):
+        async with gate:
+            for step in steps:
+                if not await self.step(client, uid, step):
+                    return      # дальше сценарий не имеет смысла: бот в другом состоянии
+            self.completed += 1
+
+
+async def main(users: int, concurrency: int, groq_spec: str, api_latency: float):
+    groq = fake_groq.FakeGroq(fake_groq.parse_profile(groq_spec))
+    groq_port = free_port()
+    fake_groq.make_server(groq).listen(groq_port, "127.0.0.1")
+    api = FakeBotApi(latency=api_latency)
+    server, api_url = serve_api(api)
+    bot, webhook, secret, log_path = await launch_bot(
+        api, api_url, GROQ_BASE_URL=f"http://127.0.0.1:{groq_port}", PAYMENT_PROVIDER_TOKEN="381764678:TEST:load")
+
+    sampler = RssSampler(bot.pid)
+    sampling = asyncio.ensure_future(sampler.run())
+    driver = ScenarioDriver(api, webhook, secret)
+    rnd = random.Random(2024)
+    plans = [(10_000 + i, scenario(10_000 + i, rnd)) for i in range(users)]
+    gate = asyncio.Semaphore(concurrency)
+    async with httpx.AsyncClient(limits=httpx.Limits(max_connections=concurrency), timeout=STEP_TIMEOUT) as client:
+        t0 = time.perf_counter()
+        await asyncio.gather(*(driver.user(client, uid, steps, gate) for uid, steps in plans))
+        elapsed = time.perf_counter() - t0
+    sampler.sample()
+    sampling.cancel()
+    bot_peak = sampler.bot_peak_kb()
+
+    bot.send_signal(signal.SIGINT)
+    code = await asyncio.to_thread(bot.wait, 60)
+    server.stop()
+
+    steps = sum(len(v) for v in driver.latencies.values())
+    print(f"👥 Пользователей: {users} (сценариев пройдено {driver.completed}), одновременно: {concurrency}")
+    print(f"🚀 Шагов: {steps} за {elapsed:.2f} с — {steps / elapsed:,.1f} апдейтов/с, "
+          f"{driver.completed / elapsed:,.2f} сценариев/с")
+    print(f"{'обработчик':<16}{'шагов':>7}{'p50 мс':>9}{'p95 мс':>9}{'p99 мс':>9}{'без ответа':>12}")
+    for handler, values in sorted(driver.latencies.items(), key=lambda kv: -percentile(kv[1], 95)):
+        print(f"{handler:<16}{len(values):>7}{percentile(values, 50)*1000:>9.0f}"
+              f"{percentile(values, 95)*1000:>9.0f}{percentile(values, 99)*1000:>9.0f}"
+              f"{driver.timeouts[handler]:>12}")
+    print(f"⚠️ Без ответа: {sum(driver.timeouts.values())}, отклонено webhook-сервером: {driver.rejected}, "
+          f"шагов без кнопки/счёта: {sum(driver.broken.values())}, разборов с ошибкой LLM: {driver.deep_failed}")
+    print(f"🧠 Память: бот пик {bot_peak / 1024:.0f} МБ, бот + воркеры ({sampler.peak_workers}) "
+          f"пик {sampler.peak_total_kb / 1024:.0f} МБ")
+    print(f"🤖 Groq: запросы {dict(groq.requests)}, ответы {dict(groq.statuses)}, брошено {groq.cancelled}")
+    print(f"📡 Вызовы Bot API: {dict(api.calls.most_common())}")
+    print(f"🛑 Остановка: код {code}, журнал: {log_path}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 100,
+                     int(sys.argv[2]) if len(sys.argv) > 2 else 20,
+                     sys.argv[3] if len(sys.argv) > 3 else "*=latency:0.5,jitter:0.3,error:0.02",
+                     float(sys.argv[4]) if len(sys.argv) > 4 else 0.0))
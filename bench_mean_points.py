@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+"""
+⏱ Таблица средних Лилит/Узла: точность относительно swe.calc_ut и скорость поиска
+"""
+import os
+import sys
+import time
+
+os.environ.setdefault("TELEGRAM_TOKEN", "bench")
+os.environ.setdefault("GROQ_API_KEY", "bench")
+
+import numpy as np
+import swisseph as swe
+import bot
+
+N = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+
+
+def main():
+    table = bot.MEAN_POINTS
+    t0 = time.perf_counter()
+    built = not table.path.exists()
+    table.load()
+    print(f"📉 Таблица {'построена' if built else 'открыта'} за {time.perf_counter() - t0:.2f} с: "
+          f"{len(table._data)} точек, шаг {table.step_hours} ч")
+
+    worst = table.verify(samples=20000)
+    print(f"🎯 Макс. ошибка на 20000 случайных моментах: {worst:.6f}″")
+
+    jds = np.random.default_rng(7).uniform(table.jd0, table.jd1, N).tolist()
+    for name, body in (("Лилит", swe.MEAN_APOG), ("Узел", swe.MEAN_NODE)):
+        t0 = time.perf_counter()
+        for jd in jds:
+            swe.calc_ut(jd, body)
+        t_live = time.perf_counter() - t0
+
+        t0 = time.perf_counter()
+        for jd in jds:
+            table.lon(jd, body)
+        t_table = time.perf_counter() - t0
+        print(f"⚡ {name}: swe.calc_ut {t_live/N*1e6:.2f} мкс, таблица {t_table/N*1e6:.2f} мкс (×{t_live/t_table:.1f})")
+
+    outside = swe.julday(bot.BIRTH_YEAR_MIN - 10, 1, 1, 0.0)
+    fallback = bot.body_lon(outside, swe.MEAN_APOG)
+    live = swe.calc_ut(outside, swe.MEAN_APOG)[0][0]
+    print(f"↩️ Вне диапазона — живой расчёт: {'✅' if fallback == live else '❌'}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+"""
+⏱ Бенчмарк: таблицы переходов UTC-смещений vs pytz.localize
+Все годы BIRTH_YEAR_MIN–BIRTH_YEAR_MAX × все города из towns.csv
+"""
+import os
+import sys
+import time
+import datetime as dt
+
+os.environ.setdefault("TELEGRAM_TOKEN", "bench")
+os.environ.setdefault("GROQ_API_KEY", "bench")
+
+import pytz
+import bot
+
+# Несколько точек в году, включая ночные часы около переходов DST
+PROBES = [(1, 15, 12), (3, 27, 2), (4, 15, 9), (7, 15, 12), (9, 28, 3), (10, 27, 23)]
+
+
+def pytz_offset(zone: str, moment: dt.datetime) -> float:
+    return pytz.timezone(zone).localize(moment).utcoffset().total_seconds() / 3600.0
+
+
+def main():
+    points = bot.CITY_CATALOG.coordinates()
+    if not points:
+        print("❌ В towns.csv нет координат")
+        sys.exit(1)
+
+    t0 = time.perf_counter()
+    bot.TZ_RESOLVER.preload(points)
+    zones = sorted({bot.TZ_RESOLVER.zone_at(lat, lon) or "Europe/Moscow" for lat, lon in points})
+    t_resolve = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    bot.TZ_TABLES.preload(zones)
+    t_build = time.perf_counter() - t0
+
+    town_zones = [bot.TZ_RESOLVER.zone_at(lat, lon) or "Europe/Moscow" for lat, lon in points]
+    moments = [dt.datetime(y, m, d, h)
+               for y in range(bot.BIRTH_YEAR_MIN, bot.BIRTH_YEAR_MAX + 1)
+               for m, d, h in PROBES]
+    total = len(town_zones) * len(moments)
+
+    print(f"🏙 Городов: {len(points)}, зон: {len(zones)}")
+    print(f"📅 Лет: {bot.BIRTH_YEAR_MAX - bot.BIRTH_YEAR_MIN + 1}, точек на город: {len(moments)}, всего: {total}")
+    print(f"🗺 Предрасчёт зон: {t_resolve*1000:.1f} мс, построение таблиц: {t_build*1000:.1f} мс")
+
+    t0 = time.perf_counter()
+    old = [pytz_offset(zone, moment) for zone in town_zones for moment in moments]
+    t_old = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    new = [bot.TZ_TABLES.offset_at(zone, moment) for zone in town_zones for moment in moments]
+    t_new = time.perf_counter() - t0
+
+    mismatches = [(z, m, a, b)
+                  for (z, m), a, b in zip(((z, m) for z in town_zones for m in moments), old, new)
+                  if a != b]
+
+    print(f"\n🐢 pytz.localize:       {t_old:.3f} с ({t_old/total*1e6:.2f} мкс/запрос)")
+    print(f"⚡ таблица + bisect:    {t_new:.3f} с ({t_new/total*1e6:.2f} мкс/запрос)")
+    print(f"🚀 Ускорение: ×{t_old/t_new:.1f}")
+
+    if mismatches:
+        print(f"\n⚠️ Расхождений: {len(mismatches)}")
+        for zone, moment, a, b in mismatches[:10]:
+            print(f"   {zone} {moment}: pytz={a:+.2f} таблица={b:+.2f}")
+    else:
+        print("\n✅ Результаты совпадают с pytz во всех точках")
+
+
+if __name__ == "__main__":
+    main()
@@ -11,18 +11,34 @@
 """
 
 import os
+import re
 import sys
 import csv
+import json
+import heapq
+import hashlib
+import time
+import asyncio
+import mmap
+import multiprocessing
+import shutil
+import sqlite3
+import threading
 import datetime as dt
+from array import array
+from bisect import bisect_right
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from pathlib import Path
 from functools import wraps
-from collections import Counter
+from collections import Counter, OrderedDict, deque
 from typing import Dict, Tuple, Optional, List
 
+import numpy as np
 import swisseph as swe
 from dotenv import load_dotenv
-from groq import Groq
-from telegram.error import BadRequest
+from groq import AsyncGroq
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
 
 # 🆕 Новые импорты для точного определения часового пояса
 import pytz
@@ -34,7 +50,8 @@ from telegram import (
 )
 from telegram.ext import (
     Application, CommandHandler, MessageHandler, CallbackQueryHandler,
-    PreCheckoutQueryHandler, filters, ContextTypes, ConversationHandler
+    PreCheckoutQueryHandler, filters, ContextTypes, ConversationHandler, BaseUpdateProcessor,
+    BasePersistence, PersistenceInput
 )
 
 # ---------- CONFIG ----------
@@ -51,10 +68,38 @@ if not TELEGRAM_TOKEN or not GROQ_API_KEY:
 # Проверка токена платежей
 PAYMENTS_ENABLED = bool(PAYMENT_TOKEN and ("TEST" in PAYMENT_TOKEN or "LIVE" in PAYMENT_TOKEN))
 
-EPHE_PATH    = BASE_DIR / "ephe"
+EPHE_PATH    = Path(os.getenv("EPHE_PATH") or BASE_DIR / "ephe")   # можно указать урезанный набор
+DATA_DIR     = Path(os.getenv("DATA_DIR") or BASE_DIR)   # журналы и базы; отдельный каталог для нагрузочных тестов
 TOWNS_CSV    = BASE_DIR / "towns.csv"
-REPORTS_CSV  = BASE_DIR / "reports.csv"
-PAYMENTS_CSV = BASE_DIR / "payments.csv"
+REPORTS_CSV  = DATA_DIR / "reports.csv"
+PAYMENTS_CSV = DATA_DIR / "payments.csv"   # устаревший формат, мигрируется в PAYMENTS_DB
+PAYMENTS_DB  = DATA_DIR / "payments.db"
+TZ_ANSWERS_JSON = DATA_DIR / "tz_cache.json"
+PAYMENT_LOGS_CSV = DATA_DIR / "payment_logs.csv"
+STATS_JSON   = DATA_DIR / "stats.json"
+READINGS_DB  = DATA_DIR / "readings.db"
+CONVERSATIONS_DB = DATA_DIR / "conversations.db"
+MEAN_POINTS_NPY = BASE_DIR / "mean_points.npy"
+
+# ---------- 🌐 Режим запуска ----------
+BOT_MODE = os.getenv("BOT_MODE", "polling").lower()        # polling | webhook
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")                      # публичный адрес, например https://bot.example.com/telegram
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", 8443))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")                # X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", 40))   # 1–100, параллельных запросов от Telegram
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")            # локальная заглушка Bot API (fake_telegram.py)
+
+if BOT_MODE not in ("polling", "webhook"):
+    sys.exit(f"❌ BOT_MODE={BOT_MODE}: допустимо polling или webhook")
+if BOT_MODE == "webhook":
+    if not WEBHOOK_URL:
+        sys.exit("❌ Для BOT_MODE=webhook нужен WEBHOOK_URL")
+    if not WEBHOOK_SECRET or not re.fullmatch(r"[A-Za-z0-9_-]{1,256}", WEBHOOK_SECRET):
+        sys.exit("❌ WEBHOOK_SECRET обязателен: 1–256 символов A-Z, a-z, 0-9, _ и -")
+    if not 1 <= WEBHOOK_MAX_CONNECTIONS <= 100:
+        sys.exit("❌ WEBHOOK_MAX_CONNECTIONS должен быть от 1 до 100")
 
 # ---------- 👑 АДМИНЫ ----------
 ADMINS = {
@@ -73,64 +118,774 @@ PRICE_SINGLE = 30000      # 300₽
 PRICE_TRIPLE = 60000      # 600₽
 PRICE_SUBSEQUENT = 20000  # 200₽
 
+# Поддерживаемый диапазон годов рождения
+BIRTH_YEAR_MIN = 1947
+BIRTH_YEAR_MAX = 2020
+
+# ---------- 🪐 Файлы эфемерид ----------
+EPHE_KINDS = ("sepl", "semo")   # планеты и Солнце, Луна; астероиды (seas) бот не считает
+EPHE_BLOCK_CENTURIES = 6        # один файл .se1 покрывает 600 лет
+EPHE_MARGIN_YEARS = 1           # запас: часовой пояс и сутки запаса таблицы средних точек
+
+class EphemerisFiles:
+    """
+    Какие файлы Swiss Ephemeris нужны для диапазона годов рождения.
+    Только они прогреваются при старте (mmap + MADV_WILLNEED) и попадают в урезанный
+    набор для деплоя — остальные ~150 файлов ephe/ боту не нужны.
+    """
+
+    def __init__(self, path: Path, year_min: int = BIRTH_YEAR_MIN, year_max: int = BIRTH_YEAR_MAX,
+                 kinds: Tuple[str, ...] = EPHE_KINDS, margin: int = EPHE_MARGIN_YEARS):
+        self.path = path
+        self.year_min = year_min - margin
+        self.year_max = year_max + margin
+        self.kinds = kinds
+        self._maps: Dict[str, mmap.mmap] = {}
+
+    @staticmethod
+    def file_name(kind: str, year: int) -> str:
+        """sepl_18.se1 — 1800–2399 гг., seplm06.se1 — 600–1 гг. до н.э. (год астрономический)"""
+        block = (year // 100) // EPHE_BLOCK_CENTURIES * EPHE_BLOCK_CENTURIES
+        return f"{kind}_{block:02d}.se1" if block >= 0 else f"{kind}m{-block:02d}.se1"
+
+    def required(self) -> List[str]:
+        step = EPHE_BLOCK_CENTURIES * 100
+        first = self.year_min // step * step
+        return [self.file_name(kind, year)
+                for kind in self.kinds
+                for year in range(first, self.year_max + 1, step)]
+
+    def missing(self) -> List[str]:
+        return [name for name in self.required() if not (self.path / name).exists()]
+
+    def preload(self) -> int:
+        """Отображает нужные файлы в память и просит ядро подтянуть их в page cache; байт"""
+        total = 0
+        for name in self.required():
+            if name in self._maps or not (self.path / name).exists():
+                continue
+            with open(self.path / name, "rb") as f:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            if hasattr(mapped, "madvise") and hasattr(mmap, "MADV_WILLNEED"):
+                mapped.madvise(mmap.MADV_WILLNEED)
+            self._maps[name] = mapped
+            total += len(mapped)
+        return total
+
+    def close(self):
+        for mapped in self._maps.values():
+            mapped.close()
+        self._maps.clear()
+
+    def build_bundle(self, dest: Path) -> int:
+        """Копирует в dest только нужные файлы (жёсткой ссылкой, если можно); байт"""
+        missing = self.missing()
+        if missing:
+            raise FileNotFoundError(f"В {self.path} нет файлов эфемерид: {', '.join(missing)}")
+        dest.mkdir(parents=True, exist_ok=True)
+        total = 0
+        for name in self.required():
+            src, dst = self.path / name, dest / name
+            if not dst.exists():
+                try:
+                    os.link(src, dst)
+                except OSError:
+                    shutil.copy2(src, dst)
+            total += dst.stat().st_size
+        return total
+
+    def stats(self) -> Dict[str, int]:
+        present = list(self.path.glob("*.se1")) if self.path.is_dir() else []
+        return {
+            "required": len(self.required()),
+            "mapped": len(self._maps),
+            "mapped_bytes": sum(len(m) for m in self._maps.values()),
+            "dir_files": len(present),
+            "dir_bytes": sum(p.stat().st_size for p in present),
+        }
+
+EPHE_FILES = EphemerisFiles(EPHE_PATH)
+
 # ---------- 📡 Groq AI ----------
-groq_client = Groq(api_key=GROQ_API_KEY)
+GROQ_TIMEOUT = 60.0         # секунд на один запрос
+GROQ_MAX_CONCURRENCY = 8    # одновременных запросов к Groq на процесс
+GROQ_BASE_URL = os.getenv("GROQ_BASE_URL") or None    # например, локальный fake_groq.py
 
-def ask_groq(prompt: str, model: str = "llama-3.3-70b-versatile") -> str:
-    try:
-        resp = groq_client.chat.completions.create(
-            messages=[{"role": "user", "content": prompt}],
-            model=model,
-            temperature=0.8,
-            max_tokens=2048
+# Цепочки моделей: первая здоровая — основная, остальные — запасные (по возрастанию p50)
+GROQ_DEEP_MODELS = [m.strip() for m in os.getenv(
+    "GROQ_DEEP_MODELS", "llama-3.3-70b-versatile,llama-3.1-70b-versatile,llama3-70b-8192").split(",") if m.strip()]
+GROQ_FAST_MODELS = [m.strip() for m in os.getenv(
+    "GROQ_FAST_MODELS", "llama-3.1-8b-instant").split(",") if m.strip()]
+
+ROUTE_DEEP = "deep"     # разборы: большая модель, длинный ответ
+ROUTE_FAST = "fast"     # город, часовой пояс: короткий ответ от маленькой модели
+GROQ_ROUTES: Dict[str, Dict] = {
+    ROUTE_DEEP: {"models": GROQ_DEEP_MODELS, "temperature": 0.8, "max_tokens": 2048},
+    ROUTE_FAST: {"models": GROQ_FAST_MODELS + [m for m in GROQ_DEEP_MODELS if m not in GROQ_FAST_MODELS],
+                 "temperature": 0.0, "max_tokens": 64},
+}
+
+GROQ_HEDGE = os.getenv("GROQ_HEDGE", "0") == "1"   # дублировать медленный запрос на запасную модель
+GROQ_HEDGE_MIN_DELAY = 0.5          # секунд, не раньше — даже если p95 меньше
+GROQ_HEDGE_MIN_SAMPLES = 20         # замеров модели, прежде чем доверять её p95
+GROQ_LATENCY_WINDOW = 500           # последних замеров на модель
+GROQ_COOLDOWN_RATE_LIMIT = 30.0     # секунд паузы после 429 без Retry-After
+GROQ_COOLDOWN_FORBIDDEN = 600.0     # после 403/404: модель недоступна ключу или снята
+GROQ_COOLDOWN_ERROR = 5.0           # после GROQ_ERROR_STREAK таймаутов, 5xx или обрывов подряд
+GROQ_ERROR_STREAK = 3               # единичная 5xx — случайность, паузу не заслуживает
+
+# Повторы делает ModelRouter (на другой модели), а не клиент — иначе 429 ждёт впустую
+groq_client = AsyncGroq(api_key=GROQ_API_KEY, base_url=GROQ_BASE_URL, max_retries=0)
+_groq_semaphore = asyncio.Semaphore(GROQ_MAX_CONCURRENCY)
+
+async def _groq_stream(prompt: str, model: str, route: Dict, on_delta) -> str:
+    stream = await groq_client.chat.completions.create(
+        messages=[{"role": "user", "content": prompt}],
+        model=model,
+        temperature=route["temperature"],
+        max_tokens=route["max_tokens"],
+        stream=True
+    )
+    parts = []
+    async for chunk in stream:
+        delta = chunk.choices[0].delta.content if chunk.choices else None
+        if delta:
+            parts.append(delta)
+            await on_delta(delta)
+    return "".join(parts).strip()
+
+async def _groq_call(prompt: str, model: str, route: Dict, timeout: float, on_delta=None) -> str:
+    """
+    Один запрос к одной модели: не блокирует цикл событий, ограничен по времени и параллельности.
+    on_delta — корутина-колбэк: ответ идёт потоком (stream=True) и каждый кусок передаётся в неё.
+    Ошибки не глотает — их разбирает ModelRouter.
+    """
+    async with _groq_semaphore:
+        if on_delta is not None:
+            return await asyncio.wait_for(_groq_stream(prompt, model, route, on_delta), timeout=timeout)
+        resp = await asyncio.wait_for(
+            groq_client.chat.completions.create(
+                messages=[{"role": "user", "content": prompt}],
+                model=model,
+                temperature=route["temperature"],
+                max_tokens=route["max_tokens"]
+            ),
+            timeout=timeout
         )
-        return resp.choices[0].message.content.strip()
-    except Exception as e:
-        print("🤖 Groq error:", e)
+    return (resp.choices[0].message.content or "").strip()
+
+class ModelHealth:
+    __slots__ = ("latency", "ok", "errors", "streak", "rate_limited", "forbidden", "cooldown_until")
+
+    def __init__(self):
+        self.latency = LatencyWindow(GROQ_LATENCY_WINDOW)
+        self.ok = 0
+        self.errors = 0
+        self.streak = 0
+        self.rate_limited = 0
+        self.forbidden = 0
+        self.cooldown_until = 0.0
+
+class ModelRouter:
+    """
+    Выбор модели Groq по маршруту (ROUTE_DEEP / ROUTE_FAST) с учётом её состояния:
+    после 429 модель отдыхает Retry-After секунд, после 403/404 — GROQ_COOLDOWN_FORBIDDEN,
+    после серии из GROQ_ERROR_STREAK прочих ошибок — GROQ_COOLDOWN_ERROR; запрос тут же
+    уходит на следующую модель цепочки. Запасные упорядочены
+    по p50 задержки. С hedge=True непотоковый запрос, не ответивший за p95 основной
+    модели, дублируется на запасную; побеждает первый ответ, второй отменяется.
+    """
+
+    def __init__(self, routes: Dict[str, Dict], hedge: bool = GROQ_HEDGE):
+        self.routes = routes
+        self.hedge = hedge
+        self.health: Dict[str, ModelHealth] = {}
+        self.failovers = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+
+    def _health(self, model: str) -> ModelHealth:
+        health = self.health.get(model)
+        if health is None:
+            health = self.health[model] = ModelHealth()
+        return health
+
+    def candidates(self, route: str) -> List[str]:
+        """
+        Порядок попыток: основная модель, затем запасные от быстрых к медленным.
+        Модели на паузе не трогаем; пусто — на паузе вся цепочка.
+        """
+        chain = self.routes[route]["models"]
+        now = time.monotonic()
+        healthy = [m for m in chain if self._health(m).cooldown_until <= now]
+        if not healthy:
+            return []
+
+        def p50(model: str) -> float:
+            latency = self._health(model).latency
+            return latency.percentile(50) if len(latency) else float("inf")
+
+        return healthy[:1] + sorted(healthy[1:], key=p50)
+
+    def _failed(self, model: str, e: BaseException):
+        health = self._health(model)
+        health.errors += 1
+        health.streak += 1
+        status = getattr(e, "status_code", None)
+        if status == 429:
+            health.rate_limited += 1
+            try:
+                pause = float(e.response.headers.get("retry-after", GROQ_COOLDOWN_RATE_LIMIT))
+            except (AttributeError, ValueError):
+                pause = GROQ_COOLDOWN_RATE_LIMIT
+        elif status in (403, 404):
+            health.forbidden += 1
+            pause = GROQ_COOLDOWN_FORBIDDEN
+        elif health.streak >= GROQ_ERROR_STREAK:
+            pause = GROQ_COOLDOWN_ERROR
+        else:
+            return
+        health.cooldown_until = max(health.cooldown_until, time.monotonic() + pause)
+
+    async def _attempt(self, model: str, prompt: str, route: Dict, timeout: float, on_delta=None) -> str:
+        t0 = time.monotonic()
+        try:
+            text = await _groq_call(prompt, model, route, timeout, on_delta)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self._failed(model, e)
+            raise
+        health = self._health(model)
+        health.latency.add(time.monotonic() - t0)
+        health.ok += 1
+        health.streak = 0
+        return text
+
+    def _hedge_delay(self, model: str) -> Optional[float]:
+        latency = self._health(model).latency
+        if not self.hedge or len(latency) < GROQ_HEDGE_MIN_SAMPLES:
+            return None
+        return max(GROQ_HEDGE_MIN_DELAY, latency.percentile(95))
+
+    async def _hedged(self, model: str, backups: List[str], prompt: str, route: Dict, deadline: float) -> str:
+        delay = self._hedge_delay(model)
+        primary = asyncio.ensure_future(self._attempt(model, prompt, route, deadline - time.monotonic()))
+        tasks = [primary]
+        try:
+            if delay is None:
+                return await primary
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if not done and deadline > time.monotonic():
+                self.hedges += 1
+                tasks.append(asyncio.ensure_future(
+                    self._attempt(backups[0] if backups else model, prompt, route, deadline - time.monotonic())))
+            pending = set(tasks)
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is not primary:
+                            self.hedge_wins += 1
+                        return task.result()
+                    error = error or task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+
+    async def ask(self, prompt: str, route: str = ROUTE_DEEP, timeout: float = GROQ_TIMEOUT,
+                  on_delta=None) -> str:
+        """
+        Ответ первой модели, которая справилась; "" — не справилась ни одна.
+        timeout — на весь запрос: запасная модель получает только остаток времени.
+        """
+        settings = self.routes[route]
+        models = self.candidates(route)
+        if not models:
+            print(f"🤖 Groq: все модели маршрута {route} на паузе")
+            return ""
+        emitted = False
+        deadline = time.monotonic() + timeout
+
+        async def relay(delta: str):
+            nonlocal emitted
+            emitted = True
+            await on_delta(delta)
+
+        for i, model in enumerate(models):
+            left = deadline - time.monotonic()
+            if left <= 0:
+                print(f"🤖 Groq: время на запрос вышло ({timeout:.0f}s), {model} и дальше не пробуем")
+                break
+            if i:
+                self.failovers += 1
+            try:
+                if on_delta is not None:
+                    return await self._attempt(model, prompt, settings, left, relay)
+                return await self._hedged(model, models[i + 1:], prompt, settings, deadline)
+            except asyncio.TimeoutError:
+                print(f"🤖 Groq {model}: timeout ({left:.0f}s)")
+            except Exception as e:
+                print(f"🤖 Groq {model} error:", e)
+            if emitted:
+                # Часть ответа уже показана — повтор на другой модели её задублирует
+                return ""
         return ""
 
+    def stats(self) -> Dict[str, Dict]:
+        now = time.monotonic()
+        return {
+            model: {
+                "ok": h.ok, "errors": h.errors, "rate_limited": h.rate_limited, "forbidden": h.forbidden,
+                "p50_ms": h.latency.percentile(50) * 1000, "p95_ms": h.latency.percentile(95) * 1000,
+                "cooldown": max(0.0, h.cooldown_until - now),
+            }
+            for model, h in self.health.items()
+        }
+
+LLM_ROUTER = ModelRouter(GROQ_ROUTES)
+
+class _Flight:
+    __slots__ = ("task", "parts", "subscribers", "waiters", "streaming")
+
+    def __init__(self, streaming: bool):
+        self.task: Optional[asyncio.Future] = None
+        self.parts: List[str] = []
+        self.subscribers: set = set()
+        self.waiters = 0
+        self.streaming = streaming
+
+    async def publish(self, delta: str):
+        self.parts.append(delta)
+        for deliver in list(self.subscribers):
+            try:
+                await deliver(delta)
+            except Exception as e:
+                # Сломавшийся получатель не должен обрывать общий поток
+                print(f"⚠️ Получатель потока LLM: {e}")
+                self.subscribers.discard(deliver)
+
+class SingleFlight:
+    """
+    Одинаковые одновременные запросы (маршрут + хэш промпта) идут к LLM одним вызовом:
+    остальные ждут тот же future и получают тот же ответ. Потоковые получатели,
+    пришедшие позже, сначала получают уже сгенерированный текст, затем — новые куски.
+    Отмена одного ожидающего не трогает общий запрос; он отменяется, только когда
+    ждать его больше некому.
+    """
+
+    def __init__(self):
+        self._flights: Dict[Tuple[str, str], _Flight] = {}
+        self.calls = 0
+        self.saved = 0
+        self.abandoned = 0
+
+    @staticmethod
+    def key(route: str, prompt: str) -> Tuple[str, str]:
+        return route, hashlib.sha256(prompt.encode()).hexdigest()
+
+    def _forget(self, key, flight: _Flight):
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+
+    async def run(self, key, factory, on_delta=None):
+        """factory(publish_or_None) — корутина настоящего запроса"""
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = _Flight(streaming=on_delta is not None)
+            flight.task = asyncio.ensure_future(factory(flight.publish if flight.streaming else None))
+            flight.task.add_done_callback(lambda _, f=flight: self._forget(key, f))
+            self._flights[key] = flight
+            self.calls += 1
+        else:
+            self.saved += 1
+
+        deliver = None
+        if on_delta is not None and flight.streaming:
+            lock = asyncio.Lock()
+
+            async def deliver(delta: str):
+                async with lock:
+                    await on_delta(delta)
+
+            # Подписка и снимок — в одном шаге цикла: ни один кусок не потеряется и не повторится
+            flight.subscribers.add(deliver)
+            snapshot = "".join(flight.parts)
+
+        flight.waiters += 1
+        try:
+            if deliver is not None and snapshot:
+                await deliver(snapshot)
+            return await asyncio.shield(flight.task)
+        finally:
+            flight.waiters -= 1
+            if deliver is not None:
+                flight.subscribers.discard(deliver)
+            if not flight.waiters and not flight.task.done():
+                self.abandoned += 1
+                flight.task.cancel()
+                self._forget(key, flight)
+
+    def stats(self) -> Dict[str, int]:
+        return {"calls": self.calls, "saved": self.saved, "abandoned": self.abandoned,
+                "in_flight": len(self._flights)}
+
+LLM_FLIGHTS = SingleFlight()
+
+async def ask_groq(prompt: str, route: str = ROUTE_DEEP, timeout: float = GROQ_TIMEOUT,
+                   on_delta=None) -> str:
+    """
+    Запрос к Groq через LLM_FLIGHTS и LLM_ROUTER: одинаковые одновременные запросы
+    склеиваются в один, модель выбирается по маршруту route с переключением при отказе.
+    on_delta — корутина-колбэк для потокового ответа (stream=True).
+    """
+    return await LLM_FLIGHTS.run(SingleFlight.key(route, prompt),
+                                 lambda publish: LLM_ROUTER.ask(prompt, route, timeout, publish),
+                                 on_delta)
+
+# Запросы к LLM в разрезе пользователей — чтобы отменить их, когда пользователь ушёл
+_llm_tasks: Dict[int, set] = {}
+
+async def ask_groq_for(uid: int, prompt: str, **kwargs) -> Optional[str]:
+    """
+    ask_groq от имени пользователя. None — запрос отменён через cancel_llm_for(uid).
+    """
+    task = asyncio.ensure_future(ask_groq(prompt, **kwargs))
+    tasks = _llm_tasks.setdefault(uid, set())
+    tasks.add(task)
+    try:
+        return await asyncio.shield(task)
+    except asyncio.CancelledError:
+        if task.cancelled():
+            return None
+        task.cancel()
+        raise
+    finally:
+        tasks.discard(task)
+        if not tasks:
+            _llm_tasks.pop(uid, None)
+
+def cancel_llm_for(uid: int) -> int:
+    """Отменяет все незавершённые запросы пользователя к LLM"""
+    tasks = [t for t in _llm_tasks.get(uid, ()) if not t.done()]
+    for task in tasks:
+        task.cancel()
+    return len(tasks)
+
+# ---------- 📚 Кэш разборов ----------
+READING_MODEL = GROQ_DEEP_MODELS[0]                         # в ключе кэша; ответы запасных моделей — туда же
+READING_PROMPT_VERSION = 1                                  # менять при любой правке промпта разбора
+READING_VARIANTS = int(os.getenv("READING_VARIANTS", 3))    # разных текстов на одну карту
+READING_TTL = 30 * 24 * 3600                                # секунд
+READING_CACHE_MAX = 20000                                   # строк в базе, сверх — вытесняются давно не выданные
+
+class ReadingCache:
+    """
+    Сгенерированные разборы по ключу «нормализованная карта + модель + версия промпта».
+    На ключ — до variants текстов: пользователь получает тот, что ещё не видел;
+    новый запрос к LLM — только когда он видел все. LRU по last_used + TTL по created.
+    """
+
+    def __init__(self, path: Path, variants: int = READING_VARIANTS, ttl: float = READING_TTL,
+                 max_rows: int = READING_CACHE_MAX):
+        self.path = path
+        self.variants = max(1, variants)
+        self.ttl = ttl
+        self.max_rows = max_rows
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+
+    def _db(self) -> sqlite3.Connection:
+        if self._conn is None:
+            conn = sqlite3.connect(str(self.path), check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS readings ("
+                " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+                " key TEXT NOT NULL,"
+                " text TEXT NOT NULL,"
+                " created REAL NOT NULL,"
+                " last_used REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS readings_key ON readings (key)")
+            conn.execute("CREATE INDEX IF NOT EXISTS readings_lru ON readings (last_used)")
+            self._conn = conn
+        return self._conn
+
+    @staticmethod
+    def key(facts: Dict, model: str = READING_MODEL, version: int = READING_PROMPT_VERSION) -> str:
+        raw = json.dumps({"facts": facts, "model": model, "v": version}, sort_keys=True)
+        return hashlib.sha256(raw.encode()).hexdigest()
+
+    def pick(self, key: str, seen) -> Optional[Tuple[int, str]]:
+        """Давно не выдававшийся вариант, которого нет в seen (id уже показанных)"""
+        now = time.time()
+        seen = set(seen)
+        with self._lock:
+            db = self._db()
+            rows = db.execute("SELECT id, text FROM readings WHERE key = ? AND created >= ? ORDER BY last_used",
+                              (key, now - self.ttl)).fetchall()
+            for rid, text in rows:
+                if rid not in seen:
+                    db.execute("UPDATE readings SET last_used = ? WHERE id = ?", (now, rid))
+                    self.hits += 1
+                    return rid, text
+        self.misses += 1
+        return None
+
+    def put(self, key: str, text: str) -> int:
+        """Новый вариант; если их уже variants — заменяет самый старый"""
+        now = time.time()
+        with self._lock:
+            db = self._db()
+            same = db.execute("SELECT id FROM readings WHERE key = ? AND text = ? AND created >= ?",
+                              (key, text, now - self.ttl)).fetchone()
+            if same is not None:
+                # Тот же ответ уже лежит (склеенный запрос двух пользователей); просроченный не в счёт —
+                # его удалит очистка ниже
+                return same[0]
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                db.execute("DELETE FROM readings WHERE key = ? AND created < ?", (key, now - self.ttl))
+                extra = db.execute("SELECT COUNT(*) FROM readings WHERE key = ?", (key,)).fetchone()[0] - self.variants + 1
+                if extra > 0:
+                    db.execute("DELETE FROM readings WHERE id IN "
+                               "(SELECT id FROM readings WHERE key = ? ORDER BY created LIMIT ?)", (key, extra))
+                rid = db.execute("INSERT INTO readings (key, text, created, last_used) VALUES (?, ?, ?, ?) RETURNING id",
+                                 (key, text, now, now)).fetchone()[0]
+                over = db.execute("SELECT COUNT(*) FROM readings").fetchone()[0] - self.max_rows
+                if over > 0:
+                    db.execute("DELETE FROM readings WHERE id IN "
+                               "(SELECT id FROM readings ORDER BY last_used LIMIT ?)", (over,))
+                db.execute("COMMIT")
+            except Exception:
+                db.execute("ROLLBACK")
+                raise
+        return rid
+
+    def purge_expired(self) -> int:
+        with self._lock:
+            return self._db().execute("DELETE FROM readings WHERE created < ?", (time.time() - self.ttl,)).rowcount
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            rows = self._db().execute("SELECT COUNT(*), COUNT(DISTINCT key) FROM readings").fetchone()
+        total = self.hits + self.misses
+        return {"rows": rows[0], "keys": rows[1], "hits": self.hits, "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0}
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+READINGS = ReadingCache(READINGS_DB)
+
+# ---------- 🗺 Резолвер координат → IANA-зона ----------
+TZ_CACHE_SIZE = 4096      # записей в LRU
+TZ_CACHE_PRECISION = 3    # знаков после запятой в ключе (~100 м)
+
+COUNTRY_DEFAULT_TZ = {
+    'RU': 'Europe/Moscow',
+    'UA': 'Europe/Kyiv',
+    'BY': 'Europe/Minsk',
+    'KZ': 'Asia/Almaty',
+    'UZ': 'Asia/Tashkent',
+    'LT': 'Europe/Vilnius',
+    'LV': 'Europe/Riga',
+    'EE': 'Europe/Tallinn',
+    'GE': 'Asia/Tbilisi',
+    'AM': 'Asia/Yerevan',
+    'AZ': 'Asia/Baku',
+}
+
+class TimezoneResolver:
+    """
+    Один TimezoneFinder на весь процесс + LRU по округлённым координатам.
+    Зоны городов из towns.csv считаются заранее и никогда не вытесняются.
+    """
+
+    def __init__(self, cache_size: int = TZ_CACHE_SIZE, precision: int = TZ_CACHE_PRECISION):
+        self._finder: Optional[TimezoneFinder] = None
+        self._lock = threading.Lock()
+        self._cache: "OrderedDict[Tuple[float, float], Optional[str]]" = OrderedDict()
+        self._static: Dict[Tuple[float, float], Optional[str]] = {}
+        self.cache_size = cache_size
+        self.precision = precision
+        self.hits = 0
+        self.misses = 0
+
+    def _key(self, lat: float, lon: float) -> Tuple[float, float]:
+        return round(lat, self.precision), round(lon, self.precision)
+
+    def _get_finder(self) -> TimezoneFinder:
+        # Ленивая загрузка полигонов — один раз, под локом
+        if self._finder is None:
+            with self._lock:
+                if self._finder is None:
+                    self._finder = TimezoneFinder(in_memory=True)
+        return self._finder
+
+    def _lookup(self, key: Tuple[float, float]) -> Optional[str]:
+        return self._get_finder().timezone_at(lat=key[0], lng=key[1])
+
+    def zone_at(self, lat: float, lon: float) -> Optional[str]:
+        """IANA-имя зоны для координат (None, если точка вне полигонов)"""
+        key = self._key(lat, lon)
+        with self._lock:
+            if key in self._static:
+                self.hits += 1
+                return self._static[key]
+            if key in self._cache:
+                self.hits += 1
+                self._cache.move_to_end(key)
+                return self._cache[key]
+            self.misses += 1
+
+        name = self._lookup(key)
+
+        with self._lock:
+            self._cache[key] = name
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return name
+
+    def preload(self, points) -> int:
+        """Заранее считает зоны для пар (lat, lon), например для всех строк towns.csv"""
+        count = 0
+        for lat, lon in points:
+            key = self._key(lat, lon)
+            if key in self._static:
+                continue
+            self._static[key] = self._lookup(key)
+            count += 1
+        return count
+
+    def zones(self) -> set:
+        """Все IANA-зоны, найденные при предрасчёте"""
+        return {name for name in self._static.values() if name}
+
+    def stats(self) -> Dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses,
+                "cached": len(self._cache), "static": len(self._static)}
+
+TZ_RESOLVER = TimezoneResolver()
+
+def resolve_timezone_name(lat: float, lon: float, iso: str) -> str:
+    """IANA-зона по координатам, а если не нашли — эвристика по стране"""
+    return TZ_RESOLVER.zone_at(lat, lon) or COUNTRY_DEFAULT_TZ.get((iso or "").upper(), 'Europe/Moscow')
+
+# ---------- 📈 Таблицы переходов UTC-смещений ----------
+_EPOCH = dt.datetime(1970, 1, 1)
+
+def _epoch_seconds(moment: dt.datetime) -> float:
+    return (moment - _EPOCH).total_seconds()
+
+class TzTransitionTable:
+    """
+    Отсортированные переходы (utc_instant, offset) одной зоны в диапазоне лет рождения.
+    Смещение для локального времени ищется бисекцией, без pytz.localize.
+    """
+    __slots__ = ("zone", "start", "end", "utc", "local", "offsets")
+
+    def __init__(self, zone: str, year_min: int, year_max: int):
+        tz = pytz.timezone(zone)
+        self.zone = zone
+        # Запас в сутки с каждой стороны, чтобы покрыть любую локальную дату диапазона
+        self.start = _epoch_seconds(dt.datetime(year_min, 1, 1) - dt.timedelta(days=1))
+        self.end = _epoch_seconds(dt.datetime(year_max + 1, 1, 1) + dt.timedelta(days=1))
+        self.utc = array('d')
+        self.local = array('d')
+        self.offsets = array('d')
+
+        transitions = getattr(tz, "_utc_transition_times", None)
+        if not transitions:
+            # Зона без переходов (UTC, Etc/GMT±N)
+            offset = tz.utcoffset(dt.datetime(year_min, 1, 1)).total_seconds()
+            self._append(self.start, offset)
+            return
+
+        infos = tz._transition_info
+        first = max(bisect_right(transitions, dt.datetime(year_min - 1, 12, 31)) - 1, 0)
+        for moment, info in zip(transitions[first:], infos[first:]):
+            instant = _epoch_seconds(moment)
+            if instant > self.end:
+                break
+            self._append(max(instant, self.start), info[0].total_seconds())
+
+    def _append(self, instant: float, offset: float):
+        if self.offsets and self.offsets[-1] == offset:
+            return
+        self.utc.append(instant)
+        self.local.append(instant + offset)
+        self.offsets.append(offset)
+
+    def offset_at(self, local: dt.datetime) -> Optional[float]:
+        """Смещение в часах для наивного локального времени (None — вне таблицы)"""
+        instant = _epoch_seconds(local)
+        if not self.start + 86400 <= instant < self.end - 86400:
+            return None
+        idx = bisect_right(self.local, instant) - 1
+        return self.offsets[max(idx, 0)] / 3600.0
+
+class TzTransitionTables:
+    """Реестр таблиц переходов: строятся один раз на зону и живут весь процесс"""
+
+    def __init__(self, year_min: int = BIRTH_YEAR_MIN, year_max: int = BIRTH_YEAR_MAX):
+        self.year_min = year_min
+        self.year_max = year_max
+        self._tables: Dict[str, TzTransitionTable] = {}
+        self._lock = threading.Lock()
+
+    def table(self, zone: str) -> TzTransitionTable:
+        table = self._tables.get(zone)
+        if table is None:
+            with self._lock:
+                table = self._tables.get(zone)
+                if table is None:
+                    table = TzTransitionTable(zone, self.year_min, self.year_max)
+                    self._tables[zone] = table
+        return table
+
+    def preload(self, zones) -> int:
+        for zone in zones:
+            self.table(zone)
+        return len(self._tables)
+
+    def offset_at(self, zone: str, local: dt.datetime) -> float:
+        """Смещение в часах; вне диапазона таблицы — обычный pytz.localize"""
+        offset = self.table(zone).offset_at(local)
+        if offset is None:
+            offset = pytz.timezone(zone).localize(local).utcoffset().total_seconds() / 3600.0
+        return offset
+
+TZ_TABLES = TzTransitionTables()
+
 # ---------- 🌍 Точное определение часового пояса с учётом DST ----------
-def get_precise_tz_offset(lat: float, lon: float, iso: str, date_str: str) -> Optional[float]:
+def get_precise_tz_offset(lat: float, lon: float, iso: str, date_str: str, hour: int = 12) -> Optional[float]:
     """
-    Определяет точное смещение от UTC с учётом летнего времени для конкретной даты.
+    Определяет точное смещение от UTC с учётом летнего времени для конкретной даты и часа.
     """
     try:
-        # Определяем IANA timezone по координатам
-        tf = TimezoneFinder()
-        timezone_name = tf.timezone_at(lng=lon, lat=lat)
-        
-        # Если не нашли по координатам, используем эвристику по стране
-        if not timezone_name:
-            timezone_name = {
-                'RU': 'Europe/Moscow',
-                'UA': 'Europe/Kyiv',
-                'BY': 'Europe/Minsk',
-                'KZ': 'Asia/Almaty',
-                'UZ': 'Asia/Tashkent',
-                'LT': 'Europe/Vilnius',
-                'LV': 'Europe/Riga',
-                'EE': 'Europe/Tallinn',
-                'GE': 'Asia/Tbilisi',
-                'AM': 'Asia/Yerevan',
-                'AZ': 'Asia/Baku',
-            }.get(iso.upper(), 'Europe/Moscow')
-        
+        # Определяем IANA timezone по координатам (общий резолвер с кэшем)
+        timezone_name = resolve_timezone_name(lat, lon, iso)
+
         # Парсим дату
         day, month, year = map(int, date_str.split('.'))
         
         # Создаём datetime объект (НЕ используем имя 'dt' для переменной!)
-        date_obj = dt.datetime(year, month, day, 12, 0)  # 12:00 чтобы избежать перехода дня
-        
-        # Получаем timezone и смещение для этой конкретной даты
-        tz = pytz.timezone(timezone_name)
-        
-        # Делаем datetime "aware" (с timezone)
-        aware_datetime = tz.localize(date_obj)
+        date_obj = dt.datetime(year, month, day, hour, 0)
         
-        # Получаем смещение от UTC
-        offset = aware_datetime.utcoffset()
-        
-        return offset.total_seconds() / 3600.0
+        # Смещение берём из предрассчитанной таблицы переходов зоны
+        return TZ_TABLES.offset_at(timezone_name, date_obj)
         
     except Exception as e:
         print(f"❌ Ошибка определения TZ: {e}, используем базовое значение")
@@ -177,17 +932,601 @@ def write_csv_dict(path: Path, rows: List[Dict[str, str]], header: List[str]):
     except Exception as e:
         print(f"❌ CSV write error {path}: {e}")
 
+# ---------- 🧾 Журнал расчётов ----------
+REPORTS_HEADER = ["ts", "uid", "username", "full_name", "type", "city", "iso", "date", "time", "tz", "tz_offset", "dst_applied"]
+REPORTS_FLUSH_ROWS = 100       # сбросить на диск, как только накопилось столько строк
+REPORTS_FLUSH_INTERVAL = 2.0   # ...или не реже, чем раз в столько секунд
+
+class ReportLog:
+    """
+    Append-only CSV через очередь: хендлеры кладут строку и сразу идут дальше,
+    фоновая задача пишет пачками через один файловый дескриптор на процесс.
+    """
+
+    def __init__(self, path: Path, header: List[str],
+                 flush_rows: int = REPORTS_FLUSH_ROWS, flush_interval: float = REPORTS_FLUSH_INTERVAL,
+                 on_write=None):
+        self.path = path
+        self.header = header
+        self.on_write = on_write   # on_write(rows, offset) — после записи пачки на диск
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._file = None
+        self._writer = None
+
+    def _open(self):
+        if self._file is None:
+            ensure_csv(self.path, self.header)
+            self._file = self.path.open("a", newline="", encoding="utf-8")
+            self._writer = csv.writer(self._file)
+
+    def _write(self, rows: List[list]):
+        self._open()
+        self._writer.writerows(rows)
+        self._file.flush()
+        if self.on_write is not None:
+            self.on_write(rows, self._file.tell())
+
+    async def start(self):
+        if self._task is None:
+            self._queue = asyncio.Queue()
+            self._task = asyncio.create_task(self._run())
+
+    def log(self, row: list):
+        """Поставить строку в очередь (до start() — синхронная запись, как раньше)"""
+        if self._queue is None:
+            self._write([row])
+        else:
+            self._queue.put_nowait(row)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        running = True
+        while running:
+            row = await self._queue.get()
+            if row is None:
+                break
+            batch = [row]
+            deadline = loop.time() + self.flush_interval
+            while len(batch) < self.flush_rows:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    row = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if row is None:
+                    running = False
+                    break
+                batch.append(row)
+            try:
+                await asyncio.to_thread(self._write, batch)
+            except Exception as e:
+                print(f"❌ Report log write error {self.path}: {e}")
+
+    async def stop(self):
+        """Дописать всё, что осталось в очереди, и закрыть файл"""
+        if self._task is not None:
+            self._queue.put_nowait(None)   # всё, что встало в очередь раньше, будет записано
+            await self._task
+            self._task = None
+            self._queue = None
+        if self._file is not None:
+            self._file.close()
+            self._file = self._writer = None
+
+# ---------- 📊 Статистика для /reports ----------
+STATS_TOP_K = 5
+STATS_SNAPSHOT_INTERVAL = 60.0   # секунд между снимками на диск
+STATS_SNAPSHOT_TOP = 100         # городов/пользователей в снимке: запас над топ-k, остальные не храним
+
+class TopCounter:
+    """
+    Counter с поддерживаемым топ-k; счётчики только растут.
+    В снимок попадают только первые `keep`, а отброшенным ключам остаётся floor —
+    счёт последнего из сохранённых. Вернувшийся ключ продолжает с floor, а не с нуля,
+    поэтому после перезапуска счёт — оценка сверху, а топ приблизительный.
+    """
+
+    def __init__(self, k: int, counts: Optional[Dict[str, int]] = None, floor: int = 0):
+        self.k = k
+        self.counts: Counter = Counter(counts or {})
+        self.floor = floor
+        self._top = [key for key, _ in self.counts.most_common(k)]
+
+    def add(self, key: str, n: int = 1):
+        if key not in self.counts:
+            self.counts[key] = self.floor
+        self.counts[key] += n
+        if key not in self._top:
+            if len(self._top) < self.k:
+                self._top.append(key)
+            elif self.counts[key] > self.counts[self._top[-1]]:
+                self._top[-1] = key
+            else:
+                return
+        self._top.sort(key=lambda x: self.counts[x], reverse=True)
+
+    def top(self) -> List[Tuple[str, int]]:
+        return [(key, self.counts[key]) for key in self._top]
+
+    def snapshot(self, keep: int) -> Tuple[Dict[str, int], int]:
+        """Первые keep счётчиков и floor для остальных"""
+        kept = self.counts.most_common(keep + 1)
+        floor = max(self.floor, kept.pop()[1]) if len(kept) > keep else self.floor
+        return dict(kept), floor
+
+class BalanceTop:
+    """Топ-k по балансу: куча с ленивым удалением устаревших записей"""
+
+    def __init__(self, k: int):
+        self.k = k
+        self.balances: Dict[int, int] = {}
+        self._heap: List[Tuple[int, int]] = []
+
+    def update(self, uid: int, balance: int):
+        if balance > 0:
+            self.balances[uid] = balance
+            heapq.heappush(self._heap, (-balance, uid))
+        else:
+            self.balances.pop(uid, None)
+        if len(self._heap) > 2 * len(self.balances) + 64:
+            self._heap = [(-b, u) for u, b in self.balances.items()]
+            heapq.heapify(self._heap)
+
+    def top(self) -> List[Tuple[int, int]]:
+        found: List[Tuple[int, int]] = []
+        valid: List[Tuple[int, int]] = []
+        while self._heap and len(found) < self.k:
+            neg, uid = heapq.heappop(self._heap)
+            if self.balances.get(uid) == -neg and uid not in (u for u, _ in found):
+                found.append((uid, -neg))
+                valid.append((neg, uid))
+        for item in valid:
+            heapq.heappush(self._heap, item)
+        return found
+
+class BotStats:
+    """
+    Агрегаты для /reports, обновляемые по мере записи событий.
+    Снимок хранит смещения в reports.csv и payment_logs.csv: при старте
+    дочитывается только хвост после снимка, а не вся история.
+    Из счётчиков по городам и пользователям в снимок идут только первые
+    STATS_SNAPSHOT_TOP — размер файла не растёт с числом пользователей,
+    а топ после перезапуска приблизительный (см. TopCounter).
+    """
+
+    def __init__(self, path: Path, k: int = STATS_TOP_K):
+        self.path = path
+        self.k = k
+        self._lock = threading.Lock()
+        self._task: Optional[asyncio.Task] = None
+        self._reset_events()
+        self._reset_ledger()
+        self.dirty = False
+
+    def _reset_events(self):
+        self.total = 0
+        self.by_type: Counter = Counter()
+        self.by_city = TopCounter(self.k)
+        self.by_user = TopCounter(self.k)
+        self.dst_count = 0
+        self.revenue = 0
+        self.reports_offset = 0
+        self.payments_offset = 0
+
+    def _reset_ledger(self):
+        self.users = 0
+        self.total_balance = 0
+        self.total_used = 0
+        self.balances = BalanceTop(self.k)
+
+    # --- события ---
+    def _add_report(self, row: list):
+        rec = dict(zip(REPORTS_HEADER, row))
+        self.total += 1
+        self.by_type[str(rec.get("type", ""))] += 1
+        self.by_city.add(str(rec.get("city", "")))
+        self.by_user.add(str(rec.get("username") or rec.get("uid", "")))
+        if str(rec.get("dst_applied", "0")) == "1":
+            self.dst_count += 1
+
+    def _add_payment(self, row: list):
+        if len(row) >= 5 and row[4] == "success":
+            try:
+                self.revenue += int(row[2])
+            except ValueError:
+                pass
+
+    def on_reports(self, rows: List[list], offset: int):
+        with self._lock:
+            for row in rows:
+                self._add_report(row)
+            self.reports_offset = offset
+            self.dirty = True
+
+    def on_payment(self, row: list, offset: int):
+        with self._lock:
+            self._add_payment(row)
+            self.payments_offset = offset
+            self.dirty = True
+
+    # --- балансы (из LedgerCache) ---
+    def ledger_reloaded(self, records: List[Dict[str, str]]):
+        with self._lock:
+            self._reset_ledger()
+            for rec in records:
+                self._apply_ledger(None, rec)
+
+    def ledger_changed(self, old: Optional[Dict[str, str]], new: Dict[str, str]):
+        with self._lock:
+            self._apply_ledger(old, new)
+
+    def _apply_ledger(self, old: Optional[Dict[str, str]], new: Dict[str, str]):
+        if old is None:
+            self.users += 1
+        else:
+            self.total_balance -= int(old["balance"])
+            self.total_used -= int(old["used"])
+        self.total_balance += int(new["balance"])
+        self.total_used += int(new["used"])
+        self.balances.update(int(new["uid"]), int(new["balance"]))
+
+    # --- снимок ---
+    @staticmethod
+    def _tail(path: Path, offset: int) -> Tuple[List[list], int]:
+        """Строки CSV после offset (с начала файла — без заголовка) и новый offset"""
+        if not path.exists():
+            return [], 0
+        with path.open("r", newline="", encoding="utf-8") as f:
+            f.seek(0, os.SEEK_END)
+            end = f.tell()
+            if offset > end:
+                offset = 0   # файл пересоздан — читаем заново
+            f.seek(offset)
+            rows = list(csv.reader(f.read().splitlines()))
+        if offset == 0:
+            rows = rows[1:]
+        return rows, end
+
+    def load(self) -> Tuple[int, int]:
+        """Поднять снимок и дочитать хвосты журналов; возвращает число дочитанных строк"""
+        snap = {}
+        if self.path.exists():
+            try:
+                snap = json.loads(self.path.read_text(encoding="utf-8"))
+            except Exception as e:
+                print(f"❌ Stats snapshot read error {self.path}: {e}")
+        with self._lock:
+            self._reset_events()
+            if snap:
+                self.total = snap["total"]
+                self.by_type = Counter(snap["by_type"])
+                self.by_city = TopCounter(self.k, snap["by_city"], snap.get("by_city_floor", 0))
+                self.by_user = TopCounter(self.k, snap["by_user"], snap.get("by_user_floor", 0))
+                self.dst_count = snap["dst_count"]
+                self.revenue = snap["revenue"]
+                self.reports_offset = snap["reports_offset"]
+                self.payments_offset = snap["payments_offset"]
+
+            report_rows, self.reports_offset = self._tail(REPORTS_CSV, self.reports_offset)
+            if self.reports_offset < snap.get("reports_offset", 0):
+                self._reset_events()   # журнал пересоздан — снимок больше не соответствует
+                report_rows, self.reports_offset = self._tail(REPORTS_CSV, 0)
+            for row in report_rows:
+                self._add_report(row)
+            payment_rows, self.payments_offset = self._tail(PAYMENT_LOGS_CSV, self.payments_offset)
+            for row in payment_rows:
+                self._add_payment(row)
+            self.dirty = bool(report_rows or payment_rows or not snap)
+        return len(report_rows), len(payment_rows)
+
+    def save(self):
+        with self._lock:
+            if not self.dirty:
+                return
+            by_city, city_floor = self.by_city.snapshot(STATS_SNAPSHOT_TOP)
+            by_user, user_floor = self.by_user.snapshot(STATS_SNAPSHOT_TOP)
+            snap = {
+                "total": self.total,
+                "by_type": dict(self.by_type),
+                "by_city": by_city,
+                "by_city_floor": city_floor,
+                "by_user": by_user,
+                "by_user_floor": user_floor,
+                "dst_count": self.dst_count,
+                "revenue": self.revenue,
+                "reports_offset": self.reports_offset,
+                "payments_offset": self.payments_offset,
+            }
+            self.dirty = False
+        tmp = self.path.with_suffix(".tmp")
+        try:
+            tmp.write_text(json.dumps(snap, ensure_ascii=False), encoding="utf-8")
+            tmp.replace(self.path)
+        except Exception as e:
+            print(f"❌ Stats snapshot write error {self.path}: {e}")
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(STATS_SNAPSHOT_INTERVAL)
+            await asyncio.to_thread(self.save)
+
+    async def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self.save()
+
+STATS = BotStats(STATS_JSON)
+
+REPORTS = ReportLog(REPORTS_CSV, REPORTS_HEADER, on_write=STATS.on_reports)
+
+# ---------- 🗄 Хранилище балансов (SQLite) ----------
+class BalanceStore:
+    """
+    Балансы пользователей в локальной SQLite (WAL).
+    uid — первичный ключ, начисления и списания — атомарные UPDATE без read-modify-write.
+    """
+
+    def __init__(self, path: Path, legacy_csv: Optional[Path] = None):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(path), check_same_thread=False, isolation_level=None)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS users ("
+            " uid INTEGER PRIMARY KEY,"
+            " balance INTEGER NOT NULL DEFAULT 0,"
+            " used INTEGER NOT NULL DEFAULT 0,"
+            " last_updated TEXT NOT NULL)"
+        )
+        self._conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        if legacy_csv is not None:
+            self.migrate_from_csv(legacy_csv)
+
+    @staticmethod
+    def _now() -> str:
+        return dt.datetime.now(dt.timezone.utc).isoformat()
+
+    @staticmethod
+    def _record(row: sqlite3.Row) -> Dict[str, str]:
+        # Тот же формат, что раньше отдавал payments.csv
+        return {"uid": str(row["uid"]), "balance": str(row["balance"]),
+                "used": str(row["used"]), "last_updated": row["last_updated"]}
+
+    def migrate_from_csv(self, csv_path: Path) -> int:
+        """Однократный перенос payments.csv в базу (повторный запуск ничего не делает)"""
+        with self._lock:
+            if self._conn.execute("SELECT 1 FROM meta WHERE key = 'csv_migrated'").fetchone():
+                return 0
+            rows = read_csv_dict(csv_path)
+            migrated = 0
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                for row in rows:
+                    try:
+                        uid = int(row["uid"])
+                        balance = int(row.get("balance") or 0)
+                        used = int(row.get("used") or 0)
+                    except (KeyError, TypeError, ValueError):
+                        continue
+                    self._conn.execute(
+                        "INSERT OR REPLACE INTO users (uid, balance, used, last_updated) VALUES (?, ?, ?, ?)",
+                        (uid, balance, used, row.get("last_updated") or self._now())
+                    )
+                    migrated += 1
+                self._conn.execute(
+                    "INSERT INTO meta (key, value) VALUES ('csv_migrated', ?)",
+                    (f"{self._now()} rows={migrated}",)
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        if migrated:
+            print(f"🗄 Перенесено из {csv_path.name}: {migrated} пользователей")
+        return migrated
+
+    def get(self, uid: int) -> Optional[Dict[str, str]]:
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM users WHERE uid = ?", (uid,)).fetchone()
+        return self._record(row) if row else None
+
+    def all_records(self) -> List[Dict[str, str]]:
+        with self._lock:
+            rows = self._conn.execute("SELECT * FROM users ORDER BY uid").fetchall()
+        return [self._record(r) for r in rows]
+
+    def set(self, uid: int, balance: Optional[int] = None, used: Optional[int] = None) -> Dict[str, str]:
+        """Upsert абсолютных значений (None — поле не трогаем)"""
+        with self._lock:
+            row = self._conn.execute(
+                "INSERT INTO users (uid, balance, used, last_updated) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(uid) DO UPDATE SET "
+                " balance = COALESCE(?, balance), used = COALESCE(?, used), last_updated = excluded.last_updated "
+                "RETURNING *",
+                (uid, balance or 0, used or 0, self._now(), balance, used)
+            ).fetchone()
+        return self._record(row)
+
+    def credit(self, uid: int, balance: int = 0, used: int = 0) -> Dict[str, str]:
+        """Атомарно прибавляет к балансу и/или счётчику использований"""
+        with self._lock:
+            row = self._conn.execute(
+                "INSERT INTO users (uid, balance, used, last_updated) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(uid) DO UPDATE SET "
+                " balance = balance + excluded.balance, used = used + excluded.used,"
+                " last_updated = excluded.last_updated "
+                "RETURNING *",
+                (uid, balance, used, self._now())
+            ).fetchone()
+        return self._record(row)
+
+    def debit(self, uid: int, amount: int = 1) -> Optional[Dict[str, str]]:
+        """Атомарно списывает разборы; None — если баланса не хватает"""
+        with self._lock:
+            row = self._conn.execute(
+                "UPDATE users SET balance = balance - ?, last_updated = ? "
+                "WHERE uid = ? AND balance >= ? RETURNING *",
+                (amount, self._now(), uid, amount)
+            ).fetchone()
+        return self._record(row) if row else None
+
+    def claim_free(self, uid: int) -> Optional[Dict[str, str]]:
+        """Атомарно отмечает бесплатный разбор использованным; None — он уже был использован"""
+        with self._lock:
+            row = self._conn.execute(
+                "INSERT INTO users (uid, balance, used, last_updated) VALUES (?, 0, 1, ?) "
+                "ON CONFLICT(uid) DO UPDATE SET used = used + 1, last_updated = excluded.last_updated "
+                "WHERE used = 0 RETURNING *",
+                (uid, self._now())
+            ).fetchone()
+        return self._record(row) if row else None
+
+    def release_free(self, uid: int) -> Optional[Dict[str, str]]:
+        """Откат claim_free, если после него ничего не использовано; None — откатывать нечего"""
+        with self._lock:
+            row = self._conn.execute(
+                "UPDATE users SET used = 0, last_updated = ? WHERE uid = ? AND used = 1 RETURNING *",
+                (self._now(), uid)
+            ).fetchone()
+        return self._record(row) if row else None
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+_payments_store: Optional[BalanceStore] = None
+_payments_store_lock = threading.Lock()
+
+def payments_store() -> BalanceStore:
+    """Хранилище открывается при первом обращении (и тогда же мигрирует CSV)"""
+    global _payments_store
+    if _payments_store is None:
+        with _payments_store_lock:
+            if _payments_store is None:
+                _payments_store = BalanceStore(PAYMENTS_DB, legacy_csv=PAYMENTS_CSV)
+    return _payments_store
+
+# ---------- ⚡ Кэш балансов в памяти ----------
+class LedgerCache:
+    """
+    Словарь uid → запись поверх BalanceStore: читается один раз, каждая запись
+    сначала уходит в базу, затем обновляет словарь (write-through). Запись в базу и
+    в словарь — под одним замком: порядок в кэше всегда совпадает с порядком коммитов.
+    """
+
+    def __init__(self, store: BalanceStore, listener=None):
+        self.store = store
+        self.listener = listener   # ledger_reloaded(records) / ledger_changed(old, new)
+        self._lock = threading.Lock()
+        self._records: Dict[int, Optional[Dict[str, str]]] = {}
+        self.hits = 0
+        self.misses = 0
+        self.reload()
+
+    def reload(self) -> int:
+        """Принудительно перечитать все записи с диска"""
+        with self._lock:
+            records = {int(r["uid"]): r for r in self.store.all_records()}
+            self._records = records
+        if self.listener is not None:
+            self.listener.ledger_reloaded(list(records.values()))
+        return len(records)
+
+    def get(self, uid: int) -> Optional[Dict[str, str]]:
+        with self._lock:
+            if uid in self._records:
+                self.hits += 1
+                return self._records[uid]
+            self.misses += 1
+        record = self.store.get(uid)
+        with self._lock:
+            # None тоже кэшируем: все записи идут через этот кэш
+            self._records.setdefault(uid, record)
+        return record
+
+    def all_records(self) -> List[Dict[str, str]]:
+        with self._lock:
+            return [r for r in self._records.values() if r is not None]
+
+    def _apply(self, uid: int, write) -> Optional[Dict[str, str]]:
+        """write() — изменение в BalanceStore; None — ничего не изменилось"""
+        with self._lock:
+            record = write()
+            if record is None:
+                return None
+            old = self._records.get(uid)
+            self._records[uid] = record
+        if self.listener is not None:
+            self.listener.ledger_changed(old, record)
+        return record
+
+    def set(self, uid: int, balance: Optional[int] = None, used: Optional[int] = None) -> Dict[str, str]:
+        return self._apply(uid, lambda: self.store.set(uid, balance=balance, used=used))
+
+    def credit(self, uid: int, balance: int = 0, used: int = 0) -> Dict[str, str]:
+        return self._apply(uid, lambda: self.store.credit(uid, balance=balance, used=used))
+
+    def debit(self, uid: int, amount: int = 1) -> Optional[Dict[str, str]]:
+        return self._apply(uid, lambda: self.store.debit(uid, amount))
+
+    def claim_free(self, uid: int) -> Optional[Dict[str, str]]:
+        return self._apply(uid, lambda: self.store.claim_free(uid))
+
+    def release_free(self, uid: int) -> Optional[Dict[str, str]]:
+        return self._apply(uid, lambda: self.store.release_free(uid))
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            cached = sum(1 for r in self._records.values() if r is not None)
+        return {"hits": self.hits, "misses": self.misses, "cached": cached}
+
+_payments_ledger: Optional[LedgerCache] = None
+
+def payments_ledger() -> LedgerCache:
+    global _payments_ledger
+    if _payments_ledger is None:
+        store = payments_store()
+        with _payments_store_lock:
+            if _payments_ledger is None:
+                _payments_ledger = LedgerCache(store, listener=STATS)
+    return _payments_ledger
+
 # ---------- 💳 Payment Manager ----------
 class PaymentManager:
     """Оптимизированное управление платежами и балансом"""
     
     @staticmethod
     def get_user_record(uid: int) -> Optional[Dict[str, str]]:
-        rows = read_csv_dict(PAYMENTS_CSV)
-        for row in rows:
-            if int(row["uid"]) == uid:
-                return row
-        return None
+        return payments_ledger().get(uid)
+    
+    @staticmethod
+    def all_records() -> List[Dict[str, str]]:
+        return payments_ledger().all_records()
+    
+    @staticmethod
+    def reload() -> int:
+        """Сбросить кэш и перечитать балансы с диска"""
+        return payments_ledger().reload()
+    
+    @staticmethod
+    def cache_stats() -> Dict[str, int]:
+        return payments_ledger().stats()
     
     @staticmethod
     def get_balance(uid: int) -> int:
@@ -205,44 +1544,43 @@ class PaymentManager:
     def update_user(uid: int, balance: int = None, used: int = None):
         if uid in ADMIN_IDS:
             return
-        
-        rows = read_csv_dict(PAYMENTS_CSV)
-        header = ["uid", "balance", "used", "last_updated"]
-        user_found = False
-        
-        for row in rows:
-            if int(row["uid"]) == uid:
-                if balance is not None:
-                    row["balance"] = str(balance)
-                if used is not None:
-                    row["used"] = str(used)
-                row["last_updated"] = dt.datetime.now(dt.timezone.utc).isoformat()
-                user_found = True
-                break
-        
-        if not user_found:
-            rows.append({
-                "uid": str(uid),
-                "balance": str(balance or 0),
-                "used": str(used or 0),
-                "last_updated": dt.datetime.now(dt.timezone.utc).isoformat()
-            })
-        
-        write_csv_dict(PAYMENTS_CSV, rows, header)
+        payments_ledger().set(uid, balance=balance, used=used)
     
     @staticmethod
     def add_balance(uid: int, amount: int):
         if uid in ADMIN_IDS:
             return
-        current = PaymentManager.get_balance(uid)
-        PaymentManager.update_user(uid, balance=current + amount)
+        payments_ledger().credit(uid, balance=amount)
     
     @staticmethod
     def increment_used(uid: int):
         if uid in ADMIN_IDS:
             return
-        current_used = PaymentManager.get_used(uid)
-        PaymentManager.update_user(uid, used=current_used + 1)
+        payments_ledger().credit(uid, used=1)
+    
+    @staticmethod
+    def claim_free(uid: int) -> bool:
+        """
+        Атомарно забирает бесплатный разбор: True — только первому из одновременных
+        нажатий. Админам бесплатный не нужен (у них безлимит) — всегда False.
+        """
+        if uid in ADMIN_IDS:
+            return False
+        return payments_ledger().claim_free(uid) is not None
+    
+    @staticmethod
+    def release_free(uid: int):
+        """Вернуть бесплатный разбор, если его выдача сорвалась"""
+        if uid in ADMIN_IDS:
+            return
+        payments_ledger().release_free(uid)
+    
+    @staticmethod
+    def debit(uid: int, amount: int = 1) -> bool:
+        """Атомарное списание: False, если баланса не хватило"""
+        if uid in ADMIN_IDS:
+            return True
+        return payments_ledger().debit(uid, amount) is not None
     
     @staticmethod
     def get_next_price(uid: int) -> int:
@@ -260,122 +1598,876 @@ class PaymentManager:
     
     @staticmethod
     def log_payment(uid: int, amount: int, payload: str, status: str):
-        log_file = BASE_DIR / "payment_logs.csv"
-        ensure_csv(log_file, ["timestamp", "uid", "amount", "payload", "status"])
-        with log_file.open("a", newline="", encoding="utf-8") as f:
-            csv.writer(f).writerow([
-                dt.datetime.now(dt.timezone.utc).isoformat(),
-                uid,
-                amount,
-                payload,
-                status
-            ])
+        ensure_csv(PAYMENT_LOGS_CSV, ["timestamp", "uid", "amount", "payload", "status"])
+        row = [dt.datetime.now(dt.timezone.utc).isoformat(), uid, amount, payload, status]
+        with PAYMENT_LOGS_CSV.open("a", newline="", encoding="utf-8") as f:
+            csv.writer(f).writerow(row)
+            offset = f.tell()
+        STATS.on_payment([str(v) for v in row], offset)
+
+# ---------- 🌍 Города ----------
+CityRow = Tuple[str, float, float, str]   # (имя, lat, lon, iso)
+
+TOWNS_HEADER = ["city", "population", "lat", "lon", "region_name", "region_name_ao", "region_iso_code",
+                "federal_district", "okato", "oktmo", "kladr_id", "fias_id", "place_id"]
+
+class CityCatalog:
+    """
+    Справочник городов в колоночном виде: координаты и население — array('d'),
+    строки интернированы. Индекс города — позиция во всех колонках.
+    """
+
+    def __init__(self):
+        self.names: List[str] = []
+        self.lat = array('d')
+        self.lon = array('d')
+        self.population = array('d')   # тыс. человек
+        self.iso: List[str] = []
+        self.region: List[str] = []
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def add(self, name: str, lat: float, lon: float, iso: str, region: str = "", population: float = 0.0) -> int:
+        self.names.append(sys.intern(name))
+        self.lat.append(lat)
+        self.lon.append(lon)
+        self.population.append(population)
+        self.iso.append(sys.intern(iso))
+        self.region.append(sys.intern(region))
+        return len(self.names) - 1
+
+    def row(self, idx: int) -> CityRow:
+        return self.names[idx], self.lat[idx], self.lon[idx], self.iso[idx]
+
+    def label(self, idx: int) -> str:
+        """«Киров (Калужская область, RU)» — различает города с одинаковым именем"""
+        where = ", ".join(filter(None, (self.region[idx], self.iso[idx])))
+        return f"{self.names[idx]} ({where})" if where else self.names[idx]
+
+    def coordinates(self) -> List[Tuple[float, float]]:
+        return list(zip(self.lat, self.lon))
+
+    def by_population(self) -> List[int]:
+        return sorted(range(len(self)), key=lambda i: self.population[i], reverse=True)
+
+    def top(self, n: int) -> List[str]:
+        """n самых крупных городов (без повторов имён)"""
+        names: List[str] = []
+        for idx in self.by_population():
+            if self.names[idx] not in names:
+                names.append(self.names[idx])
+            if len(names) == n:
+                break
+        return names
+
+def _parse_town_row(header: List[str], row: List[str]) -> Optional[Tuple[str, float, float, str, str, float]]:
+    """Строка towns.csv → (имя, lat, lon, iso, регион, население)"""
+    if len(row) == 4:
+        # Старый формат save_city: city,lat,lon,iso
+        name, lat, lon, iso = row
+        return name.strip(), float(lat), float(lon), iso.strip().upper(), "", 0.0
+    rec = dict(zip(header, row))
+    region_iso = (rec.get("region_iso_code") or rec.get("country_iso") or "").strip().upper()
+    try:
+        population = float(rec.get("population") or 0)
+    except ValueError:
+        population = 0.0
+    return (rec["city"].strip(), float(rec["lat"]), float(rec["lon"]),
+            region_iso.split("-")[0], (rec.get("region_name") or "").strip(), population)
+
+def load_cities() -> CityCatalog:
+    catalog = CityCatalog()
+    if not TOWNS_CSV.exists():
+        return catalog
+    try:
+        with TOWNS_CSV.open(encoding="utf-8", newline="") as f:
+            reader = csv.reader(f)
+            header = next(reader, [])
+            for row in reader:
+                try:
+                    parsed = _parse_town_row(header, row)
+                except Exception:
+                    continue
+                if parsed and parsed[0]:
+                    catalog.add(*parsed)
+    except Exception as e:
+        print(f"❌ CSV read error {TOWNS_CSV}: {e}")
+    return catalog
+
+def save_city(name: str, lat: float, lon: float, iso: str):
+    """Дописывает город в towns.csv в его основной схеме"""
+    ensure_csv(TOWNS_CSV, TOWNS_HEADER)
+    with TOWNS_CSV.open("a", encoding="utf-8", newline="") as f:
+        csv.DictWriter(f, fieldnames=TOWNS_HEADER, restval="").writerow(
+            {"city": name, "lat": lat, "lon": lon, "region_iso_code": iso}
+        )
+
+CITY_CATALOG = load_cities()
+
+# ---------- 🔎 Поиск городов ----------
+CITY_SUGGEST_LIMIT = 6
+
+_CITY_PREFIX_RE = re.compile(r"^(?:город|гор|пгт|пос[её]лок|пос|село|деревня|дер|г|п|с|д)(?:\.\s*|\s+)")
+_CITY_PUNCT_RE = re.compile(r"[^\w\s]+|_")
+_CITY_SPACE_RE = re.compile(r"\s+")
+
+def normalize_city(name: str) -> str:
+    """«г. Орёл», «орел», «ОРЁЛ, Россия» → «орел»; дефисы → пробелы"""
+    s = name.split(",")[0].strip().lower().replace("ё", "е")
+    s = _CITY_PREFIX_RE.sub("", s)
+    s = _CITY_PUNCT_RE.sub(" ", s)
+    return _CITY_SPACE_RE.sub(" ", s).strip()
+
+def _trigrams(norm: str) -> set:
+    padded = f"  {norm} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+def edit_distance(a: str, b: str, limit: int) -> int:
+    """Расстояние Левенштейна с ранним выходом, если оно заведомо больше limit"""
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    prev = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        cur = [i] + [0] * len(b)
+        for j, cb in enumerate(b, 1):
+            cur[j] = min(prev[j] + 1, cur[j - 1] + 1, prev[j - 1] + (ca != cb))
+        if min(cur) > limit:
+            return limit + 1
+        prev = cur
+    return prev[-1]
+
+class CityIndex:
+    """
+    Индекс городов в памяти: точное совпадение по нормализованному имени,
+    префиксный поиск по отсортированному массиву и нечёткий — по триграммам
+    с проверкой расстоянием Левенштейна.
+    """
+
+    def __init__(self, catalog: CityCatalog):
+        self.catalog = catalog
+        self._keys: Dict[int, List[str]] = {}     # индекс в каталоге → нормализованные имена и алиасы
+        self._exact: Dict[str, int] = {}
+        self._places: Dict[Tuple[str, str, str], int] = {}   # (имя, регион, ISO) → первый такой город
+        self._by_label: Dict[str, int] = {}
+        self._sorted: List[Tuple[str, int]] = []
+        self._grams: Dict[str, set] = {}
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def add(self, idx: int, aliases=()) -> int:
+        """
+        Индексирует город каталога под его именем, подписью варианта и алиасами.
+        Повтор уже известного города (то же имя, регион и ISO — например, строки
+        save_city) не индексируется: его алиасы достаются первому, его индекс и возвращается.
+        """
+        place = (normalize_city(self.catalog.names[idx]), self.catalog.region[idx], self.catalog.iso[idx])
+        first = self._places.setdefault(place, idx)
+        if first != idx:
+            return self.add(first, aliases)
+        label = self.catalog.label(idx)
+        self._by_label.setdefault(label, idx)
+        keys = self._keys.setdefault(idx, [])
+        for alias in (self.catalog.names[idx], label, *aliases):
+            norm = normalize_city(alias)
+            if not norm or norm in keys:
+                continue
+            keys.append(norm)
+            self._exact.setdefault(norm, idx)
+            self._sorted.insert(bisect_right(self._sorted, (norm, idx)), (norm, idx))
+            for gram in _trigrams(norm):
+                self._grams.setdefault(gram, set()).add(idx)
+        return idx
+
+    def _labels(self, idxs, by_population: bool = False) -> List[str]:
+        """Подписи вариантов без повторов: подпись в ответе пользователя находит ровно один город"""
+        idxs = list(idxs)
+        if by_population:
+            idxs.sort(key=lambda i: self.catalog.population[i], reverse=True)
+        labels = dict.fromkeys(self.catalog.label(idx) for idx in idxs)
+        return list(labels)[:CITY_SUGGEST_LIMIT]
+
+    def _by_prefix(self, norm: str, whole: bool = False) -> List[int]:
+        start = bisect_right(self._sorted, (norm, -1))
+        found: List[int] = []
+        for key, idx in self._sorted[start:]:
+            if key != norm if whole else not key.startswith(norm):
+                break
+            if idx not in found:
+                found.append(idx)
+            if len(found) > CITY_SUGGEST_LIMIT:
+                break
+        return found
+
+    def _fuzzy(self, norm: str) -> List[Tuple[int, int]]:
+        shared = Counter()
+        for gram in _trigrams(norm):
+            shared.update(self._grams.get(gram, ()))
+        limit = 1 if len(norm) <= 4 else 2 if len(norm) <= 8 else 3
+        scored = []
+        for idx, _ in shared.most_common(30):
+            dist = min((edit_distance(norm, key, limit) for key in self._keys[idx]), default=limit + 1)
+            if dist <= limit:
+                scored.append((dist, idx))
+        scored.sort(key=lambda x: x[0])
+        return scored
+
+    def lookup(self, text: str) -> Tuple[Optional[CityRow], List[str]]:
+        """
+        (город, []) — однозначное совпадение; (None, [варианты]) — нужно уточнить;
+        (None, []) — в базе ничего похожего нет.
+        """
+        if text.strip() in self._by_label:
+            return self.catalog.row(self._by_label[text.strip()]), []
+        norm = normalize_city(text)
+        if not norm:
+            return None, []
+        if norm in self._exact:
+            same = self._by_prefix(norm, whole=True)
+            if len(same) > 1:
+                # Одноимённые города в разных регионах — пусть выберет сам
+                return None, self._labels(same, by_population=True)
+            return self.catalog.row(self._exact[norm]), []
+
+        if len(norm) >= 3:
+            prefixed = self._by_prefix(norm)
+            if prefixed:
+                # Даже единственный город по началу имени — только после подтверждения
+                return None, self._labels(prefixed, by_population=True)
+
+        scored = self._fuzzy(norm)
+        if not scored:
+            return None, []
+        best = scored[0][0]
+        if best <= 1 and sum(1 for d, _ in scored if d == best) == 1:
+            return self.catalog.row(scored[0][1]), []
+        return None, self._labels(idx for _, idx in scored)
+
+def build_city_index(catalog: CityCatalog) -> CityIndex:
+    # Крупные города первыми: среди одноимённых они первыми и в вариантах
+    index = CityIndex(catalog)
+    for idx in catalog.by_population():
+        index.add(idx)
+    return index
+
+CITY_INDEX = build_city_index(CITY_CATALOG)
+
+async def find_city(text: str) -> Tuple[Optional[CityRow], List[str]]:
+    """Город по вводу пользователя: индекс → варианты на выбор → Groq в последнюю очередь"""
+    city, suggestions = CITY_INDEX.lookup(text)
+    if city or suggestions:
+        return city, suggestions
+    ai = await groq_city(text)
+    if not ai:
+        return None, []
+    name, lat, lon, iso = ai
+    CITY_INDEX.add(CITY_CATALOG.add(name, lat, lon, iso), aliases=(text,))
+    save_city(name, lat, lon, iso)
+    return ai, []
+
+async def groq_city(city_input: str) -> Optional[Tuple[str, float, float, str]]:
+    prompt = (
+        f"Определи город по названию '{city_input}'. "
+        "Ответь строго: Город латиницей;широта;долгота;ISO\n"
+        "Пример: Moscow;55.7558;37.6173;RU\nЕсли не уверен, напиши NONE"
+    )
+    raw = await ask_groq(prompt, route=ROUTE_FAST)
+    if not raw or raw.upper() == "NONE":
+        return None
+    try:
+        name, lat_str, lon_str, iso = [p.strip() for p in raw.split(";")]
+        return name, float(lat_str.replace(",", ".")), float(lon_str.replace(",", ".")), iso.upper()
+    except Exception:
+        return None
+
+async def groq_tz(city: str, iso: Optional[str]) -> Optional[float]:
+    country = f" (страна ISO {iso})" if iso else ""
+    prompt = (
+        f"Часовой пояс города '{city}'{country} относительно UTC. "
+        "Ответь только числом, например: 3, -5, 5.5"
+    )
+    try:
+        return float(await ask_groq(prompt, route=ROUTE_FAST))
+    except Exception:
+        return None
+
+# ---------- 💾 Кэш базовых часовых поясов ----------
+TZ_ANSWERS_TTL = 90 * 24 * 3600   # секунд
+TZ_ANSWERS_MAX = 5000             # записей в файле
+TZ_ANSWERS_FLUSH_DELAY = 2.0      # секунд копим новые ответы перед записью файла
+
+class TzAnswerCache:
+    """
+    Базовые UTC-смещения городов на диске (JSON), ключ — город + страна.
+    Записи старше TTL игнорируются, при переполнении вытесняются самые старые.
+    Файл переписывается пачкой в фоновом потоке, не на каждый ответ.
+    """
+
+    def __init__(self, path: Path, ttl: float = TZ_ANSWERS_TTL, max_size: int = TZ_ANSWERS_MAX,
+                 flush_delay: float = TZ_ANSWERS_FLUSH_DELAY):
+        self.path = path
+        self.ttl = ttl
+        self.max_size = max_size
+        self.flush_delay = flush_delay
+        self._lock = threading.Lock()
+        self._entries: Dict[str, Dict] = {}
+        self._flush_task: Optional[asyncio.Task] = None
+        self.dirty = False
+        self.load()
+
+    @staticmethod
+    def _key(city: str, iso: Optional[str]) -> str:
+        return f"{city.strip().lower()}|{(iso or '').strip().upper()}"
+
+    def load(self) -> int:
+        entries: Dict[str, Dict] = {}
+        if self.path.exists():
+            try:
+                entries = json.loads(self.path.read_text(encoding="utf-8"))
+            except Exception as e:
+                print(f"❌ TZ cache read error {self.path}: {e}")
+        now = time.time()
+        with self._lock:
+            self._entries = {k: v for k, v in entries.items() if now - v.get("ts", 0) < self.ttl}
+        return len(self._entries)
+
+    def save(self):
+        with self._lock:
+            if not self.dirty:
+                return
+            data = json.dumps(self._entries, ensure_ascii=False)
+            self.dirty = False
+        tmp = self.path.with_suffix(".tmp")
+        try:
+            tmp.write_text(data, encoding="utf-8")
+            tmp.replace(self.path)
+        except Exception as e:
+            print(f"❌ TZ cache write error {self.path}: {e}")
+            with self._lock:
+                self.dirty = True
+
+    async def _flush_later(self):
+        # Ответы, пришедшие во время записи, попадут в следующий круг
+        while self.dirty:
+            await asyncio.sleep(self.flush_delay)
+            await asyncio.to_thread(self.save)
+
+    async def stop(self):
+        if self._flush_task is not None and not self._flush_task.done():
+            self._flush_task.cancel()
+            await asyncio.gather(self._flush_task, return_exceptions=True)
+        await asyncio.to_thread(self.save)
+
+    def get(self, city: str, iso: Optional[str]) -> Optional[float]:
+        with self._lock:
+            entry = self._entries.get(self._key(city, iso))
+        if entry is None or time.time() - entry["ts"] >= self.ttl:
+            return None
+        return entry["tz"]
+
+    def put(self, city: str, iso: Optional[str], tz: float, source: str):
+        with self._lock:
+            self._entries[self._key(city, iso)] = {"tz": tz, "src": source, "ts": time.time()}
+            while len(self._entries) > self.max_size:
+                del self._entries[min(self._entries, key=lambda k: self._entries[k]["ts"])]
+            self.dirty = True
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.get_running_loop().create_task(self._flush_later())
+
+TZ_ANSWERS = TzAnswerCache(TZ_ANSWERS_JSON)
+
+def local_base_tz(lat: float, lon: float, iso: Optional[str]) -> Optional[float]:
+    """Стандартное (зимнее) смещение зоны на сегодня — без LLM"""
+    zone = TZ_RESOLVER.zone_at(lat, lon) or COUNTRY_DEFAULT_TZ.get((iso or "").upper())
+    if not zone:
+        return None
+    # Текущий момент в самой зоне, а не местное время сервера: у границы DST это разные часы
+    now = dt.datetime.now(pytz.utc).astimezone(pytz.timezone(zone))
+    return (now.utcoffset() - now.dst()).total_seconds() / 3600.0
+
+async def base_tz_for(city: str, iso: Optional[str], lat: float, lon: float) -> Optional[float]:
+    """Базовый часовой пояс: кэш → локальный резолвер → Groq (в последнюю очередь)"""
+    cached = TZ_ANSWERS.get(city, iso)
+    if cached is not None:
+        return cached
+    try:
+        tz = await CHART_SERVICE.run(local_base_tz, lat, lon, iso)
+    except ChartServiceBusy:
+        tz = local_base_tz(lat, lon, iso)
+    source = "local"
+    if tz is None:
+        tz, source = await groq_tz(city, iso), "llm"
+    if tz is not None:
+        TZ_ANSWERS.put(city, iso, tz, source)
+    return tz
+
+# ---------- 🌙 Астро ----------
+ZODIAC_SIGNS = ["♈ Овен", "♉ Телец", "♊ Близнецы", "♋ Рак", "♌ Лев", "♍ Дева",
+                "♎ Весы", "♏ Скорпион", "♐ Стрелец", "♑ Козерог", "♒ Водолей", "♓ Рыбы"]
+
+def deg_to_sign(deg: float) -> Tuple[str, int]:
+    d = deg % 360
+    sign_idx = int(d // 30)
+    d_sign = d % 30
+    return f"{int(d_sign)}°{int((d_sign % 1)*60):02d}' {ZODIAC_SIGNS[sign_idx]}", sign_idx
+
+class HouseLocator:
+    """
+    Куспиды одной карты, развёрнутые от куспида 1 в монотонный массив [0, 360).
+    Точка попадает в дом, чей куспид она уже прошла: бисекция по 12 границам.
+    """
+    __slots__ = ("start", "offsets")
+
+    def __init__(self, cusps):
+        self.start = cusps[0] % 360
+        self.offsets = [(c - self.start) % 360 for c in cusps[:12]]
+
+    def house(self, lon: float) -> int:
+        return bisect_right(self.offsets, (lon - self.start) % 360)
+
+    def houses(self, lons) -> List[int]:
+        return [self.house(lon) for lon in lons]
+
+def house_for_lon(lon: float, cusps) -> int:
+    """Дом (1–12) для эклиптической долготы; cusps — 12 куспидов из swe.houses"""
+    return HouseLocator(cusps).house(lon)
+
+HOUSE_SYSTEM = b"P"            # Плацидус
+HOUSE_SYSTEM_FALLBACK = b"O"   # Порфирий — за полярным кругом Плацидус не определён
+
+def house_cusps(jd: float, lat: float, lon: float, hsys: bytes = HOUSE_SYSTEM):
+    """Куспиды 12 домов; если система не считается на этой широте — Порфирий"""
+    try:
+        return swe.houses(jd, lat, lon, hsys)[0]
+    except swe.Error:
+        return swe.houses(jd, lat, lon, HOUSE_SYSTEM_FALLBACK)[0]
+
+# ---------- 🪐 Кэш эфемерид ----------
+EPHE_BODY_CACHE_SIZE = 20000    # (jd, тело) → долгота
+EPHE_HOUSE_CACHE_SIZE = 5000    # (jd, lat, lon, система) → куспиды
+
+class LRUCache:
+    """Потокобезопасный LRU с подсчётом попаданий"""
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._data: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get_or_compute(self, key, compute):
+        with self._lock:
+            if key in self._data:
+                self.hits += 1
+                self._data.move_to_end(key)
+                return self._data[key]
+            self.misses += 1
+        value = compute()
+        with self._lock:
+            self._data[key] = value
+            if len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+        return value
+
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def stats(self) -> Dict[str, float]:
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._data), "hit_rate": self.hit_rate()}
+
+BODY_CACHE = LRUCache(EPHE_BODY_CACHE_SIZE)
+HOUSE_CACHE = LRUCache(EPHE_HOUSE_CACHE_SIZE)
+
+# ---------- 📉 Таблица медленных точек (средние Лилит и Узел) ----------
+MEAN_POINTS_STEP_HOURS = 1
+
+class MeanPointTable:
+    """
+    Долготы средней Лилит (MEAN_APOG) и среднего Узла (MEAN_NODE) с постоянным шагом
+    по диапазону годов рождения. Файл .npy открывается через mmap, значение между
+    узлами сетки — линейная интерполяция. Строка 0 файла — (jd первой точки, шаг в сутках),
+    дальше — развёрнутые (без скачка 360→0) долготы.
+    """
+
+    BODIES = {swe.MEAN_APOG: 0, swe.MEAN_NODE: 1}
+
+    def __init__(self, path: Path, year_min: int = BIRTH_YEAR_MIN, year_max: int = BIRTH_YEAR_MAX,
+                 step_hours: float = MEAN_POINTS_STEP_HOURS):
+        self.path = path
+        self.year_min = year_min
+        self.year_max = year_max
+        self.step_hours = step_hours
+        self._data: Optional[np.ndarray] = None
+        self.jd0 = 0.0
+        self.step = 0.0
+        self.jd1 = 0.0
+
+    @property
+    def loaded(self) -> bool:
+        return self._data is not None
+
+    def build(self) -> int:
+        # Сутки запаса с обеих сторон: локальная дата рождения ± часовой пояс
+        jd0 = swe.julday(self.year_min, 1, 1, 0.0) - 1
+        jd1 = swe.julday(self.year_max + 1, 1, 1, 0.0) + 1
+        step = self.step_hours / 24.0
+        jds = jd0 + step * np.arange(int(np.ceil((jd1 - jd0) / step)) + 1)
+        table = np.empty((len(jds) + 1, 2))
+        table[0] = (jd0, step)
+        calc_ut = swe.calc_ut
+        for body, col in self.BODIES.items():
+            lons = np.fromiter((calc_ut(t, body)[0][0] for t in jds.tolist()), dtype=np.float64, count=len(jds))
+            table[1:, col] = np.unwrap(lons, period=360.0)
+        tmp = self.path.with_suffix(".tmp.npy")
+        np.save(tmp, table)
+        tmp.replace(self.path)
+        return len(jds)
+
+    def load(self, build_missing: bool = True) -> bool:
+        if not self.path.exists():
+            if not build_missing:
+                return False
+            self.build()
+        data = np.load(self.path, mmap_mode="r")
+        self.jd0, self.step = float(data[0, 0]), float(data[0, 1])
+        self._data = data[1:]
+        self.jd1 = self.jd0 + self.step * (len(self._data) - 1)
+        return True
 
-# ---------- 🌍 Города ----------
-CityData = Tuple[float, float, str]
+    def lon(self, jd: float, body: int) -> Optional[float]:
+        """Интерполированная долгота; None — тело не табличное или jd вне таблицы"""
+        col = self.BODIES.get(body)
+        if col is None or self._data is None or not self.jd0 <= jd < self.jd1:
+            return None
+        pos = (jd - self.jd0) / self.step
+        i = int(pos)
+        frac = pos - i
+        a = self._data[i, col]
+        return float(a + (self._data[i + 1, col] - a) * frac) % 360
 
-def load_cities() -> Dict[str, CityData]:
-    cities: Dict[str, CityData] = {}
-    rows = read_csv_dict(TOWNS_CSV)
-    for row in rows:
-        try:
-            cities[row["city"].strip().lower()] = (
-                float(row["lat"]),
-                float(row["lon"]),
-                row["country_iso"].strip().upper()
-            )
-        except Exception:
-            continue
-    return cities
+    def verify(self, samples: int = 5000, seed: int = 1) -> float:
+        """Максимальная ошибка относительно swe.calc_ut на случайных моментах, угл. секунды"""
+        rnd = np.random.default_rng(seed)
+        worst = 0.0
+        for jd in rnd.uniform(self.jd0, self.jd1, samples).tolist():
+            for body in self.BODIES:
+                diff = abs(self.lon(jd, body) - swe.calc_ut(jd, body)[0][0]) % 360
+                worst = max(worst, min(diff, 360 - diff) * 3600)
+        return worst
 
-def save_city(name: str, lat: float, lon: float, iso: str):
-    ensure_csv(TOWNS_CSV, ["city", "lat", "lon", "country_iso"])
-    with TOWNS_CSV.open("a", encoding="utf-8", newline="") as f:
-        csv.writer(f).writerow([name, lat, lon, iso])
+MEAN_POINTS = MeanPointTable(MEAN_POINTS_NPY)
 
-CITY_COORDS = load_cities()
+def body_lon(jd: float, body: int) -> float:
+    """Эклиптическая долгота тела на момент jd (таблица медленных точек или LRU)"""
+    lon = MEAN_POINTS.lon(jd, body)
+    if lon is not None:
+        return lon
+    return BODY_CACHE.get_or_compute((jd, body), lambda: swe.calc_ut(jd, body)[0][0])
 
-def groq_city(city_input: str) -> Optional[Tuple[str, float, float, str]]:
-    prompt = (
-        f"Определи город по названию '{city_input}'. "
-        "Ответь строго: Город латиницей;широта;долгота;ISO\n"
-        "Пример: Moscow;55.7558;37.6173;RU\nЕсли не уверен, напиши NONE"
-    )
-    raw = ask_groq(prompt)
-    if not raw or raw.upper() == "NONE":
-        return None
-    try:
-        name, lat_str, lon_str, iso = [p.strip() for p in raw.split(";")]
-        return name, float(lat_str.replace(",", ".")), float(lon_str.replace(",", ".")), iso.upper()
-    except Exception:
-        return None
+def cached_house_cusps(jd: float, lat: float, lon: float, hsys: bytes = HOUSE_SYSTEM):
+    return HOUSE_CACHE.get_or_compute((jd, lat, lon, hsys), lambda: house_cusps(jd, lat, lon, hsys))
 
-def groq_tz(city: str, iso: Optional[str]) -> Optional[float]:
-    country = f" (страна ISO {iso})" if iso else ""
-    prompt = (
-        f"Часовой пояс города '{city}'{country} относительно UTC. "
-        "Ответь только числом, например: 3, -5, 5.5"
-    )
-    try:
-        return float(ask_groq(prompt))
-    except Exception:
-        return None
+class ChartContext:
+    """
+    Карта одного запроса: каждое тело и куспиды считаются не больше одного раза,
+    повторы между запросами берутся из BODY_CACHE / HOUSE_CACHE.
+    """
+    __slots__ = ("jd", "lat", "lon", "_bodies", "_cusps", "_houses")
 
-# ---------- 🌙 Астро ----------
-def deg_to_sign(deg: float) -> Tuple[str, int]:
-    signs = ["♈ Овен", "♉ Телец", "♊ Близнецы", "♋ Рак", "♌ Лев", "♍ Дева",
-             "♎ Весы", "♏ Скорпион", "♐ Стрелец", "♑ Козерог", "♒ Водолей", "♓ Рыбы"]
-    d = deg % 360
-    sign_idx = int(d // 30)
-    d_sign = d % 30
-    return f"{int(d_sign)}°{int((d_sign % 1)*60):02d}' {signs[sign_idx]}", sign_idx
+    def __init__(self, jd: float, lat: float, lon: float):
+        self.jd = jd
+        self.lat = lat
+        self.lon = lon
+        self._bodies: Dict[int, float] = {}
+        self._cusps = None
+        self._houses: Optional[HouseLocator] = None
 
-def house_for_lon(lon: float, cusps) -> int:
-    lon = lon % 360
-    best_house, best_diff = 1, 360.0
-    for idx, cusp in enumerate(cusps[1:], 1):
-        diff = abs((lon - cusp) % 360)
-        if diff > 180:
-            diff = 360 - diff
-        if diff < best_diff:
-            best_diff, best_house = diff, idx
-    return best_house
+    @classmethod
+    def from_local(cls, date_str: str, time_str: str, tz_offset: float, lat: float, lon: float) -> "ChartContext":
+        d, m, y = map(int, date_str.split("."))
+        h, mn = map(int, time_str.split(":"))
+        # Преобразуем локальное время в UT с учётом DST
+        ut = calculate_utc_time(h + mn/60, tz_offset)
+        return cls(swe.julday(y, m, d, ut), lat, lon)
+
+    def lon_of(self, body: int) -> float:
+        if body not in self._bodies:
+            self._bodies[body] = body_lon(self.jd, body)
+        return self._bodies[body]
+
+    @property
+    def cusps(self):
+        if self._cusps is None:
+            self._cusps = cached_house_cusps(self.jd, self.lat, self.lon)
+        return self._cusps
+
+    def house_of(self, lon: float) -> int:
+        if self._houses is None:
+            self._houses = HouseLocator(self.cusps)
+        return self._houses.house(lon)
+
+    def phase(self) -> str:
+        return MOON_PHASES[phase_index(self.lon_of(swe.MOON) - self.lon_of(swe.SUN))]
 
 def calc_lilith_house(date_str: str, time_str: str, tz_offset: float, lat: float, lon: float):
     """
     Рассчитывает положение Лилит с учётом точного часового пояса.
     """
-    d, m, y = map(int, date_str.split("."))
-    h, mn = map(int, time_str.split(":"))
-    
-    # Преобразуем локальное время в UT с учётом DST
-    ut = calculate_utc_time(h + mn/60, tz_offset)
-    
-    jd = swe.julday(y, m, d, ut)
-    pos, _ = swe.calc_ut(jd, swe.MEAN_APOG)
-    lil_lon = pos[0]
-    cusps, _ = swe.houses(jd, lat, lon, b"P")
-    return deg_to_sign(lil_lon)[0], deg_to_sign(lil_lon)[1], house_for_lon(lil_lon, cusps), jd, cusps
+    chart = ChartContext.from_local(date_str, time_str, tz_offset, lat, lon)
+    lil_lon = chart.lon_of(swe.MEAN_APOG)
+    pos, sign_idx = deg_to_sign(lil_lon)
+    return pos, sign_idx, chart.house_of(lil_lon), chart.jd, chart.cusps
 
 def calc_nodes(jd: float, true: bool):
-    body = swe.TRUE_NODE if true else swe.MEAN_NODE
-    pos, _ = swe.calc_ut(jd, body)
-    return deg_to_sign(pos[0])[0], deg_to_sign(pos[0])[1], pos[0]
+    node_lon = body_lon(jd, swe.TRUE_NODE if true else swe.MEAN_NODE)
+    return deg_to_sign(node_lon)[0], deg_to_sign(node_lon)[1], node_lon
 
 # ---------- 🌕 Фазы Луны ----------
+MOON_PHASES = [
+    "🌑 Новолуние (новые начинания)",
+    "🌒 Первая четверть (действие)",
+    "🌕 Полнолуние (результаты)",
+    "🌖 Последняя четверть (завершение)",
+    "🌗 Убывающая Луна (анализ)",
+]
+MOON_PHASE_BOUNDS = [45, 90, 135, 180]   # элонгация Луны от Солнца, градусы
+
+def phase_index(elong: float) -> int:
+    return bisect_right(MOON_PHASE_BOUNDS, elong % 360)
+
 def moon_phase(jd: float) -> str:
-    sun, _ = swe.calc_ut(jd, swe.SUN)
-    moon, _ = swe.calc_ut(jd, swe.MOON)
-    elong = (moon[0] - sun[0]) % 360
-    if elong < 45:
-        return "🌑 Новолуние (новые начинания)"
-    if elong < 90:
-        return "🌒 Первая четверть (действие)"
-    if elong < 135:
-        return "🌕 Полнолуние (результаты)"
-    if elong < 180:
-        return "🌖 Последняя четверть (завершение)"
-    return "🌗 Убывающая Луна (анализ)"
+    return MOON_PHASES[phase_index(body_lon(jd, swe.MOON) - body_lon(jd, swe.SUN))]
+
+# ---------- 🧮 Пакетный расчёт карт ----------
+def julday_array(y, m, d, ut) -> np.ndarray:
+    """Юлианская дата (григорианский календарь) для массивов — то же, что swe.julday"""
+    y = np.asarray(y, dtype=np.int64)
+    m = np.asarray(m, dtype=np.int64)
+    early = m <= 2
+    y = np.where(early, y - 1, y)
+    m = np.where(early, m + 12, m)
+    a = y // 100
+    b = 2 - a + a // 4
+    return (np.floor(365.25 * (y + 4716)) + np.floor(30.6001 * (m + 1))
+            + np.asarray(d, dtype=np.float64) + b - 1524.5 + np.asarray(ut, dtype=np.float64) / 24.0)
+
+def houses_for_lons(lons: np.ndarray, cusps: np.ndarray) -> np.ndarray:
+    """Векторная версия house_for_lon: lons — (n,), cusps — (n, 12)"""
+    start = cusps[:, :1]
+    offsets = (cusps - start) % 360
+    return np.count_nonzero(offsets <= ((lons[:, None] - start) % 360), axis=1)
+
+class ChartEngine:
+    """
+    Пакетный расчёт карт для массовых задач (пересчёты, отчёты, бэкфиллы).
+    Вызовы Swiss Ephemeris идут одним плотным циклом, всё остальное — NumPy.
+    """
+
+    BODIES = (("lilith", swe.MEAN_APOG), ("node", swe.MEAN_NODE), ("sun", swe.SUN), ("moon", swe.MOON))
+
+    def __init__(self, house_system: bytes = HOUSE_SYSTEM):
+        self.house_system = house_system
+
+    @staticmethod
+    def parse_births(births) -> Tuple[np.ndarray, ...]:
+        """[(«дд.мм.гггг», час, tz_offset, lat, lon), ...] → колонки NumPy"""
+        days, months, years, hours, tzs, lats, lons = [], [], [], [], [], [], []
+        for date_str, hour, tz_offset, lat, lon in births:
+            d, m, y = map(int, date_str.split("."))
+            days.append(d)
+            months.append(m)
+            years.append(y)
+            hours.append(hour)
+            tzs.append(tz_offset)
+            lats.append(lat)
+            lons.append(lon)
+        return (np.array(years), np.array(months), np.array(days), np.array(hours, dtype=np.float64),
+                np.array(tzs, dtype=np.float64), np.array(lats, dtype=np.float64), np.array(lons, dtype=np.float64))
+
+    def compute_batch(self, births) -> Dict[str, np.ndarray]:
+        return self.compute_arrays(*self.parse_births(births))
+
+    def compute_arrays(self, years, months, days, hours, tz_offsets, lats, lons) -> Dict[str, np.ndarray]:
+        """
+        Возвращает массивы длины n: jd, долготы lilith/node/south/sun/moon,
+        cusps (n, 12), знаки *_sign, дома *_house, elongation и phase (индекс MOON_PHASES).
+        """
+        jd = julday_array(years, months, days, calculate_utc_time(np.asarray(hours, dtype=np.float64),
+                                                                 np.asarray(tz_offsets, dtype=np.float64)))
+        n = len(jd)
+        out = {name: np.empty(n) for name, _ in self.BODIES}
+        cusps = np.empty((n, 12))
+        calc_ut, hsys = swe.calc_ut, self.house_system
+        for i, (t, lat, lon) in enumerate(zip(jd.tolist(), np.asarray(lats).tolist(), np.asarray(lons).tolist())):
+            for name, body in self.BODIES:
+                out[name][i] = calc_ut(t, body)[0][0]
+            cusps[i] = house_cusps(t, lat, lon, hsys)
+
+        out["jd"] = jd
+        out["cusps"] = cusps
+        out["south"] = (out["node"] + 180) % 360
+        for name in ("lilith", "node", "south", "sun", "moon"):
+            out[f"{name}_sign"] = (out[name] % 360 // 30).astype(np.int8)
+        for name in ("lilith", "node", "south"):
+            out[f"{name}_house"] = houses_for_lons(out[name], cusps).astype(np.int8)
+        out["elongation"] = (out["moon"] - out["sun"]) % 360
+        out["phase"] = np.searchsorted(MOON_PHASE_BOUNDS, out["elongation"], side="right").astype(np.int8)
+        return out
+
+CHART_ENGINE = ChartEngine()
+
+# ---------- 🏭 Пул расчётов ----------
+# Одно ядро остаётся циклу событий; 0 — считать в процессе бота (одноядерная машина)
+CHART_WORKERS = int(os.getenv("CHART_WORKERS", max(0, (os.cpu_count() or 1) - 1)))
+CHART_QUEUE_LIMIT = int(os.getenv("CHART_QUEUE_LIMIT", 64))            # расчётов в работе и в очереди
+
+class ChartServiceBusy(Exception):
+    """Очередь расчётов заполнена — пользователю предлагается повторить позже"""
+
+def compute_chart(date_str: str, hour: int, lat: float, lon: float, iso: str, fallback_tz: float) -> Dict:
+    """Всё, что держит GIL в lil_hour/nodes_hour: смещение пояса и карта. Выполняется в воркере."""
+    tz_offset = get_precise_tz_offset(lat, lon, iso, date_str, hour)
+    if tz_offset is None:
+        tz_offset = fallback_tz
+    chart = ChartContext.from_local(date_str, f"{hour:02d}:00", tz_offset, lat, lon)
+    lilith = chart.lon_of(swe.MEAN_APOG)
+    node = chart.lon_of(swe.MEAN_NODE)
+    south = (node + 180) % 360
+    return {
+        "tz_offset": tz_offset,
+        "lilith": lilith, "lilith_house": chart.house_of(lilith),
+        "node": node, "node_house": chart.house_of(node),
+        "south": south, "south_house": chart.house_of(south),
+        "phase": chart.phase(),
+    }
+
+def _chart_worker_init(ephe_path: str):
+    """Один раз на воркер: эфемериды, таблица средних точек, пояса городов"""
+    swe.set_ephe_path(ephe_path)
+    EPHE_FILES.preload()
+    MEAN_POINTS.load(build_missing=False)
+    TZ_RESOLVER.preload(CITY_CATALOG.coordinates())
+    TZ_TABLES.preload(TZ_RESOLVER.zones())
+
+def _chart_worker_ping() -> int:
+    return os.getpid()
+
+def _chart_worker_call(fn, args) -> Tuple[object, int, Tuple[int, int, int, int]]:
+    """fn(*args) плюс счётчики кэшей эфемерид этого процесса — сами кэши живут в воркерах"""
+    result = fn(*args)
+    return result, os.getpid(), (BODY_CACHE.hits, BODY_CACHE.misses, HOUSE_CACHE.hits, HOUSE_CACHE.misses)
+
+class ChartService:
+    """
+    CPU-расчёты (Swiss Ephemeris, TimezoneFinder) в пуле процессов, чтобы они не
+    держали GIL цикла событий. Очередь ограничена: сверх limit — ChartServiceBusy.
+    """
+
+    def __init__(self, workers: int = CHART_WORKERS, limit: int = CHART_QUEUE_LIMIT):
+        self.workers = max(0, workers)
+        self.limit = max(1, limit)
+        self.pending = 0
+        self.completed = 0
+        self.failed = 0        # расчёт бросил исключение или пул так и не поднялся
+        self.rejected = 0
+        self.busy_time = 0.0   # только по успешным расчётам
+        self.restarts = 0
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._caches: Dict[int, Tuple[int, int, int, int]] = {}    # pid → последние счётчики кэшей
+
+    def _make_pool(self) -> ProcessPoolExecutor:
+        # spawn: воркер импортирует бот с нуля, без копии потоков и цикла событий родителя
+        return ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"),
+                                   initializer=_chart_worker_init, initargs=(str(EPHE_PATH),))
+
+    async def start(self) -> int:
+        """Поднимает воркеры заранее, чтобы первый пользователь не ждал их загрузки"""
+        if not self.workers or self._pool is not None:
+            return 0
+        self._pool = self._make_pool()
+        loop = asyncio.get_running_loop()
+        pids = await asyncio.gather(*(loop.run_in_executor(self._pool, _chart_worker_ping)
+                                      for _ in range(self.workers)))
+        return len(set(pids))
+
+    async def stop(self):
+        pool, self._pool = self._pool, None
+        if pool is not None:
+            await asyncio.to_thread(pool.shutdown, True, cancel_futures=True)
+
+    @property
+    def saturated(self) -> bool:
+        """Все воркеры заняты — новый расчёт встанет в очередь"""
+        return self.pending >= max(1, self.workers)
+
+    def _replace(self, broken: ProcessPoolExecutor) -> Optional[ProcessPoolExecutor]:
+        """
+        Пул сломан (воркер упал). Пересоздаёт его один раз, сколько бы расчётов ни
+        упало одновременно: остальные увидят, что self._pool уже не тот, и возьмут новый.
+        """
+        if self._pool is broken:
+            print("⚠️ Пул расчётов сломан, пересоздаём")
+            self.restarts += 1
+            self._pool = self._make_pool()
+            broken.shutdown(wait=False, cancel_futures=True)
+        return self._pool
+
+    async def _call(self, pool: ProcessPoolExecutor, fn, args):
+        result, pid, caches = await asyncio.get_running_loop().run_in_executor(pool, _chart_worker_call, fn, args)
+        self._caches[pid] = caches
+        return result
+
+    async def _run(self, fn, args):
+        pool = self._pool
+        if pool is None:
+            return _chart_worker_call(fn, args)[0]
+        try:
+            return await self._call(pool, fn, args)
+        except BrokenProcessPool:
+            pool = self._replace(pool)
+        # Одна повторная попытка в новом пуле; на цикле событий расчёт не делаем
+        if pool is None:
+            raise ChartServiceBusy()
+        try:
+            return await self._call(pool, fn, args)
+        except BrokenProcessPool:
+            self._replace(pool)
+            raise ChartServiceBusy()
+
+    async def run(self, fn, *args):
+        if self.pending >= self.limit:
+            self.rejected += 1
+            raise ChartServiceBusy()
+        self.pending += 1
+        t0 = time.perf_counter()
+        try:
+            result = await self._run(fn, args)
+        except Exception:
+            self.failed += 1
+            raise
+        finally:
+            self.pending -= 1
+        self.completed += 1
+        self.busy_time += time.perf_counter() - t0
+        return result
+
+    def stats(self) -> Dict[str, float]:
+        # Без пула расчёты идут здесь — счётчики берутся из кэшей этого процесса
+        caches = dict(self._caches)
+        caches[os.getpid()] = (BODY_CACHE.hits, BODY_CACHE.misses, HOUSE_CACHE.hits, HOUSE_CACHE.misses)
+        body_hits, body_misses, house_hits, house_misses = (sum(c[i] for c in caches.values()) for i in range(4))
+        return {
+            "workers": self.workers, "pending": self.pending, "completed": self.completed,
+            "failed": self.failed, "rejected": self.rejected, "restarts": self.restarts,
+            "avg_ms": self.busy_time / self.completed * 1000 if self.completed else 0.0,
+            "body_hit_rate": body_hits / (body_hits + body_misses) if body_hits + body_misses else 0.0,
+            "house_hit_rate": house_hits / (house_hits + house_misses) if house_hits + house_misses else 0.0,
+        }
+
+CHART_SERVICE = ChartService()
 
 # ---------- 🎹 Клавиатуры ----------
 def build_kb(items, row=3, add_back=False, add_cancel=True):
@@ -402,10 +2494,10 @@ main_kb  = ReplyKeyboardMarkup([
     ["⚙ Админ-меню"]
 ], resize_keyboard=True)
 
-city_kb  = build_kb([c.title() for c in CITIES_TOP], add_cancel=True)
+city_kb  = build_kb(CITY_CATALOG.top(len(CITIES_TOP)) or [c.title() for c in CITIES_TOP], add_cancel=True)
 day_kb   = build_kb(range(1, 32), row=7)
 month_kb = build_kb(range(1, 13), row=6)
-year_kb  = build_kb(range(1947, 2021), row=6)
+year_kb  = build_kb(range(BIRTH_YEAR_MIN, BIRTH_YEAR_MAX + 1), row=6)
 hour_kb  = build_kb([f"{i:02d}" for i in range(24)], row=6)
 
 # ---------- 🎬 Состояния ----------
@@ -424,13 +2516,120 @@ def admin_only(func):
     return wrapped
 
 # ---------- Хелпер для экранирования Markdown ----------
+MARKDOWN_V2_SPECIAL = '\\_*[]()~`>#+-=|{}.!'
+
 def escape_markdown(text: str) -> str:
-    """Экранирует специальные символы MarkdownV2"""
-    escape_chars = r'_*[]()~`>#+-=|{}.!'
-    for char in escape_chars:
+    """Экранирует специальные символы MarkdownV2 (обратный слеш — первым)"""
+    for char in MARKDOWN_V2_SPECIAL:
         text = text.replace(char, f'\\{char}')
     return text
 
+# ---------- ✍️ Потоковый ответ ----------
+STREAM_EDIT_INTERVAL = 1.2      # секунд между правками одного сообщения (лимит Telegram ~1/с на чат)
+STREAM_MIN_CHARS = 60           # новых символов, ради которых стоит править сообщение
+STREAM_CURSOR = " ▌"
+TELEGRAM_TEXT_LIMIT = 4096
+
+class StreamingReply:
+    """
+    Ответ, который дописывается по мере генерации: заглушка → правки edit_text не чаще
+    STREAM_EDIT_INTERVAL → финальная правка с клавиатурой. Текст копится сырым и
+    экранируется целиком при каждой правке, поэтому граница куска никогда не разрывает
+    экранирование MarkdownV2. Не влезающее в 4096 символов уходит в следующее сообщение.
+    """
+
+    def __init__(self, anchor, prefix: str = "", placeholder: str = "⏳ Составляю разбор…"):
+        self.anchor = anchor            # сообщение, на которое отвечаем
+        self.prefix = prefix            # уже экранированный заголовок первого сообщения
+        self.placeholder = placeholder
+        self.messages = []
+        self._current = None
+        self._raw = ""
+        self._shown = 0
+        self._next_edit = 0.0
+        self.started_at = time.monotonic()
+        self.first_content_at: Optional[float] = None
+
+    def _head(self) -> str:
+        return self.prefix if not self.messages else ""
+
+    def _render(self, raw: str) -> str:
+        return self._head() + escape_markdown(raw)
+
+    async def start(self):
+        """Заглушка сразу — пользователь видит, что разбор пошёл"""
+        if self._current is None:
+            self._current = await self.anchor.reply_text(self._render(self.placeholder), parse_mode="MarkdownV2")
+
+    async def _show(self, text: str, reply_markup=None, final: bool = False):
+        if self._current is None:
+            self._current = await self.anchor.reply_text(text, parse_mode="MarkdownV2", reply_markup=reply_markup)
+            return
+        for _ in range(3 if final else 1):
+            try:
+                await self._current.edit_text(text, parse_mode="MarkdownV2", reply_markup=reply_markup)
+                break
+            except RetryAfter as e:
+                delay = e.retry_after.total_seconds() if isinstance(e.retry_after, dt.timedelta) else e.retry_after
+                self._next_edit = time.monotonic() + delay
+                if final:
+                    await asyncio.sleep(delay)
+            except BadRequest as e:
+                if "not modified" not in str(e).lower():
+                    print(f"⚠️ Правка потокового ответа: {e}")
+                break
+        self._next_edit = max(self._next_edit, time.monotonic() + STREAM_EDIT_INTERVAL)
+
+    def _cut(self) -> int:
+        """Сколько сырых символов влезает в сообщение вместе с заголовком и курсором"""
+        budget = TELEGRAM_TEXT_LIMIT - len(self._head()) - len(STREAM_CURSOR)
+        used = n = 0
+        for ch in self._raw:
+            used += 2 if ch in MARKDOWN_V2_SPECIAL else 1
+            if used > budget:
+                break
+            n += 1
+        # Режем по абзацу или хотя бы по пробелу, если он не слишком далеко
+        for sep in ("\n", " "):
+            pos = self._raw.rfind(sep, 0, n)
+            if pos > n // 2:
+                return pos
+        return n
+
+    async def _overflow(self):
+        while len(self._render(self._raw)) + len(STREAM_CURSOR) > TELEGRAM_TEXT_LIMIT:
+            cut = self._cut()
+            head, self._raw = self._raw[:cut], self._raw[cut:].lstrip()
+            await self._show(self._render(head.rstrip()), final=True)
+            self.messages.append(self._current)
+            self._current = None
+            self._shown = 0
+
+    async def feed(self, delta: str):
+        if self.first_content_at is None:
+            self.first_content_at = time.monotonic()
+        self._raw += delta
+        await self._overflow()
+        fresh = len(self._raw) - self._shown
+        if self._current is None or (time.monotonic() >= self._next_edit and fresh >= STREAM_MIN_CHARS) or not self._shown:
+            self._shown = len(self._raw)
+            await self._show(self._render(self._raw) + STREAM_CURSOR)
+
+    async def finish(self, text: str, reply_markup=None):
+        """Готовый ответ с клавиатурой; если он шёл потоком — буфер уже содержит text"""
+        if self.first_content_at is None:
+            self._raw = text
+            await self._overflow()
+        self._raw = self._raw.strip()
+        await self._show(self._render(self._raw), reply_markup=reply_markup, final=True)
+        self.messages.append(self._current)
+
+    async def fail(self, text: str, reply_markup=None):
+        """Вместо разбора — сообщение об ошибке, без заголовка"""
+        self.prefix = ""
+        self.first_content_at = None
+        await self.finish(text, reply_markup)
+
 # ---------- 🚀 Команды ----------
 async def start(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     """Обработка команды /start и коллбэка главного меню"""
@@ -460,12 +2659,14 @@ async def start(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text(welcome, parse_mode="Markdown", reply_markup=main_kb)
 
 async def cancel(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
+    cancel_llm_for(update.effective_user.id)
     await update.message.reply_text("✅ Диалог отменён. Возвращаемся в главное меню.", reply_markup=main_kb)
     return ConversationHandler.END
 
 # ---------- 🏠 Главное меню ----------
 async def main_menu(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     """Вернуться в главное меню"""
+    cancel_llm_for(update.effective_user.id)
     await update.message.reply_text("✅ Возвращаемся в главное меню", reply_markup=main_kb)
 
 # ---------- 💰 Баланс ----------
@@ -510,8 +2711,27 @@ async def show_balance(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(text, parse_mode="Markdown", reply_markup=main_kb)
 
 # ---------- 🌙 Лилит-разбор ----------
-async def lil_start(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
+async def compute_chart_for(update: Update, date_str: str, hour: int, lat: float, lon: float,
+                            iso: str, fallback_tz: float) -> Optional[Dict]:
+    """Карта через CHART_SERVICE; при очереди — «считаю…», при переполнении — None"""
+    if CHART_SERVICE.saturated:
+        await update.message.reply_text("⏳ Считаю карту, несколько секунд…")
+    try:
+        return await CHART_SERVICE.run(compute_chart, date_str, hour, lat, lon, iso, fallback_tz)
+    except ChartServiceBusy:
+        await update.message.reply_text("🚦 Сейчас очень много расчётов. Нажми час ещё раз через минуту.")
+        return None
+
+DIALOG_KEEP = ("seen_readings",)    # ключи user_data, которые не сбрасывает новый расчёт
+
+def reset_dialog(ctx: ContextTypes.DEFAULT_TYPE):
+    """Новый расчёт: ответы прошлого диалога стираются, DIALOG_KEEP — остаются"""
+    kept = {key: ctx.user_data[key] for key in DIALOG_KEEP if key in ctx.user_data}
     ctx.user_data.clear()
+    ctx.user_data.update(kept)
+
+async def lil_start(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
+    reset_dialog(ctx)
     await update.message.reply_text("🏙 *Выбери город рождения* (или напиши вручную):", reply_markup=city_kb, parse_mode="Markdown")
     return LIL_CITY
 
@@ -522,21 +2742,17 @@ async def lil_city(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     elif text == "🏠 Главное меню":
         return await cancel(update, ctx)
         
-    key = text.lower()
-    if key not in CITY_COORDS:
-        ai = groq_city(text)
-        if not ai:
-            await update.message.reply_text("❌ Город не найден в базе и не распознан. Попробуй другой вариант или ближайший крупный город.", reply_markup=city_kb)
-            return LIL_CITY
-        name, lat, lon, iso = ai
-        CITY_COORDS[key] = (lat, lon, iso)
-        save_city(name, lat, lon, iso)
-    else:
-        lat, lon, iso = CITY_COORDS[key]
-        name = text
+    city, suggestions = await find_city(text)
+    if suggestions:
+        await update.message.reply_text("🤔 Уточни, какой город ты имеешь в виду:", reply_markup=build_kb(suggestions, row=2))
+        return LIL_CITY
+    if not city:
+        await update.message.reply_text("❌ Город не найден в базе и не распознан. Попробуй другой вариант или ближайший крупный город.", reply_markup=city_kb)
+        return LIL_CITY
+    name, lat, lon, iso = city
     
     # Определяем базовый часовой пояс (для начального отображения)
-    base_tz = groq_tz(name, iso) or 3.0
+    base_tz = await base_tz_for(name, iso, lat, lon) or 3.0
     ctx.user_data.update({"city": name, "lat": lat, "lon": lon, "iso": iso, "base_tz": base_tz})
     
     await update.message.reply_text(
@@ -596,12 +2812,12 @@ async def lil_hour(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     # Получаем дату для расчёта DST
     date_str = f"{d:02d}.{m:02d}.{y}"
     
-    # Определяем точное смещение с учётом летнего времени
-    tz_offset = get_precise_tz_offset(lat, lon, iso, date_str)
-    
-    # Если не удалось определить точно, используем базовое от groq
-    if tz_offset is None:
-        tz_offset = ctx.user_data.get("base_tz", 3.0)
+    # Точное смещение с учётом летнего времени и карта считаются в пуле процессов;
+    # если не удалось определить пояс точно, берётся базовое значение
+    chart = await compute_chart_for(update, date_str, h, lat, lon, iso, ctx.user_data.get("base_tz", 3.0))
+    if chart is None:
+        return LIL_HOUR
+    tz_offset = chart["tz_offset"]
     
     # Определяем, был ли применён DST
     base_tz = ctx.user_data.get("base_tz", tz_offset)
@@ -609,8 +2825,9 @@ async def lil_hour(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     
     time_str = f"{h:02d}:00"
     
-    # Рассчитываем позиции с точным временем
-    pos, sign_idx, house, jd, cusps = calc_lilith_house(date_str, time_str, tz_offset, lat, lon)
+    lil_lon = chart["lilith"]
+    pos, sign_idx = deg_to_sign(lil_lon)
+    house = chart["lilith_house"]
     
     # ... остальной код сохранения данных
     ctx.user_data["tz_offset"] = tz_offset
@@ -645,14 +2862,20 @@ async def lil_hour(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         12: "🔮 12 дом — подсознание, тайны, духовность."
     }.get(house, "")
     
-    phase = moon_phase(jd)
+    phase = chart["phase"]
     
     # Узлы внутри Лилит (бесплатно)
-    pos_node_str, node_sign_idx, node_lon = calc_nodes(jd, False)
-    node_house = house_for_lon(node_lon, cusps)
-    south_lon = (node_lon + 180) % 360
-    pos_south_str, south_sign_idx = deg_to_sign(south_lon)
-    south_house = house_for_lon(south_lon, cusps)
+    pos_node_str, node_sign_idx = deg_to_sign(chart["node"])
+    node_house = chart["node_house"]
+    pos_south_str, south_sign_idx = deg_to_sign(chart["south"])
+    south_house = chart["south_house"]
+    
+    # Нормализованная карта — ключ кэша расширенных разборов; едет в кнопке вместе с сообщением
+    deep_data = deep_callback_data({
+        "lilith": [sign_idx, house],
+        "node": [node_sign_idx, node_house],
+        "phase": MOON_PHASES.index(phase),
+    })
     
     nodes_block = (
         f"🌟 *Лунные Узлы:*\n"
@@ -683,34 +2906,32 @@ async def lil_hour(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     
     # Отправляем результат с inline кнопкой
     await update.message.reply_text(full_text, parse_mode="Markdown", reply_markup=InlineKeyboardMarkup([
-        [InlineKeyboardButton("🧠 Получить расширенный разбор", callback_data="deep_lilith")]
+        [InlineKeyboardButton("🧠 Получить расширенный разбор", callback_data=deep_data)]
     ]))
     
     # Восстанавливаем главную клавиатуру
     await update.message.reply_text("👉👉👉 Выбери действие в меню:", reply_markup=main_kb)
     
-    # лог
-    ensure_csv(REPORTS_CSV, ["ts", "uid", "username", "full_name", "type", "city", "iso", "date", "time", "tz", "tz_offset", "dst_applied"])
-    with REPORTS_CSV.open("a", newline="", encoding="utf-8") as f:
-        csv.writer(f).writerow([
-            dt.datetime.now(dt.timezone.utc).isoformat(),
-            update.effective_user.id,
-            update.effective_user.username or "",
-            update.effective_user.full_name or "",
-            "lilith",
-            city,
-            iso,
-            date_str,
-            time_str,
-            base_tz,
-            tz_offset,
-            int(dst_applied)
-        ])
+    # лог (пишется в фоне пачками)
+    REPORTS.log([
+        dt.datetime.now(dt.timezone.utc).isoformat(),
+        update.effective_user.id,
+        update.effective_user.username or "",
+        update.effective_user.full_name or "",
+        "lilith",
+        city,
+        iso,
+        date_str,
+        time_str,
+        base_tz,
+        tz_offset,
+        int(dst_applied)
+    ])
     return ConversationHandler.END
 
 # ---------- ⭐ Узлы Луны ----------
 async def nodes_start(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
-    ctx.user_data.clear()
+    reset_dialog(ctx)
     await update.message.reply_text("🏙 *Город рождения для расчёта узлов:*", reply_markup=city_kb, parse_mode="Markdown")
     return NOD_CITY
 
@@ -721,20 +2942,16 @@ async def nodes_city(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     elif text == "🏠 Главное меню":
         return await cancel(update, ctx)
         
-    key = text.lower()
-    if key not in CITY_COORDS:
-        ai = groq_city(text)
-        if not ai:
-            await update.message.reply_text("❌ Город не найден. Попробуй ещё раз.", reply_markup=city_kb)
-            return NOD_CITY
-        name, lat, lon, iso = ai
-        CITY_COORDS[key] = (lat, lon, iso)
-        save_city(name, lat, lon, iso)
-    else:
-        lat, lon, iso = CITY_COORDS[key]
-        name = text
+    city, suggestions = await find_city(text)
+    if suggestions:
+        await update.message.reply_text("🤔 Уточни, какой город ты имеешь в виду:", reply_markup=build_kb(suggestions, row=2))
+        return NOD_CITY
+    if not city:
+        await update.message.reply_text("❌ Город не найден. Попробуй ещё раз.", reply_markup=city_kb)
+        return NOD_CITY
+    name, lat, lon, iso = city
     
-    base_tz = groq_tz(name, iso) or 3.0
+    base_tz = await base_tz_for(name, iso, lat, lon) or 3.0
     ctx.user_data.update({"nodes_city": name, "nodes_lat": lat, "nodes_lon": lon, "nodes_iso": iso, "nodes_base_tz": base_tz})
     
     await update.message.reply_text(
@@ -793,30 +3010,22 @@ async def nodes_hour(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     
     date_str = f"{d:02d}.{m:02d}.{y}"
     
-    # Точное смещение с учётом DST
-    tz_offset = get_precise_tz_offset(lat, lon, iso, date_str)
-    if tz_offset is None:
-        tz_offset = ctx.user_data.get("nodes_base_tz", 3.0)
+    # Точное смещение с учётом DST и карта — в пуле процессов
+    chart = await compute_chart_for(update, date_str, h, lat, lon, iso, ctx.user_data.get("nodes_base_tz", 3.0))
+    if chart is None:
+        return NOD_HOUR
+    tz_offset = chart["tz_offset"]
     
     base_tz = ctx.user_data.get("nodes_base_tz", tz_offset)
     dst_applied = abs(tz_offset - base_tz) > 0.5
     
     time_str = f"{h:02d}:00"
 
-    # Используем date_obj вместо dt_date
-    date_obj = dt.datetime.strptime(date_str, "%d.%m.%Y")
-    local_hour = h
-    ut_hour = calculate_utc_time(local_hour, tz_offset)
-    
-    jd = swe.julday(date_obj.year, date_obj.month, date_obj.day, ut_hour)
-
     # Узлы
-    pos_node_str, node_sign_idx, node_lon = calc_nodes(jd, False)
-    cusps, _ = swe.houses(jd, lat, lon, b"P")
-    node_house = house_for_lon(node_lon, cusps)
-    south_lon = (node_lon + 180) % 360
-    pos_south_str, south_sign_idx = deg_to_sign(south_lon)
-    south_house = house_for_lon(south_lon, cusps)
+    pos_node_str, node_sign_idx = deg_to_sign(chart["node"])
+    node_house = chart["node_house"]
+    pos_south_str, south_sign_idx = deg_to_sign(chart["south"])
+    south_house = chart["south_house"]
 
     dst_status = "летнее время" if dst_applied else "зимнее время"
     
@@ -838,23 +3047,21 @@ async def nodes_hour(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     )
     await update.message.reply_text(text_out, parse_mode="Markdown", reply_markup=main_kb)
 
-    # лог
-    ensure_csv(REPORTS_CSV, ["ts", "uid", "username", "full_name", "type", "city", "iso", "date", "time", "tz", "tz_offset", "dst_applied"])
-    with REPORTS_CSV.open("a", newline="", encoding="utf-8") as f:
-        csv.writer(f).writerow([
-            dt.datetime.now(dt.timezone.utc).isoformat(),
-            update.effective_user.id,
-            update.effective_user.username or "",
-            update.effective_user.full_name or "",
-            "nodes",
-            city,
-            iso,
-            date_str,
-            time_str,
-            base_tz,
-            tz_offset,
-            int(dst_applied)
-        ])
+    # лог (пишется в фоне пачками)
+    REPORTS.log([
+        dt.datetime.now(dt.timezone.utc).isoformat(),
+        update.effective_user.id,
+        update.effective_user.username or "",
+        update.effective_user.full_name or "",
+        "nodes",
+        city,
+        iso,
+        date_str,
+        time_str,
+        base_tz,
+        tz_offset,
+        int(dst_applied)
+    ])
     return ConversationHandler.END
 
 # ---------- 🛒 Магазин ----------
@@ -926,12 +3133,10 @@ async def first_free(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         await query.message.reply_text("👑 Ты администратор! У тебя уже безлимитный доступ.", reply_markup=main_kb)
         return
         
-    used = PaymentManager.get_used(uid)
-    if used > 0:
+    if not PaymentManager.claim_free(uid):
         await query.message.reply_text("❗ Ты уже использовал бесплатный разбор. Выбери платный пакет.", reply_markup=main_kb)
         return
     
-    PaymentManager.increment_used(uid)
     await query.message.reply_text(
         "🎁 *Поздравляю! Первый расширенный разбор — в подарок!*\n\n"
         "Теперь можешь получить его в любом расчёте Лилит или Узлов.\n"
@@ -1043,20 +3248,16 @@ async def success_payment(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
             reply_markup=main_kb
         )
         
-        # Сообщение админам
-        for admin in ADMIN_IDS:
-            try:
-                await ctx.bot.send_message(
-                    admin,
-                    f"💰 *Новый платёж!*\n\n"
-                    f"👤 Пользователь: {uid}\n"
-                    f"💳 Сумма: {amount//100}₽\n"
-                    f"🎁 Разборов: {add_count}\n"
-                    f"💰 Баланс: {new_balance}",
-                    parse_mode="Markdown"
-                )
-            except:
-                pass
+        # Сообщение админам — в фоне, пользователь не ждёт рассылку
+        NOTIFIER.broadcast(
+            ADMIN_IDS,
+            f"💰 *Новый платёж!*\n\n"
+            f"👤 Пользователь: {uid}\n"
+            f"💳 Сумма: {amount//100}₽\n"
+            f"🎁 Разборов: {add_count}\n"
+            f"💰 Баланс: {new_balance}",
+            parse_mode="Markdown"
+        )
                 
     except Exception as e:
         print(f"❌ Payment processing error: {e}")
@@ -1064,6 +3265,79 @@ async def success_payment(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ Ошибка обработки платежа. Обратись к администратору.", reply_markup=main_kb)
 
 # ---------- 🧠 Расширенный разбор ----------
+DEEP_PROMPT = (
+    "Ты профессиональный астролог-психолог. "
+    "Сделай мягкий, поддерживающий, глубокий разбор: Лилит, Узлы, Фазу Луны. "
+    "Дай практические советы, как работать с этой энергией, без фатализма. "
+    "Отвечай на русском, дружелюбно, структурированно.\n\n"
+)
+SEEN_READINGS_KEEP = 50     # id выданных вариантов в user_data
+READING_STREAMING = os.getenv("READING_STREAMING", "1") != "0"   # разбор дописывается по мере генерации
+GIFT_HEADER = (
+    "🎁 *" + escape_markdown("ПОДАРОК! Первый расширенный разбор — бесплатно!") + "*\n\n"
+    + escape_markdown("🌟 Вот подробный психологичный анализ:") + "\n\n"
+)
+
+def reading_prompt(facts: Dict) -> str:
+    """Промпт только из нормализованной карты — без даты и города, чтобы ответ можно было переиспользовать"""
+    lil_sign, lil_house = facts["lilith"]
+    node_sign, node_house = facts["node"]
+    south_house = (node_house + 5) % 12 + 1
+    return DEEP_PROMPT + (
+        f"⚫ Чёрная Луна (Лилит): {ZODIAC_SIGNS[lil_sign]}, {lil_house} дом\n"
+        f"✅ Северный узел: {ZODIAC_SIGNS[node_sign]}, {node_house} дом\n"
+        f"🔄 Южный узел: {ZODIAC_SIGNS[(node_sign + 6) % 12]}, {south_house} дом\n"
+        f"🌙 Фаза Луны: {MOON_PHASES[facts['phase']]}"
+    )
+
+def deep_callback_data(facts: Dict) -> str:
+    """callback_data кнопки разбора: deep_lilith:<знак>:<дом>:<знак узла>:<дом узла>:<фаза>"""
+    return "deep_lilith:" + ":".join(str(v) for v in (*facts["lilith"], *facts["node"], facts["phase"]))
+
+def chart_facts_from(data: str) -> Optional[Dict]:
+    """Обратно из callback_data; None — старая кнопка без карты"""
+    try:
+        lil_sign, lil_house, node_sign, node_house, phase = map(int, data.split(":")[1:])
+    except ValueError:
+        return None
+    if not (0 <= lil_sign < 12 and 0 <= node_sign < 12 and 1 <= lil_house <= 12
+            and 1 <= node_house <= 12 and 0 <= phase < len(MOON_PHASES)):
+        return None
+    return {"lilith": [lil_sign, lil_house], "node": [node_sign, node_house], "phase": phase}
+
+async def deep_reading(uid: int, ctx: ContextTypes.DEFAULT_TYPE, base: str, facts: Optional[Dict],
+                       stream: Optional[StreamingReply] = None) -> Optional[str]:
+    """
+    Разбор карты facts (из кнопки, на которую нажали): сначала из READINGS (вариант,
+    который пользователь ещё не видел), иначе — Groq, потоком в stream, если он передан.
+    None — запрос отменён.
+    """
+    async def llm(prompt: str, **kwargs) -> Optional[str]:
+        if stream is None or not READING_STREAMING:
+            return await ask_groq_for(uid, prompt, **kwargs)
+        await stream.start()
+        deep = await ask_groq_for(uid, prompt, on_delta=stream.feed, **kwargs)
+        if deep is None:
+            await stream.fail("⏹ Разбор остановлен.")
+        return deep
+
+    if not facts:
+        # Кнопка из старого сообщения, без карты — разбор по тексту сообщения, без кэша
+        return await llm(DEEP_PROMPT + base)
+    key = READINGS.key(facts)
+    seen = ctx.user_data.setdefault("seen_readings", [])
+    cached = READINGS.pick(key, seen)
+    if cached is not None:
+        rid, deep = cached
+    else:
+        deep = await llm(reading_prompt(facts))
+        if not deep:
+            return deep
+        rid = READINGS.put(key, deep)
+    seen.append(rid)
+    del seen[:-SEEN_READINGS_KEEP]
+    return deep
+
 async def deep_lilith(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     
@@ -1075,56 +3349,42 @@ async def deep_lilith(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     uid = query.from_user.id
     bal = PaymentManager.get_balance(uid)
     used = PaymentManager.get_used(uid)
+    facts = chart_facts_from(query.data)
+    again = query.data   # «Ещё разбор» — той же карты
 
-    # 🎁 Первый бесплатно
-    if used == 0:
-        PaymentManager.increment_used(uid)
-        base = query.message.text
-        prompt = (
-            "Ты профессиональный астролог-психолог. "
-            "Сделай мягкий, поддерживающий, глубокий разбор: Лилит, Узлы, Фазу Луны. "
-            "Дай практические советы, как работать с этой энергией, без фатализма. "
-            "Отвечай на русском, дружелюбно, структурированно.\n\n" + base
-        )
-        deep = ask_groq(prompt)
+    # 🎁 Первый бесплатно (отметка атомарная — двойное нажатие не даст два подарка)
+    if used == 0 and PaymentManager.claim_free(uid):
+        stream = StreamingReply(query.message, prefix=GIFT_HEADER)
+        deep = await deep_reading(uid, ctx, query.message.text, facts, stream)
+        if deep is None:
+            # Пользователь ушёл, не дождавшись разбора — подарок остаётся за ним
+            PaymentManager.release_free(uid)
+            return
         
+        kb = InlineKeyboardMarkup([[InlineKeyboardButton("🔄 Получить ещё разбор", callback_data=again)]])
         if deep:
-            deep_escaped = escape_markdown(deep)
-            txt = (
-                "🎁 *ПОДАРОК! Первый расширенный разбор — бесплатно!*\n\n"
-                "🌟 Вот подробный психологичный анализ:\n\n"
-                f"{deep_escaped}"
-            )
+            await stream.finish(deep, reply_markup=kb)
         else:
-            txt = "⏳ Пока не удалось получить разбор. Попробуй позже."
-        
-        kb = InlineKeyboardMarkup([[InlineKeyboardButton("🔄 Получить ещё разбор", callback_data="deep_lilith")]])
-        await query.message.reply_text(txt, parse_mode="MarkdownV2", reply_markup=kb)
+            await stream.fail("⏳ Пока не удалось получить разбор. Попробуй позже.", reply_markup=kb)
         await query.message.reply_text("✅ Выбери действие:", reply_markup=main_kb)
         return
 
     # 💰 Платные
+    used = PaymentManager.get_used(uid)   # подарок могло забрать параллельное нажатие
     price_rub = PaymentManager.get_next_price(uid)
     
     # Админы не платят за разборы
     if uid in ADMIN_IDS:
-        base = query.message.text
-        prompt = (
-            "Ты профессиональный астролог-психолог. "
-            "Сделай мягкий, поддерживающий, глубокий разбор: Лилит, Узлы, Фазу Луны. "
-            "Дай практические советы, как работать с этой энергией, без фатализма. "
-            "Отвечай на русском, дружелюбно, структурированно.\n\n" + base
-        )
-        deep = ask_groq(prompt)
+        stream = StreamingReply(query.message)
+        deep = await deep_reading(uid, ctx, query.message.text, facts, stream)
+        if deep is None:
+            return
         
+        kb = InlineKeyboardMarkup([[InlineKeyboardButton("🔄 Админ: Бобер", callback_data=again)]])
         if deep:
-            deep_escaped = escape_markdown(deep)
-            txt = deep_escaped
+            await stream.finish(deep, reply_markup=kb)
         else:
-            txt = "⏳ Не удалось получить разбор. Попробуй позже."
-        
-        kb = InlineKeyboardMarkup([[InlineKeyboardButton("🔄 Админ: Бобер", callback_data="deep_lilith")]])
-        await query.message.reply_text(txt, parse_mode="MarkdownV2", reply_markup=kb)
+            await stream.fail("⏳ Не удалось получить разбор. Попробуй позже.", reply_markup=kb)
         await query.message.reply_text("✅ Выбери действие:", reply_markup=main_kb)
         return
     
@@ -1143,34 +3403,30 @@ async def deep_lilith(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         )
         return
 
-    # ✅ Списываем и выдаём (только не админов)
-    if uid not in ADMIN_IDS:
-        PaymentManager.update_user(uid, balance=bal - 1)
-    
-    base = query.message.text
-    prompt = (
-        "Ты профессиональный астролог-психолог. "
-        "Сделай мягкий, поддерживающий, глубокий разбор: Лилит, Узлы, Фазу Луны. "
-        "Дай практические советы, как работать с этой энергией, без фатализма. "
-        "Отвечай на русском, дружелюбно, структурированно.\n\n" + base
-    )
-    deep = ask_groq(prompt)
+    # ✅ Списываем и выдаём (только не админов); списание атомарное — двойной клик не уведёт баланс в минус
+    if uid not in ADMIN_IDS and not PaymentManager.debit(uid):
+        await query.message.reply_text("❗ Разборы на балансе закончились. Пополни баланс в «🛒 Магазин разборов».", reply_markup=main_kb)
+        return
     
-    if deep:
-        deep_escaped = escape_markdown(deep)
-        txt = deep_escaped
-    else:
-        txt = "⏳ Не удалось получить разбор. Попробуй позже."
+    stream = StreamingReply(query.message)
+    deep = await deep_reading(uid, ctx, query.message.text, facts, stream)
+    if deep is None:
+        # Пользователь ушёл, не дождавшись разбора — возвращаем списанное
+        PaymentManager.add_balance(uid, 1)
+        return
 
     # Кнопка «Ещё» или «Купить»
     kb_lines = []
     if uid in ADMIN_IDS or PaymentManager.get_balance(uid) > 0:
-        kb_lines.append([InlineKeyboardButton("🔄 Получить ещё разбор", callback_data="deep_lilith")])
+        kb_lines.append([InlineKeyboardButton("🔄 Получить ещё разбор", callback_data=again)])
     else:
         kb_lines.append([InlineKeyboardButton(f"💳 Купить разбор — {PaymentManager.get_next_price(uid)}₽", callback_data="buy_1")])
     kb = InlineKeyboardMarkup(kb_lines)
 
-    await query.message.reply_text(txt, parse_mode="MarkdownV2", reply_markup=kb)
+    if deep:
+        await stream.finish(deep, reply_markup=kb)
+    else:
+        await stream.fail("⏳ Не удалось получить разбор. Попробуй позже.", reply_markup=kb)
     await query.message.reply_text("✅ Выбери действие:", reply_markup=main_kb)
 
 # ---------- 💰 Админ-управление балансом ----------
@@ -1202,57 +3458,59 @@ async def add_balance_cmd(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
             reply_markup=main_kb
         )
         
-        # Уведомляем пользователя
-        try:
-            await ctx.bot.send_message(
-                target_uid,
-                f"🎁 Тебе начислено {amount} разбор(а)!\n"
-                f"💰 Твой текущий баланс: {current}\n\n"
-                f"Приятного использования! 🌟",
-                parse_mode="Markdown"
-            )
-        except Exception as e:
-            print(f"❌ Не удалось уведомить пользователя {target_uid}: {e}")
+        # Уведомляем пользователя (в фоне, с повторами)
+        NOTIFIER.send(
+            target_uid,
+            f"🎁 Тебе начислено {amount} разбор(а)!\n"
+            f"💰 Твой текущий баланс: {current}\n\n"
+            f"Приятного использования! 🌟",
+            parse_mode="Markdown"
+        )
             
     except Exception as e:
         await update.message.reply_text(f"❌ Ошибка: {e}\n\nУбедитесь, что вводите числа.", reply_markup=main_kb)
 
+# ---------- 🔄 Перечитать балансы ----------
+@admin_only
+async def reload_balances_cmd(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
+    """/reload_balances - сбросить кэш балансов и перечитать их с диска"""
+    count = PaymentManager.reload()
+    await update.message.reply_text(f"✅ Кэш балансов перечитан: {count} пользователей", reply_markup=main_kb)
+
 # ---------- 📊 Админ-отчёт ----------
 @admin_only
 async def reports(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     """/reports - показать полную статистику (только для админов)"""
-    await update.message.reply_text("📊 Собираю статистику, подождите...")
-    
     try:
-        # Статистика расчетов
-        rows = read_csv_dict(REPORTS_CSV)
-        total = len(rows)
-        by_type = Counter(r["type"] for r in rows)
-        by_city = Counter(r["city"] for r in rows)
-        by_user = Counter(r["username"] or r["uid"] for r in rows)
-        
-        # Статистика платежей
-        payment_rows = read_csv_dict(PAYMENTS_CSV)
-        total_users = len(payment_rows)
-        total_balance = sum(int(r.get("balance", 0)) for r in payment_rows)
-        total_used = sum(int(r.get("used", 0)) for r in payment_rows)
+        # Кэш балансов (заодно гарантирует, что агрегаты по балансам подняты)
+        ledger = PaymentManager.cache_stats()
+        charts = CHART_SERVICE.stats()
+        updates = UPDATE_PROCESSOR.stats()
+        notify = NOTIFIER.stats()
+        readings = READINGS.stats()
+        persisted = PERSISTENCE.stats()
+        flights = LLM_FLIGHTS.stats()
+        models = "".join(
+            f"• `{model}`: p50 {s['p50_ms']:.0f} / p95 {s['p95_ms']:.0f} мс, ок {s['ok']}, "
+            f"429: {s['rate_limited']}, 403: {s['forbidden']}, ошибок {s['errors']}"
+            + (f", пауза {s['cooldown']:.0f} с" if s['cooldown'] else "") + "\n"
+            for model, s in LLM_ROUTER.stats().items()
+        )
         
-        # Сумма платежей из логов
-        log_file = BASE_DIR / "payment_logs.csv"
-        total_revenue = 0
-        if log_file.exists():
-            log_rows = read_csv_dict(log_file)
-            total_revenue = sum(int(r.get("amount", 0)) for r in log_rows if r.get("status") == "success")
+        # Все цифры — из инкрементальных агрегатов, без перечитывания CSV
+        total = STATS.total
+        by_type = STATS.by_type
+        dst_count = STATS.dst_count
+        total_users = STATS.users
+        total_balance = STATS.total_balance
+        total_used = STATS.total_used
+        total_revenue = STATS.revenue
         
         # Список админов
         admin_list = "\n".join([f"• {name} (`{uid}`)" for uid, name in ADMINS.items()])
         
         # Топ-5 пользователей по балансу
-        top_balance = sorted(payment_rows, key=lambda x: int(x.get("balance", 0)), reverse=True)[:5]
-        top_balance_text = "\n".join([f"• `{r['uid']}`: {r.get('balance', 0)} разборов" for r in top_balance])
-        
-        # Статистика DST
-        dst_count = sum(int(r.get("dst_applied", 0)) for r in rows if r.get("dst_applied"))
+        top_balance_text = "\n".join([f"• `{uid}`: {bal} разборов" for uid, bal in STATS.balances.top()])
         
         text = (
             f"📊 *Административный отчёт*\n\n"
@@ -1267,15 +3525,34 @@ async def reports(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
             f"• Пользователей: {total_users}\n"
             f"• Общий баланс: {total_balance}\n"
             f"• Использовано: {total_used}\n"
-            f"• Выручка: {total_revenue//100}₽\n\n"
+            f"• Выручка: {total_revenue//100}₽\n"
+            f"• Кэш балансов: {ledger['hits']} попаданий / {ledger['misses']} промахов\n"
+            f"• Кэш эфемерид (все воркеры): тела {charts['body_hit_rate']:.0%}, дома {charts['house_hit_rate']:.0%}\n"
+            f"• Пул расчётов: {charts['workers']} воркеров, {charts['completed']} задач, "
+            f"{charts['avg_ms']:.0f} мс в среднем, ошибок {charts['failed']}, отказов {charts['rejected']}, "
+            f"перезапусков {charts['restarts']}\n"
+            f"• Апдейты: {updates['running']} в работе, {updates['waiting']} в очереди "
+            f"(пик {updates['peak_waiting']}), обработка p50 {updates['p50_ms']:.0f} / "
+            f"p95 {updates['p95_ms']:.0f} мс, ожидание p95 {updates['wait_p95_ms']:.0f} мс\n"
+            f"• Уведомления: {notify['sent']} отправлено, {notify['retried']} повторов, "
+            f"{notify['failed']} не доставлено, {notify['queued']} в очереди\n"
+            f"• Кэш разборов: {readings['keys']} карт / {readings['rows']} текстов, "
+            f"попаданий {readings['hit_rate']:.0%} ({readings['hits']} из {readings['hits'] + readings['misses']})\n"
+            f"• Диалоги на диске: {persisted['writes']} записей в {persisted['batches']} пачках, "
+            f"без изменений {persisted['skipped']}, ждут записи {persisted['pending']}\n"
+            f"• Запросы к LLM: {flights['calls']} отправлено, {flights['saved']} склеено с одинаковыми, "
+            f"{flights['abandoned']} брошено\n"
+            f"• Модели Groq: переключений {LLM_ROUTER.failovers}, дублирующих запросов {LLM_ROUTER.hedges} "
+            f"(успели первыми {LLM_ROUTER.hedge_wins})\n"
+            f"{models}\n"
             
             f"👑 *Администраторы ({len(ADMINS)}):*\n{admin_list}\n\n"
             
-            f"🏆 *Топ-5 городов:*\n{', '.join(f'{c}({v})' for c,v in by_city.most_common(5))}\n\n"
+            f"🏆 *Топ-5 городов:*\n{', '.join(f'{c}({v})' for c,v in STATS.by_city.top())}\n\n"
             
             f"💎 *Топ-5 по балансу:*\n{top_balance_text if top_balance_text else 'Нет данных'}\n\n"
             
-            f"👤 *Топ-5 активных:*\n{', '.join(f'{u}({v})' for u,v in by_user.most_common(5))}"
+            f"👤 *Топ-5 активных:*\n{', '.join(f'{u}({v})' for u,v in STATS.by_user.top())}"
         )
         await update.message.reply_text(text, parse_mode="Markdown", reply_markup=main_kb)
         
@@ -1380,7 +3657,8 @@ async def admin_help(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         
         "💰 *Команды управления:*\n"
         "/add_balance <user_id> <количество> — начислить разборы\n"
-        "   Пример: `/add_balance 123456789 5`\n\n"
+        "   Пример: `/add_balance 123456789 5`\n"
+        "/reload\\_balances — перечитать балансы с диска\n\n"
         
         "⚙️ *Команды меню:*\n"
         "/admin — главное админ-меню\n"
@@ -1405,20 +3683,518 @@ async def admin_help(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     
     await update.message.reply_text(help_text, parse_mode="Markdown", reply_markup=kb)
 
+# ---------- 📣 Уведомления ----------
+NOTIFY_WORKERS = 8              # одновременных отправок
+NOTIFY_GLOBAL_RATE = 25.0       # сообщений в секунду на бота (лимит Telegram ~30)
+NOTIFY_CHAT_INTERVAL = 1.0      # секунд между сообщениями в один чат
+NOTIFY_MAX_ATTEMPTS = 5
+NOTIFY_DRAIN_TIMEOUT = 10.0     # сколько ждать недоставленные при остановке
+
+class RateLimiter:
+    """Token bucket: не больше rate событий в секунду, всплеск до burst"""
+
+    def __init__(self, rate: float, burst: Optional[float] = None):
+        self.rate = rate
+        self.burst = burst or rate
+        self._tokens = self.burst
+        self._stamp = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._stamp) * self.rate)
+                self._stamp = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+class Notifier:
+    """
+    Фоновая рассылка служебных сообщений (админам о платежах, пользователю о начислении):
+    хендлер ставит сообщение в очередь и сразу отвечает пользователю. Воркеры шлют
+    параллельно под общим и per-chat лимитами Telegram, на RetryAfter ждут и повторяют.
+    """
+
+    def __init__(self, workers: int = NOTIFY_WORKERS, rate: float = NOTIFY_GLOBAL_RATE,
+                 chat_interval: float = NOTIFY_CHAT_INTERVAL, attempts: int = NOTIFY_MAX_ATTEMPTS):
+        self.workers = workers
+        self.chat_interval = chat_interval
+        self.attempts = attempts
+        self._limiter = RateLimiter(rate)
+        self._next_at: Dict[int, float] = {}
+        self._bot = None
+        self._queue: asyncio.Queue = asyncio.Queue()   # до start() сообщения копятся здесь
+        self._tasks: List[asyncio.Task] = []
+        self.sent = 0
+        self.retried = 0
+        self.failed = 0
+
+    async def start(self, bot):
+        if not self._tasks:
+            self._bot = bot
+            self._tasks = [asyncio.create_task(self._run()) for _ in range(self.workers)]
+
+    def send(self, chat_id: int, text: str, **kwargs):
+        """Поставить сообщение в очередь и сразу вернуться"""
+        self._queue.put_nowait((chat_id, text, kwargs))
+
+    def broadcast(self, chat_ids, text: str, **kwargs):
+        for chat_id in chat_ids:
+            self.send(chat_id, text, **kwargs)
+
+    async def _chat_slot(self, chat_id: int):
+        # Слот бронируется сразу, чтобы два воркера не отправили в один чат одновременно
+        now = time.monotonic()
+        at = max(now, self._next_at.get(chat_id, 0.0))
+        self._next_at[chat_id] = at + self.chat_interval
+        if at > now:
+            await asyncio.sleep(at - now)
+
+    async def _deliver(self, chat_id: int, text: str, kwargs: Dict):
+        bot = self._bot
+        for attempt in range(1, self.attempts + 1):
+            await self._chat_slot(chat_id)
+            await self._limiter.acquire()
+            try:
+                await bot.send_message(chat_id, text, **kwargs)
+                self.sent += 1
+                return
+            except RetryAfter as e:
+                delay = e.retry_after.total_seconds() if isinstance(e.retry_after, dt.timedelta) else e.retry_after
+                self._next_at[chat_id] = time.monotonic() + delay
+            except (Forbidden, BadRequest) as e:
+                # Бот заблокирован или чат не существует — повтор не поможет
+                print(f"❌ Уведомление {chat_id} не доставлено: {e}")
+                break
+            except NetworkError as e:
+                delay = min(2 ** attempt, 30)
+                print(f"⚠️ Уведомление {chat_id}: {e}, повтор через {delay} с")
+                self._next_at[chat_id] = time.monotonic() + delay
+            if attempt < self.attempts:
+                self.retried += 1
+        self.failed += 1
+
+    async def _run(self):
+        while True:
+            item = await self._queue.get()
+            try:
+                await self._deliver(*item)
+            except Exception as e:
+                self.failed += 1
+                print(f"❌ Ошибка рассылки: {e}")
+            finally:
+                self._queue.task_done()
+
+    async def stop(self, timeout: float = NOTIFY_DRAIN_TIMEOUT):
+        """Доотправить очередь (не дольше timeout) и остановить воркеры"""
+        if not self._tasks:
+            return
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            print(f"⚠️ Не доставлено уведомлений при остановке: {self._queue.qsize()}")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def stats(self) -> Dict[str, int]:
+        return {"queued": self._queue.qsize(),
+                "sent": self.sent, "retried": self.retried, "failed": self.failed}
+
+NOTIFIER = Notifier()
+
+# ---------- 💾 Сохранение диалогов ----------
+PERSIST_UPDATE_INTERVAL = 5.0          # как часто PTB отдаёт изменения в persistence, секунд
+PERSIST_FLUSH_DELAY = 0.5              # write-behind: сколько копить пачку перед записью
+PERSIST_RESUME_WINDOW = 24 * 3600      # при старте поднимаются диалоги и user_data не старше этого
+PERSIST_KEEP = 30 * 24 * 3600          # более старые строки удаляются при старте
+PERSIST_HASHES_MAX = 100000            # отпечатков последней записи в памяти
+PERSIST_RETRY_DELAY = 5.0              # пауза перед повтором после ошибки записи, секунд
+
+class SQLitePersistence(BasePersistence):
+    """
+    Состояния ConversationHandler и user_data в SQLite (строка на пользователя / ключ диалога)
+    вместо перезаписи одного pickle-файла. PTB раз в PERSIST_UPDATE_INTERVAL отдаёт
+    затронутых пользователей; реально изменившиеся (по отпечатку JSON) копятся в памяти
+    и пишутся одной транзакцией в фоновом потоке. При старте читаются только свежие
+    строки по индексу updated — время подъёма не зависит от числа пользователей за всё время.
+    """
+
+    def __init__(self, path: Path, update_interval: float = PERSIST_UPDATE_INTERVAL,
+                 flush_delay: float = PERSIST_FLUSH_DELAY, resume_window: float = PERSIST_RESUME_WINDOW):
+        super().__init__(store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True,
+                                                     callback_data=False),
+                         update_interval=update_interval)
+        self.path = path
+        self.flush_delay = flush_delay
+        self.resume_window = resume_window
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+        self._users: Dict[int, Optional[str]] = {}                  # грязные: uid → JSON (None — удалить)
+        self._convs: Dict[Tuple[str, str], Optional[str]] = {}      # (имя, ключ) → JSON состояния
+        self._hashes: Dict[int, int] = {}                           # uid → отпечаток записанного
+        self._flush_task: Optional[asyncio.Task] = None
+        self.writes = 0
+        self.skipped = 0
+        self.batches = 0
+
+    def _db(self) -> sqlite3.Connection:
+        if self._conn is None:
+            conn = sqlite3.connect(str(self.path), check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS user_data ("
+                         " uid INTEGER PRIMARY KEY, data TEXT NOT NULL, updated REAL NOT NULL)")
+            conn.execute("CREATE TABLE IF NOT EXISTS conversations ("
+                         " name TEXT NOT NULL, key TEXT NOT NULL, state TEXT NOT NULL, updated REAL NOT NULL,"
+                         " PRIMARY KEY (name, key))")
+            conn.execute("CREATE INDEX IF NOT EXISTS user_data_updated ON user_data (updated)")
+            conn.execute("CREATE INDEX IF NOT EXISTS conversations_updated ON conversations (name, updated)")
+            cutoff = time.time() - PERSIST_KEEP
+            conn.execute("DELETE FROM user_data WHERE updated < ?", (cutoff,))
+            conn.execute("DELETE FROM conversations WHERE updated < ?", (cutoff,))
+            self._conn = conn
+        return self._conn
+
+    # --- Чтение при старте ---
+    async def get_user_data(self) -> Dict[int, Dict]:
+        with self._lock:
+            rows = self._db().execute("SELECT uid, data FROM user_data WHERE updated >= ?",
+                                      (time.time() - self.resume_window,)).fetchall()
+        out = {}
+        for uid, data in rows:
+            out[uid] = json.loads(data)
+            self._hashes[uid] = hash(data)
+        return out
+
+    async def get_conversations(self, name: str) -> Dict:
+        with self._lock:
+            rows = self._db().execute("SELECT key, state FROM conversations WHERE name = ? AND updated >= ?",
+                                      (name, time.time() - self.resume_window)).fetchall()
+        return {tuple(json.loads(key)): json.loads(state) for key, state in rows}
+
+    async def get_chat_data(self) -> Dict:
+        return {}
+
+    async def get_bot_data(self) -> Dict:
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    # --- Изменения от PTB: только в буфер ---
+    async def update_user_data(self, user_id: int, data: Dict) -> None:
+        try:
+            raw = json.dumps(data, ensure_ascii=False, sort_keys=True)
+        except (TypeError, ValueError) as e:
+            print(f"⚠️ user_data {user_id} не сериализуется в JSON: {e}")
+            return
+        fingerprint = hash(raw)
+        if self._hashes.get(user_id) == fingerprint:
+            self.skipped += 1
+            return
+        if len(self._hashes) >= PERSIST_HASHES_MAX:
+            self._hashes.clear()
+        self._hashes[user_id] = fingerprint
+        self._users[user_id] = raw
+        self._schedule()
+
+    async def drop_user_data(self, user_id: int) -> None:
+        self._hashes.pop(user_id, None)
+        self._users[user_id] = None
+        self._schedule()
+
+    async def update_conversation(self, name: str, key, new_state) -> None:
+        self._convs[(name, json.dumps(list(key)))] = None if new_state is None else json.dumps(new_state)
+        self._schedule()
+
+    async def refresh_user_data(self, user_id: int, user_data: Dict) -> None:
+        pass   # источник истины — память процесса
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: Dict) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data: Dict) -> None:
+        pass
+
+    async def update_chat_data(self, chat_id: int, data: Dict) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+
+    async def update_bot_data(self, data: Dict) -> None:
+        pass
+
+    async def update_callback_data(self, data) -> None:
+        pass
+
+    # --- Запись ---
+    def _take(self):
+        users, convs = self._users, self._convs
+        self._users, self._convs = {}, {}
+        return users, convs
+
+    def _write(self, users: Dict[int, Optional[str]], convs: Dict[Tuple[str, str], Optional[str]]):
+        now = time.time()
+        with self._lock:
+            db = self._db()
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                db.executemany("INSERT OR REPLACE INTO user_data (uid, data, updated) VALUES (?, ?, ?)",
+                               [(uid, raw, now) for uid, raw in users.items() if raw is not None])
+                db.executemany("DELETE FROM user_data WHERE uid = ?",
+                               [(uid,) for uid, raw in users.items() if raw is None])
+                db.executemany("INSERT OR REPLACE INTO conversations (name, key, state, updated) VALUES (?, ?, ?, ?)",
+                               [(name, key, raw, now) for (name, key), raw in convs.items() if raw is not None])
+                db.executemany("DELETE FROM conversations WHERE name = ? AND key = ?",
+                               [(name, key) for (name, key), raw in convs.items() if raw is None])
+                db.execute("COMMIT")
+            except Exception:
+                db.execute("ROLLBACK")
+                raise
+        self.writes += len(users) + len(convs)
+        self.batches += 1
+
+    def _schedule(self):
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.get_running_loop().create_task(self._flush_later())
+
+    async def _flush_later(self):
+        # Пока идёт запись, _schedule новую задачу не заводит — поэтому крутимся,
+        # пока буфер не опустеет: изменения, пришедшие во время записи, ждут не дольше пачки
+        delay = self.flush_delay
+        while self._users or self._convs:
+            await asyncio.sleep(delay)
+            delay = self.flush_delay
+            users, convs = self._take()
+            if not users and not convs:
+                continue
+            try:
+                await asyncio.to_thread(self._write, users, convs)
+            except Exception as e:
+                print(f"❌ Ошибка записи диалогов: {e}")
+                # Вернуть в буфер то, что не перезаписано более свежими изменениями, и повторить
+                for uid, raw in users.items():
+                    self._users.setdefault(uid, raw)
+                for key, raw in convs.items():
+                    self._convs.setdefault(key, raw)
+                delay = PERSIST_RETRY_DELAY
+
+    async def flush(self) -> None:
+        """Вызывается PTB при остановке: дописать всё и закрыть базу"""
+        if self._flush_task is not None and not self._flush_task.done():
+            self._flush_task.cancel()
+            await asyncio.gather(self._flush_task, return_exceptions=True)
+        users, convs = self._take()
+        if users or convs:
+            await asyncio.to_thread(self._write, users, convs)
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def stats(self) -> Dict[str, int]:
+        return {"pending": len(self._users) + len(self._convs), "writes": self.writes,
+                "skipped": self.skipped, "batches": self.batches}
+
+PERSISTENCE = SQLitePersistence(CONVERSATIONS_DB)
+
+# ---------- 🚦 Параллельная обработка апдейтов ----------
+UPDATES_MAX_INFLIGHT = int(os.getenv("UPDATES_MAX_INFLIGHT", 32))    # обработчиков одновременно
+UPDATES_MAX_QUEUED = int(os.getenv("UPDATES_MAX_QUEUED", 1024))      # принятых, включая ждущих своей очереди
+LATENCY_WINDOW = 2000                                                # последних замеров для перцентилей
+LEAVE_TEXTS = ("/cancel", "🏠 Главное меню")                          # уход из диалога: отменяет ждущий LLM-запрос
+
+class LatencyWindow:
+    """Последние N длительностей (секунды) и перцентили по ним"""
+    __slots__ = ("_values",)
+
+    def __init__(self, size: int = LATENCY_WINDOW):
+        self._values = deque(maxlen=size)
+
+    def add(self, seconds: float):
+        self._values.append(seconds)
+
+    def __len__(self) -> int:
+        return len(self._values)
+
+    def percentile(self, q: float) -> float:
+        if not self._values:
+            return 0.0
+        ordered = sorted(self._values)
+        return ordered[min(len(ordered) - 1, int(round(q / 100 * (len(ordered) - 1))))]
+
+class ChatOrderedProcessor(BaseUpdateProcessor):
+    """
+    Апдейты разных чатов обрабатываются параллельно, апдейты одного чата — строго по
+    очереди (FIFO-замок на чат), чтобы переходы ConversationHandler не перемешивались.
+    Не больше inflight обработчиков одновременно; ждущие считаются глубиной очереди.
+    Выход в меню (LEAVE_TEXTS) не ждёт очереди, чтобы отменить запрос к LLM: иначе
+    он встал бы за тем самым разбором, который должен прервать.
+    """
+
+    def __init__(self, inflight: int = UPDATES_MAX_INFLIGHT, queued: int = UPDATES_MAX_QUEUED):
+        super().__init__(max(queued, inflight))
+        self.inflight_limit = inflight
+        self._inflight = asyncio.Semaphore(inflight)
+        self._chats: Dict[int, List] = {}     # chat_id -> [замок, сколько апдейтов его ждут/держат]
+        self.running = 0
+        self.waiting = 0
+        self.peak_waiting = 0
+        self.processed = 0
+        self.handler_time = LatencyWindow()
+        self.wait_time = LatencyWindow()
+
+    @staticmethod
+    def chat_key(update: object) -> Optional[int]:
+        if isinstance(update, Update):
+            if update.effective_chat:
+                return update.effective_chat.id
+            if update.effective_user:
+                return update.effective_user.id
+        return None
+
+    @staticmethod
+    def leaving(update: object) -> bool:
+        return (isinstance(update, Update) and update.message is not None and update.effective_user is not None
+                and (update.message.text or "").strip() in LEAVE_TEXTS)
+
+    async def do_process_update(self, update: object, coroutine):
+        key = self.chat_key(update)
+        entry = self._chats.setdefault(key, [asyncio.Lock(), 0]) if key is not None else None
+        if entry is not None and entry[0].locked() and self.leaving(update):
+            cancel_llm_for(update.effective_user.id)
+        if entry is not None:
+            entry[1] += 1
+        self.waiting += 1
+        self.peak_waiting = max(self.peak_waiting, self.waiting)
+        started = False
+        t0 = time.perf_counter()
+        try:
+            if entry is not None:
+                await entry[0].acquire()
+            try:
+                async with self._inflight:
+                    self.waiting -= 1
+                    started = True
+                    self.running += 1
+                    t1 = time.perf_counter()
+                    self.wait_time.add(t1 - t0)
+                    try:
+                        await coroutine
+                    finally:
+                        self.running -= 1
+                        self.processed += 1
+                        self.handler_time.add(time.perf_counter() - t1)
+            finally:
+                if entry is not None:
+                    entry[0].release()
+        finally:
+            if not started:
+                # Отменили, пока апдейт ждал своей очереди
+                self.waiting -= 1
+                if hasattr(coroutine, "close"):
+                    coroutine.close()
+            if entry is not None:
+                entry[1] -= 1
+                if not entry[1]:
+                    self._chats.pop(key, None)
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "running": self.running, "waiting": self.waiting, "peak_waiting": self.peak_waiting,
+            "chats": len(self._chats), "processed": self.processed,
+            "p50_ms": self.handler_time.percentile(50) * 1000,
+            "p95_ms": self.handler_time.percentile(95) * 1000,
+            "wait_p95_ms": self.wait_time.percentile(95) * 1000,
+        }
+
+UPDATE_PROCESSOR = ChatOrderedProcessor()
+
 # ---------- 🚀 Запуск ----------
+async def post_init(app: Application):
+    """Фоновые службы стартуют вместе с циклом событий бота"""
+    await REPORTS.start()
+    await STATS.start()
+    await NOTIFIER.start(app.bot)
+    workers = await CHART_SERVICE.start()
+    if workers:
+        print(f"🏭 Пул расчётов: {workers} процесс(ов), очередь до {CHART_SERVICE.limit}")
+
+async def post_stop(app: Application):
+    """Бот ещё подключён — доотправляем уведомления"""
+    await NOTIFIER.stop()
+
+async def post_shutdown(app: Application):
+    """...и корректно останавливаются, дописав всё на диск"""
+    await REPORTS.stop()
+    await STATS.stop()
+    await TZ_ANSWERS.stop()
+    await CHART_SERVICE.stop()
+    EPHE_FILES.close()
+    READINGS.close()
+
 def main():
     print("✅ TELEGRAM_TOKEN загружен:", TELEGRAM_TOKEN[:15] + "...")
     print(f"💳 Payments enabled: {PAYMENTS_ENABLED}")
     print(f"👑 Администраторы ({len(ADMINS)}): {', '.join(ADMINS.values())}")
     print("⏰ Точное определение часового пояса: АКТИВИРОВАНО")
     
-    app = Application.builder().token(TELEGRAM_TOKEN).build()
+    missing = EPHE_FILES.missing()
+    if missing:
+        print(f"⚠️ Нет файлов эфемерид ({', '.join(missing)}) — Swiss Ephemeris перейдёт на формулы Мошьера")
+    mapped = EPHE_FILES.preload()
+    ephe = EPHE_FILES.stats()
+    print(f"🪐 Эфемериды {BIRTH_YEAR_MIN}–{BIRTH_YEAR_MAX}: прогрето {ephe['mapped']} файла(ов), "
+          f"{mapped / 2**20:.1f} МБ из {ephe['dir_bytes'] / 2**20:.0f} МБ в {EPHE_PATH.name}/")
+    preloaded = TZ_RESOLVER.preload(CITY_CATALOG.coordinates())
+    print(f"🗺 Часовые пояса городов предрассчитаны: {preloaded}")
+    tables = TZ_TABLES.preload(TZ_RESOLVER.zones())
+    built = not MEAN_POINTS.path.exists()
+    t0 = time.perf_counter()
+    MEAN_POINTS.load()
+    if built:
+        print(f"📉 Таблица средних Лилит/Узла построена за {time.perf_counter() - t0:.1f} с, "
+              f"макс. ошибка {MEAN_POINTS.verify():.3f}″")
+    expired = READINGS.purge_expired()
+    if expired:
+        print(f"📚 Кэш разборов: удалено устаревших {expired}")
+    replayed = STATS.load()
+    print(f"📊 Статистика: снимок + {replayed[0]} расчётов / {replayed[1]} платежей из хвоста журналов")
+    print(f"📈 Таблицы переходов UTC-смещений: {tables} зон ({BIRTH_YEAR_MIN}–{BIRTH_YEAR_MAX})")
+    
+    builder = (
+        Application.builder()
+        .token(TELEGRAM_TOKEN)
+        .post_init(post_init)
+        .post_stop(post_stop)
+        .post_shutdown(post_shutdown)
+        .concurrent_updates(UPDATE_PROCESSOR)
+        .persistence(PERSISTENCE)
+    )
+    if TELEGRAM_API_URL:
+        api = TELEGRAM_API_URL.rstrip("/")
+        builder = builder.base_url(f"{api}/bot").base_file_url(f"{api}/file/bot")
+        print(f"🧪 Bot API: {api}")
+    app = builder.build()
 
     # Команды
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("balance", show_balance))
     app.add_handler(CommandHandler("reports", reports))
     app.add_handler(CommandHandler("add_balance", add_balance_cmd))
+    app.add_handler(CommandHandler("reload_balances", reload_balances_cmd))
     app.add_handler(CommandHandler("admin_help", admin_help))
     app.add_handler(CommandHandler("admin", admin_menu))
     
@@ -1429,7 +4205,7 @@ def main():
     app.add_handler(MessageHandler(filters.Regex("^🏠 Главное меню$"), main_menu))
     
     # Callbacks
-    app.add_handler(CallbackQueryHandler(deep_lilith, pattern="^deep_lilith$"))
+    app.add_handler(CallbackQueryHandler(deep_lilith, pattern="^deep_lilith(:[0-9:]+)?$"))
     app.add_handler(CallbackQueryHandler(buy, pattern="^buy_"))
     app.add_handler(CallbackQueryHandler(first_free, pattern="^first_free$"))
     app.add_handler(CallbackQueryHandler(admin_menu, pattern="^admin_menu$"))
@@ -1445,6 +4221,8 @@ def main():
 
     # --- Лилит ---
     lil_conv = ConversationHandler(
+        name="lilith",
+        persistent=True,
         entry_points=[MessageHandler(filters.Regex("^🌙 Расчёт Лилит$"), lil_start)],
         states={
             LIL_CITY:   [MessageHandler(filters.TEXT & ~filters.COMMAND, lil_city)],
@@ -1459,6 +4237,8 @@ def main():
 
     # --- Узлы ---
     nodes_conv = ConversationHandler(
+        name="nodes",
+        persistent=True,
         entry_points=[MessageHandler(filters.Regex("^⭐ Расчёт Узлов Луны$"), nodes_start)],
         states={
             NOD_CITY:   [MessageHandler(filters.TEXT & ~filters.COMMAND, nodes_city)],
@@ -1479,7 +4259,23 @@ def main():
     
     print("✅ Часовой пояс: Автоматический учёт DST (летнее/зимнее время)")
     
-    app.run_polling()
+    if BOT_MODE == "webhook":
+        # Telegram сам держит до max_connections параллельных запросов; запросы без
+        # верного секрета отклоняются с 403. На SIGINT/SIGTERM сервер перестаёт принимать
+        # апдейты, а Application.stop дообрабатывает очередь и фоновые задачи.
+        print(f"🌐 Webhook: {WEBHOOK_LISTEN}:{WEBHOOK_PORT}/{WEBHOOK_PATH} → {WEBHOOK_URL}, "
+              f"до {WEBHOOK_MAX_CONNECTIONS} соединений")
+        app.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=WEBHOOK_URL,
+            secret_token=WEBHOOK_SECRET,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+            allowed_updates=Update.ALL_TYPES,
+        )
+    else:
+        app.run_polling()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,32 @@
+#!/usr/bin/env python3
+"""
+🪐 Урезанный набор эфемерид для деплоя: только файлы .se1 под BIRTH_YEAR_MIN–BIRTH_YEAR_MAX
+Запуск: python ephe_bundle.py build/ephe   (затем EPHE_PATH=build/ephe в окружении бота)
+"""
+import os
+import sys
+from pathlib import Path
+
+os.environ.setdefault("TELEGRAM_TOKEN", "bundle")
+os.environ.setdefault("GROQ_API_KEY", "bundle")
+
+import bot
+
+
+def main():
+    if len(sys.argv) < 2:
+        sys.exit(__doc__.strip())
+    dest = Path(sys.argv[1]).resolve()
+    files = bot.EPHE_FILES
+    print(f"📅 Годы {files.year_min}–{files.year_max}: {', '.join(files.required())}")
+    try:
+        size = files.build_bundle(dest)
+    except FileNotFoundError as e:
+        sys.exit(f"❌ {e}")
+    full = files.stats()
+    print(f"📦 {dest}: {len(files.required())} файла(ов), {size / 2**20:.1f} МБ "
+          f"вместо {full['dir_files']} файлов, {full['dir_bytes'] / 2**20:.0f} МБ")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+"""
+🧪 Заглушка Groq API (OpenAI-совместимый /openai/v1/chat/completions) с задержкой и ошибками
+Запуск: python fake_groq.py [порт] [профиль]
+Бот: GROQ_BASE_URL=http://127.0.0.1:<порт> python bot.py
+
+Профиль — поведение по моделям, «*» — для всех остальных:
+    "llama-3.3-70b-versatile=latency:1.5,jitter:0.5,error:0.1;llama-3.1-8b-instant=status:429;*=latency:0.2"
+latency/jitter — секунды до первого куска ответа, error — доля ответов 500,
+status — каждый ответ с этим кодом (429 — с Retry-After: retry_after).
+"""
+import sys
+import json
+import time
+import random
+import asyncio
+import threading
+from collections import Counter
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+import tornado.web
+import tornado.httpserver
+
+DEFAULT_PROFILE = "*=latency:0.05"
+CHUNK_WORDS = 8
+
+READING_TEXT = (
+    "Чёрная Луна в этой карте говорит о внутреннем напряжении, которое просит честности с собой. "
+    "Северный узел указывает направление роста: меньше оглядки на чужие ожидания, больше собственных решений. "
+    "Южный узел хранит привычные сценарии — они дают опору, но не должны становиться клеткой. "
+    "Фаза Луны при рождении добавляет ритм: силы приходят волнами, и это нормально."
+)
+
+
+@dataclass
+class Behaviour:
+    latency: float = 0.05
+    jitter: float = 0.0
+    error: float = 0.0
+    status: int = 200
+    retry_after: float = 1.0
+
+    def delay(self, rnd: random.Random) -> float:
+        return max(0.0, self.latency + rnd.uniform(-self.jitter, self.jitter))
+
+
+def parse_profile(spec: str) -> Dict[str, Behaviour]:
+    profile = {}
+    for part in filter(None, (p.strip() for p in spec.split(";"))):
+        model, _, options = part.partition("=")
+        behaviour = Behaviour()
+        for option in filter(None, options.split(",")):
+            name, _, value = option.partition(":")
+            setattr(behaviour, name.strip(), type(getattr(behaviour, name.strip()))(float(value)))
+        profile[model.strip()] = behaviour
+    profile.setdefault("*", Behaviour())
+    return profile
+
+
+def answer_for(prompt: str) -> str:
+    """Правдоподобный ответ на промпты бота: город, часовой пояс или разбор"""
+    if "Город латиницей" in prompt:
+        return "Moscow;55.7558;37.6173;RU"
+    if "Часовой пояс" in prompt:
+        return "3"
+    return READING_TEXT
+
+
+class FakeGroq:
+    """Состояние заглушки: профиль по моделям и счётчики запросов/ответов"""
+
+    def __init__(self, profile: Optional[Dict[str, Behaviour]] = None, seed: int = 7):
+        self.profile = profile or parse_profile(DEFAULT_PROFILE)
+        self.rnd = random.Random(seed)
+        self.requests = Counter()
+        self.statuses = Counter()
+        self.cancelled = 0
+
+    def behaviour(self, model: str) -> Behaviour:
+        return self.profile.get(model, self.profile["*"])
+
+    def status(self, model: str) -> int:
+        behaviour = self.behaviour(model)
+        if behaviour.status != 200:
+            return behaviour.status
+        return 500 if self.rnd.random() < behaviour.error else 200
+
+
+class CompletionsHandler(tornado.web.RequestHandler):
+    def initialize(self, groq: FakeGroq):
+        self.groq = groq
+        self.finished = False
+
+    def on_connection_close(self):
+        # Клиент бросил запрос (отмена дублирующего запроса или таймаут)
+        if not self.finished:
+            self.groq.cancelled += 1
+
+    def error(self, status: int, model: str):
+        messages = {429: "Rate limit reached", 403: "Model access denied", 404: "Model not found"}
+        if status == 429:
+            self.set_header("retry-after", str(self.groq.behaviour(model).retry_after))
+        self.set_status(status)
+        self.write({"error": {"message": messages.get(status, "Internal server error"),
+                              "type": "fake_error", "code": str(status)}})
+
+    def chunk(self, cid: str, model: str, delta: Dict, finish: Optional[str] = None) -> str:
+        body = {"id": cid, "object": "chat.completion.chunk", "created": int(time.time()), "model": model,
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish}]}
+        return f"data: {json.dumps(body, ensure_ascii=False)}\n\n"
+
+    async def post(self):
+        body = json.loads(self.request.body)
+        model = body.get("model", "")
+        self.groq.requests[model] += 1
+        status = self.groq.status(model)
+        await asyncio.sleep(self.groq.behaviour(model).delay(self.groq.rnd))
+        self.groq.statuses[status] += 1
+        if status != 200:
+            self.error(status, model)
+            self.finished = True
+            return
+
+        text = answer_for(body["messages"][-1]["content"])
+        cid = f"chatcmpl-{self.groq.rnd.getrandbits(48):x}"
+        if not body.get("stream"):
+            self.write({
+                "id": cid, "object": "chat.completion", "created": int(time.time()), "model": model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": text},
+                             "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": 100, "completion_tokens": len(text.split()), "total_tokens": 0},
+            })
+            self.finished = True
+            return
+
+        self.set_header("Content-Type", "text/event-stream")
+        words = text.split(" ")
+        pieces: List[str] = [" ".join(words[i:i + CHUNK_WORDS]) + " " for i in range(0, len(words), CHUNK_WORDS)]
+        self.write(self.chunk(cid, model, {"role": "assistant", "content": ""}))
+        for piece in pieces:
+            self.write(self.chunk(cid, model, {"content": piece}))
+            await self.flush()
+            await asyncio.sleep(0)
+        self.write(self.chunk(cid, model, {}, "stop"))
+        self.write("data: [DONE]\n\n")
+        self.finished = True
+
+
+def make_server(groq: FakeGroq) -> tornado.httpserver.HTTPServer:
+    # Журнал запросов не нужен: статусы считает сама заглушка, а 429/500 — норма профиля
+    return tornado.httpserver.HTTPServer(tornado.web.Application([
+        (r"/openai/v1/chat/completions", CompletionsHandler, {"groq": groq}),
+    ], log_function=lambda handler: None))
+
+
+def serve_in_thread(groq: FakeGroq, port: int) -> threading.Thread:
+    """Заглушка в отдельном потоке со своим циклом событий — для тестов и бенчмарков"""
+    started = threading.Event()
+
+    async def run():
+        make_server(groq).listen(port, "127.0.0.1")
+        started.set()
+        await asyncio.Event().wait()
+
+    thread = threading.Thread(target=asyncio.run, args=(run(),), daemon=True, name="fake-groq")
+    thread.start()
+    started.wait(10)
+    return thread
+
+
+async def main(port: int, spec: str):
+    groq = FakeGroq(parse_profile(spec))
+    make_server(groq).listen(port, "127.0.0.1")
+    print(f"🤖 Заглушка Groq: http://127.0.0.1:{port}, профиль: {spec}")
+    try:
+        while True:
+            await asyncio.sleep(10)
+            if groq.requests:
+                print(f"📡 Запросы: {dict(groq.requests)}, ответы: {dict(groq.statuses)}, брошено: {groq.cancelled}")
+    except asyncio.CancelledError:
+        pass
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 8765,
+                         sys.argv[2] if len(sys.argv) > 2 else DEFAULT_PROFILE))
+    except KeyboardInterrupt:
+        pass
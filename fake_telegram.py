@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+"""
+🧪 Офлайн-нагрузка webhook-режима: заглушка Bot API + бот в BOT_MODE=webhook + поток апдейтов
+Запуск: python fake_telegram.py [пользователей] [параллельно]
+Полная нагрузка (магазин, разборы, заглушка Groq) — bench_load.py, он использует этот модуль.
+
+Заглушка отвечает на любые методы Bot API так, как ответил бы Telegram, и запоминает,
+когда боту понадобилось написать в чат — это момент ответа на апдейт.
+Бот стартует отдельным процессом с временным DATA_DIR, рабочие журналы не трогаются.
+"""
+import os
+import sys
+import json
+import time
+import signal
+import socket
+import asyncio
+import secrets
+import tempfile
+import subprocess
+from collections import Counter, defaultdict
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import httpx
+import tornado.web
+import tornado.httpserver
+
+BASE_DIR = Path(__file__).resolve().parent
+TOKEN = "123456:FAKE"
+BOT_USER = {"id": 123456, "is_bot": True, "first_name": "NatKart", "username": "natkart_test_bot"}
+
+DRAIN_BURST = 30                # апдейтов, отправленных прямо перед SIGINT
+STEP_TIMEOUT = 30.0
+START_TIMEOUT = 90.0
+
+# Сценарий одного пользователя: полный расчёт Лилит
+SCENARIO = ["/start", "🌙 Расчёт Лилит", "Москва", "15", "6", "1985", "09"]
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q / 100 * (len(ordered) - 1))))]
+
+
+class FakeBotApi:
+    """
+    Состояние заглушки: счётчики методов и входящие «сообщения бота» по чатам.
+    Запоминает последние сообщения с inline-кнопками (по callback_data) и выставленные
+    счета — чтобы нагрузка могла «нажать» кнопку и «оплатить» счёт. latency — секунд
+    на каждый вызов, как сетевая задержка до Telegram.
+    """
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.calls = Counter()
+        self.message_id = 0
+        self.inbox: Dict[int, asyncio.Queue] = defaultdict(asyncio.Queue)
+        self.buttons: Dict[int, Dict[str, Dict]] = defaultdict(dict)
+        self.invoices: Dict[int, Dict] = {}
+        self.webhook_set = asyncio.Event()
+
+    def message(self, chat_id: int, text: str = "", message_id: Optional[int] = None) -> Dict:
+        if message_id is None:
+            self.message_id += 1
+            message_id = self.message_id
+        return {"message_id": message_id, "date": int(time.time()), "text": text,
+                "chat": {"id": chat_id, "type": "private"}, "from": BOT_USER}
+
+    def remember_buttons(self, chat_id: int, message: Dict, markup):
+        for row in (markup or {}).get("inline_keyboard", []):
+            for button in row:
+                if "callback_data" in button:
+                    self.buttons[chat_id].pop(button["callback_data"], None)   # свежие — в конец
+                    self.buttons[chat_id][button["callback_data"]] = message
+
+    def button(self, chat_id: int, prefix: str) -> Optional[Tuple[str, Dict]]:
+        """Последняя кнопка, чей callback_data начинается с prefix: (callback_data, сообщение)"""
+        for data, message in reversed(list(self.buttons[chat_id].items())):
+            if data == prefix or data.startswith(prefix + ":"):
+                return data, message
+        return None
+
+    def handle(self, method: str, params: Dict):
+        self.calls[method] += 1
+        chat_id = params.get("chat_id")
+        if method == "getMe":
+            return BOT_USER
+        if method == "setWebhook":
+            self.webhook_set.set()
+            return True
+        if method == "answerPreCheckoutQuery":
+            # id запроса в нагрузке — «<uid>:<номер>»
+            uid = int(str(params["pre_checkout_query_id"]).split(":")[0])
+            self.inbox[uid].put_nowait((time.perf_counter(), method, ""))
+            return True
+        if method in ("sendMessage", "editMessageText", "sendInvoice") and chat_id is not None:
+            chat_id = int(chat_id)
+            text = params.get("text", params.get("title", ""))
+            message = self.message(chat_id, text, params.get("message_id"))
+            self.remember_buttons(chat_id, message, params.get("reply_markup"))
+            if method == "sendInvoice":
+                self.invoices[chat_id] = params
+            self.inbox[chat_id].put_nowait((time.perf_counter(), method, text))
+            return message
+        if method == "getWebhookInfo":
+            return {"url": "", "has_custom_certificate": False, "pending_update_count": 0}
+        return True
+
+
+class MethodHandler(tornado.web.RequestHandler):
+    def initialize(self, api: FakeBotApi):
+        self.api = api
+
+    def params(self) -> Dict:
+        if self.request.headers.get("Content-Type", "").startswith("application/json") and self.request.body:
+            return json.loads(self.request.body)
+        out = {}
+        for key, values in self.request.body_arguments.items():
+            raw = values[-1].decode()
+            try:
+                out[key] = json.loads(raw)
+            except ValueError:
+                out[key] = raw
+        return out
+
+    async def post(self, token: str, method: str):
+        if self.api.latency:
+            await asyncio.sleep(self.api.latency)
+        self.write({"ok": True, "result": self.api.handle(method, self.params())})
+
+    get = post
+
+
+def user_json(uid: int) -> Dict:
+    return {"id": uid, "is_bot": False, "first_name": f"Load{uid}", "username": f"load{uid}"}
+
+
+def update_json(update_id: int, uid: int, text: str) -> Dict:
+    message = {
+        "message_id": update_id, "date": int(time.time()), "text": text,
+        "chat": {"id": uid, "type": "private"}, "from": user_json(uid),
+    }
+    if text.startswith("/"):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text)}]
+    return {"update_id": update_id, "message": message}
+
+
+class LoadDriver:
+    def __init__(self, api: FakeBotApi, webhook: str, secret: str):
+        self.api = api
+        self.webhook = webhook
+        self.secret = secret
+        self.update_id = 0
+        self.latencies: List[float] = []
+        self.timeouts = 0
+        self.rejected = 0
+
+    async def post(self, client: httpx.AsyncClient, uid: int, text: str, secret: Optional[str] = None) -> int:
+        self.update_id += 1
+        resp = await client.post(self.webhook, json=update_json(self.update_id, uid, text),
+                                 headers={"X-Telegram-Bot-Api-Secret-Token": secret or self.secret})
+        return resp.status_code
+
+    async def step(self, client: httpx.AsyncClient, uid: int, text: str):
+        inbox = self.api.inbox[uid]
+        while not inbox.empty():
+            inbox.get_nowait()
+        t0 = time.perf_counter()
+        if await self.post(client, uid, text) != 200:
+            self.rejected += 1
+            return
+        try:
+            answered, _, _ = await asyncio.wait_for(inbox.get(), STEP_TIMEOUT)
+            self.latencies.append(answered - t0)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+
+    async def user(self, client: httpx.AsyncClient, uid: int, gate: asyncio.Semaphore):
+        async with gate:
+            for text in SCENARIO:
+                await self.step(client, uid, text)
+
+
+def serve_api(api: FakeBotApi) -> Tuple[tornado.httpserver.HTTPServer, str]:
+    """Заглушка Bot API на свободном порту: (сервер, адрес для TELEGRAM_API_URL)"""
+    port = free_port()
+    server = tornado.httpserver.HTTPServer(tornado.web.Application([
+        (r"/bot([^/]+)/(\w+)", MethodHandler, {"api": api}),
+    ]))
+    server.listen(port, "127.0.0.1")
+    return server, f"http://127.0.0.1:{port}"
+
+
+async def launch_bot(api: FakeBotApi, api_url: str, **env_extra):
+    """
+    bot.py в webhook-режиме с временным DATA_DIR; ждёт, пока бот зарегистрирует webhook.
+    Возвращает (процесс, адрес webhook, секрет, журнал).
+    """
+    hook_port = free_port()
+    secret = secrets.token_urlsafe(24)
+    data_dir = tempfile.mkdtemp(prefix="natkart-load-")
+    env = dict(os.environ,
+               TELEGRAM_TOKEN=TOKEN, GROQ_API_KEY="fake", DATA_DIR=data_dir,
+               BOT_MODE="webhook", WEBHOOK_LISTEN="127.0.0.1", WEBHOOK_PORT=str(hook_port),
+               WEBHOOK_PATH="telegram", WEBHOOK_URL=f"http://127.0.0.1:{hook_port}/telegram",
+               WEBHOOK_SECRET=secret, TELEGRAM_API_URL=api_url, **env_extra)
+    log_path = Path(data_dir) / "bot.log"
+    with open(log_path, "w") as log:
+        bot = subprocess.Popen([sys.executable, str(BASE_DIR / "bot.py")], env=env, cwd=BASE_DIR,
+                               stdout=log, stderr=subprocess.STDOUT)
+    print(f"🤖 Бот запущен (pid {bot.pid}), журнал: {log_path}")
+
+    try:
+        await asyncio.wait_for(api.webhook_set.wait(), START_TIMEOUT)
+        await asyncio.sleep(0.5)   # setWebhook вызывается до того, как сервер начнёт слушать
+    except asyncio.TimeoutError:
+        bot.kill()
+        sys.exit(f"❌ Бот не вызвал setWebhook за {START_TIMEOUT:.0f} с — см. {log_path}")
+    return bot, f"http://127.0.0.1:{hook_port}/telegram", secret, log_path
+
+
+async def main(users: int, concurrency: int):
+    api = FakeBotApi()
+    server, api_url = serve_api(api)
+    bot, webhook, secret, _ = await launch_bot(api, api_url)
+
+    driver = LoadDriver(api, webhook, secret)
+    limits = httpx.Limits(max_connections=concurrency)
+    async with httpx.AsyncClient(limits=limits, timeout=STEP_TIMEOUT) as client:
+        wrong = await driver.post(client, 1, "/start", secret="wrong")
+        print(f"🔐 Апдейт с чужим секретом: HTTP {wrong} {'✅' if wrong == 403 else '❌'}")
+
+        gate = asyncio.Semaphore(concurrency)
+        t0 = time.perf_counter()
+        await asyncio.gather(*(driver.user(client, 10_000 + i, gate) for i in range(users)))
+        elapsed = time.perf_counter() - t0
+
+        # Плавная остановка: апдейты уже приняты сервером — бот обязан ответить на все
+        burst = [20_000 + i for i in range(DRAIN_BURST)]
+        for uid in burst:
+            api.inbox[uid]
+        await asyncio.gather(*(driver.post(client, uid, "/start") for uid in burst))
+    bot.send_signal(signal.SIGINT)
+    t_stop = time.perf_counter()
+    code = await asyncio.to_thread(bot.wait, 60)
+    drained = sum(1 for uid in burst if not api.inbox[uid].empty())
+    server.stop()
+
+    steps = len(driver.latencies)
+    print(f"👥 Пользователей: {users}, одновременно: {concurrency}, шагов: {steps} за {elapsed:.2f} с "
+          f"({steps / elapsed:,.0f} апдейтов/с)")
+    print(f"⏱ Ответ: p50 {percentile(driver.latencies, 50)*1000:.0f} мс, "
+          f"p95 {percentile(driver.latencies, 95)*1000:.0f} мс, p99 {percentile(driver.latencies, 99)*1000:.0f} мс")
+    print(f"⚠️ Без ответа: {driver.timeouts}, отклонено webhook-сервером: {driver.rejected}")
+    print(f"🛑 Остановка: код {code} за {time.perf_counter() - t_stop:.1f} с, "
+          f"дообработано {drained}/{DRAIN_BURST} апдейтов {'✅' if drained == DRAIN_BURST else '❌'}")
+    print(f"📡 Вызовы Bot API: {dict(api.calls.most_common())}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 50,
+                     int(sys.argv[2]) if len(sys.argv) > 2 else 20))
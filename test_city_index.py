@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+"""
+🏙 Проверка CityIndex: подписи вариантов различают одноимённые города
+и каждая подпись-кнопка находит ровно один город
+Запуск: python -m pytest -q test_city_index.py  (или просто python test_city_index.py)
+"""
+import os
+
+os.environ.setdefault("TELEGRAM_TOKEN", "test")
+os.environ.setdefault("GROQ_API_KEY", "test")
+
+import bot
+
+CATALOG = bot.CITY_CATALOG
+INDEX = bot.CITY_INDEX
+
+
+def test_every_label_resolves_to_one_city():
+    for idx in range(len(CATALOG)):
+        label = CATALOG.label(idx)
+        city, suggestions = INDEX.lookup(label)
+        assert city is not None and suggestions == [], label
+        assert (city[0], city[3]) == (CATALOG.names[idx], CATALOG.iso[idx]), label
+
+
+def test_suggestions_are_distinct():
+    for text in ("Moscow", "Казань", "Киров", "Советск", "Кир", "Ива"):
+        city, suggestions = INDEX.lookup(text)
+        assert len(suggestions) == len(set(suggestions)), text
+        for label in suggestions:
+            assert INDEX.lookup(label)[0] is not None, label
+
+
+def test_repeated_rows_are_one_city():
+    city, suggestions = INDEX.lookup("Moscow")
+    assert city is not None and suggestions == []
+
+
+def test_same_name_cities_need_a_choice():
+    city, suggestions = INDEX.lookup("Киров")
+    assert city is None and len(suggestions) == 2
+    chosen, rest = INDEX.lookup(suggestions[1])
+    assert rest == [] and chosen == CATALOG.row(INDEX._by_label[suggestions[1]])
+
+
+if __name__ == "__main__":
+    for name, fn in list(globals().items()):
+        if name.startswith("test_") and callable(fn):
+            fn()
+            print(f"✅ {name}")
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""
+🏠 Проверка распределения по домам: HouseLocator / house_for_lon / houses_for_lons
+Запуск: python -m pytest -q test_houses.py  (или просто python test_houses.py)
+"""
+import os
+import random
+
+os.environ.setdefault("TELEGRAM_TOKEN", "test")
+os.environ.setdefault("GROQ_API_KEY", "test")
+
+import numpy as np
+import swisseph as swe
+import bot
+
+RND = random.Random(2024)
+EPS = 1e-6
+
+
+def random_jd() -> float:
+    return swe.julday(RND.randint(bot.BIRTH_YEAR_MIN, bot.BIRTH_YEAR_MAX), RND.randint(1, 12),
+                      RND.randint(1, 28), RND.uniform(0, 24))
+
+
+def placidus(jd: float, lat: float, lon: float):
+    cusps, ascmc = swe.houses(jd, lat, lon, b"P")
+    return cusps, ascmc[2]
+
+
+def test_cusp_starts_its_house():
+    for _ in range(500):
+        cusps = bot.house_cusps(random_jd(), RND.uniform(-60, 60), RND.uniform(-180, 180))
+        locator = bot.HouseLocator(cusps)
+        for i, cusp in enumerate(cusps):
+            assert locator.house(cusp + EPS) == i + 1
+            assert locator.house(cusp - EPS) == (i - 1) % 12 + 1
+
+
+def test_point_before_next_cusp_stays_in_house():
+    # Раньше выбирался ближайший куспид: точка за градус до куспида 3 уходила в 3 дом
+    cusps = bot.house_cusps(swe.julday(1985, 7, 1, 9.0), 55.75, 37.62)
+    assert bot.house_for_lon(cusps[2] - 1.0, cusps) == 2
+    assert bot.house_for_lon(cusps[0] + 0.5, cusps) == 1
+
+
+def test_matches_swe_house_pos():
+    checked = 0
+    for _ in range(300):
+        jd = random_jd()
+        lat, lon = RND.uniform(-65, 65), RND.uniform(-180, 180)
+        cusps, armc = placidus(jd, lat, lon)
+        eps = swe.calc_ut(jd, swe.ECL_NUT)[0][0]
+        locator = bot.HouseLocator(cusps)
+        for _ in range(20):
+            point = RND.uniform(0, 360)
+            if min(abs((point - c + 180) % 360 - 180) for c in cusps) < 1e-5:
+                continue
+            expected = int(swe.house_pos(armc, lat, eps, (point, 0.0), b"P"))
+            assert locator.house(point) == expected, (jd, lat, lon, point)
+            checked += 1
+    assert checked > 5000
+
+
+def test_polar_latitudes_fall_back_and_stay_consistent():
+    failures = 0
+    for lat in (66.0, 67.5, 69.35, 72.0, 78.2, 85.0, 89.9, -66.6, -70.0, -89.9):
+        for _ in range(50):
+            jd = random_jd()
+            lon = RND.uniform(-180, 180)
+            try:
+                swe.houses(jd, lat, lon, b"P")
+            except swe.Error:
+                failures += 1
+            cusps = bot.house_cusps(jd, lat, lon)
+            assert len(cusps) == 12
+            offsets = bot.HouseLocator(cusps).offsets
+            assert offsets[0] == 0 and all(a < b for a, b in zip(offsets, offsets[1:]))
+            for point in np.linspace(0, 360, 97)[:-1]:
+                assert 1 <= bot.house_for_lon(point, cusps) <= 12
+    # За полярным кругом Плацидус действительно отказывает — значит, запасная система нужна
+    assert failures > 0
+
+
+def test_vectorized_matches_scalar():
+    charts = [(random_jd(), RND.choice([RND.uniform(-60, 60), RND.uniform(66, 89)]), RND.uniform(-180, 180))
+              for _ in range(2000)]
+    cusps = np.array([bot.house_cusps(*chart) for chart in charts])
+    lons = np.array([RND.uniform(0, 360) for _ in charts])
+    expected = [bot.house_for_lon(p, c) for p, c in zip(lons, cusps)]
+    assert bot.houses_for_lons(lons, cusps).tolist() == expected
+
+
+if __name__ == "__main__":
+    for name, fn in list(globals().items()):
+        if name.startswith("test_") and callable(fn):
+            fn()
+            print(f"✅ {name}")
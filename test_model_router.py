@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+"""
+🔀 Проверка ModelRouter на локальной заглушке Groq (fake_groq.py): переключение при 429/403,
+маршрут коротких запросов, дублирование медленного запроса
+Запуск: python -m pytest -q test_model_router.py  (или просто python test_model_router.py)
+"""
+import os
+import socket
+import asyncio
+
+os.environ.setdefault("TELEGRAM_TOKEN", "test")
+os.environ.setdefault("GROQ_API_KEY", "test")
+
+from groq import AsyncGroq
+import bot
+import fake_groq
+
+DEEP = ["big-a", "big-b", "big-c"]
+FAST = ["small"]
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+GROQ = fake_groq.FakeGroq()
+PORT = free_port()
+fake_groq.serve_in_thread(GROQ, PORT)
+
+
+def router(spec: str, hedge: bool = False) -> bot.ModelRouter:
+    GROQ.profile = fake_groq.parse_profile(spec)
+    GROQ.requests.clear()
+    # Клиент привязан к циклу событий — новый на каждый asyncio.run
+    bot.groq_client = AsyncGroq(api_key="test", base_url=f"http://127.0.0.1:{PORT}", max_retries=0)
+    return bot.ModelRouter({
+        bot.ROUTE_DEEP: {"models": DEEP, "temperature": 0.8, "max_tokens": 2048},
+        bot.ROUTE_FAST: {"models": FAST + DEEP, "temperature": 0.0, "max_tokens": 64},
+    }, hedge=hedge)
+
+
+def test_rate_limited_model_fails_over_and_rests():
+    async def run():
+        r = router("big-a=status:429,retry_after:30;*=latency:0.01")
+        assert await r.ask("разбор карты") == fake_groq.READING_TEXT
+        assert GROQ.requests["big-a"] == 1 and GROQ.requests["big-b"] == 1
+        assert r.failovers == 1 and r.health["big-a"].rate_limited == 1
+        # На паузе после 429 модель больше не трогаем
+        await r.ask("ещё один разбор")
+        assert GROQ.requests["big-a"] == 1
+        assert r.candidates(bot.ROUTE_DEEP)[0] == "big-b"
+    asyncio.run(run())
+
+
+def test_forbidden_model_is_skipped_for_long():
+    async def run():
+        r = router("big-a=status:403;big-b=status:403;*=latency:0.01")
+        assert await r.ask("разбор карты") == fake_groq.READING_TEXT
+        assert GROQ.requests["big-c"] == 1
+        assert r.health["big-b"].forbidden == 1
+        assert r.health["big-b"].cooldown_until - bot.time.monotonic() > bot.GROQ_COOLDOWN_FORBIDDEN - 5
+        assert r.candidates(bot.ROUTE_DEEP) == ["big-c"]
+    asyncio.run(run())
+
+
+def test_all_models_down_returns_empty():
+    async def run():
+        r = router("*=status:500")
+        # Одна 5xx паузу не ставит — серия из GROQ_ERROR_STREAK ставит
+        for _ in range(bot.GROQ_ERROR_STREAK):
+            assert await r.ask("разбор карты") == ""
+        assert sum(GROQ.requests.values()) == len(DEEP) * bot.GROQ_ERROR_STREAK
+        # Вся цепочка на паузе — в Groq больше не ходим
+        assert r.candidates(bot.ROUTE_DEEP) == []
+        assert await r.ask("разбор карты") == ""
+        assert sum(GROQ.requests.values()) == len(DEEP) * bot.GROQ_ERROR_STREAK
+    asyncio.run(run())
+
+
+def test_timeout_covers_whole_chain():
+    async def run():
+        r = router("big-a=latency:0.4,status:500;*=latency:2")
+        t0 = bot.time.monotonic()
+        assert await r.ask("разбор карты", timeout=1.0) == ""
+        # Вторая модель получает только остаток, третья — не пробуется вовсе
+        assert bot.time.monotonic() - t0 < 1.3
+        assert GROQ.requests["big-b"] == 1 and not GROQ.requests["big-c"]
+    asyncio.run(run())
+
+
+def test_fast_route_prefers_small_model():
+    async def run():
+        r = router("*=latency:0.01")
+        assert await r.ask("Ответь строго: Город латиницей", bot.ROUTE_FAST) == "Moscow;55.7558;37.6173;RU"
+        assert GROQ.requests["small"] == 1 and not GROQ.requests["big-a"]
+    asyncio.run(run())
+
+
+def test_backups_ordered_by_latency():
+    async def run():
+        r = router("big-b=latency:0.2;*=latency:0.01")
+        for model in DEEP:
+            await r._attempt(model, "разбор", r.routes[bot.ROUTE_DEEP], 5.0)
+        assert r.candidates(bot.ROUTE_DEEP) == ["big-a", "big-c", "big-b"]
+    asyncio.run(run())
+
+
+def test_streaming_fails_over_before_first_chunk():
+    async def run():
+        r = router("big-a=status:429;*=latency:0.01")
+        parts = []
+
+        async def on_delta(delta):
+            parts.append(delta)
+
+        text = await r.ask("разбор карты", on_delta=on_delta)
+        assert text == fake_groq.READING_TEXT and "".join(parts).strip() == text
+    asyncio.run(run())
+
+
+def test_hedge_after_p95():
+    async def run():
+        r = router("*=latency:0.01", hedge=True)
+        for _ in range(bot.GROQ_HEDGE_MIN_SAMPLES):
+            await r.ask("разогрев")
+        assert r.hedges == 0
+        GROQ.profile = fake_groq.parse_profile("big-a=latency:3;*=latency:0.01")
+        t0 = bot.time.monotonic()
+        assert await r.ask("медленный разбор") == fake_groq.READING_TEXT
+        assert bot.time.monotonic() - t0 < 1.5
+        assert r.hedges == 1 and r.hedge_wins == 1
+        assert GROQ.requests["big-b"] == 1
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    for name, fn in list(globals().items()):
+        if name.startswith("test_") and callable(fn):
+            fn()
+            print(f"✅ {name}")